@@ -1,7 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any, TypeVar, Generic
-import databutton as db
+from app.libs import answer_cache, index_cache, llm_client, search_batcher, search_cache, single_flight, storage
 import json
 from datetime import datetime
 import re
@@ -17,6 +17,12 @@ class QueryMetrics(BaseModel):
     confidence_level: Optional[str] = None
     response_length: int
     processing_time_ms: Optional[int] = None
+    retrieval_time_ms: Optional[float] = None
+    prompt_tokens: Optional[int] = None   # Whole prompt sent to the model
+    history_tokens: Optional[int] = None  # Conversation history part of the prompt
+    context_tokens: Optional[int] = None  # Repository context part of the prompt
+    relevance_gate: Optional[str] = None  # "skip", "cheap" or "full"
+    top_semantic_score: Optional[float] = None  # Best semantic score retrieved
     num_sources: int
     avg_semantic_score: Optional[float] = None
     avg_credibility_score: Optional[float] = None
@@ -36,6 +42,7 @@ class QueryStatsResponse(BaseModel):
     avg_processing_time: Optional[float] = None
     confidence_distribution: Dict[str, int] = {}
     source_type_distribution: Dict[str, int] = {}
+    relevance_gate_distribution: Dict[str, int] = {}  # e.g., {"full": 40, "cheap": 6, "skip": 4}
     top_queries: List[Dict[str, Any]] = []
     daily_query_counts: List[Dict[str, Any]] = []
 
@@ -53,7 +60,7 @@ async def log_query(metrics: QueryMetrics, user: AuthorizedUser):
         user_metrics_key = sanitize_storage_key(f"user_metrics_{user.sub}")
         
         try:
-            existing_metrics = db.storage.json.get(user_metrics_key, default=[])
+            existing_metrics = await storage.json_get(user_metrics_key, default=[])
         except:
             existing_metrics = []
             
@@ -61,16 +68,16 @@ async def log_query(metrics: QueryMetrics, user: AuthorizedUser):
         existing_metrics.append(metrics.dict())
         
         # Store updated metrics
-        db.storage.json.put(user_metrics_key, existing_metrics)
+        await storage.json_put(user_metrics_key, existing_metrics)
         
         # Also store in global metrics
         try:
-            global_metrics = db.storage.json.get("global_metrics", default=[])
+            global_metrics = await storage.json_get("global_metrics", default=[])
         except:
             global_metrics = []
             
         global_metrics.append(metrics.dict())
-        db.storage.json.put("global_metrics", global_metrics)
+        await storage.json_put("global_metrics", global_metrics)
         
         return {"success": True}
     except Exception as e:
@@ -83,7 +90,7 @@ async def get_query_history(user: AuthorizedUser, page: int = 1, page_size: int
         user_metrics_key = sanitize_storage_key(f"user_metrics_{user.sub}")
         
         try:
-            metrics = db.storage.json.get(user_metrics_key, default=[])
+            metrics = await storage.json_get(user_metrics_key, default=[])
         except:
             metrics = []
             
@@ -112,7 +119,7 @@ async def get_query_stats(user: AuthorizedUser, days: int = 30):
         user_metrics_key = sanitize_storage_key(f"user_metrics_{user.sub}")
         
         try:
-            metrics = db.storage.json.get(user_metrics_key, default=[])
+            metrics = await storage.json_get(user_metrics_key, default=[])
         except:
             metrics = []
             
@@ -142,6 +149,13 @@ async def get_query_stats(user: AuthorizedUser, days: int = 30):
             for source_type, count in source_types.items():
                 source_type_distribution[source_type] = source_type_distribution.get(source_type, 0) + count
         
+        # Relevance gate decisions
+        relevance_gate_distribution = {}
+        for m in metrics:
+            gate = m.get("relevance_gate")
+            if gate:
+                relevance_gate_distribution[gate] = relevance_gate_distribution.get(gate, 0) + 1
+        
         # Top queries (by frequency)
         query_counts = {}
         for m in metrics:
@@ -170,8 +184,44 @@ async def get_query_stats(user: AuthorizedUser, days: int = 30):
             "avg_processing_time": avg_processing_time,
             "confidence_distribution": confidence_distribution,
             "source_type_distribution": source_type_distribution,
+            "relevance_gate_distribution": relevance_gate_distribution,
             "top_queries": top_queries,
             "daily_query_counts": daily_query_counts
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get query statistics: {str(e)}")
+
+@router.get("/storage-metrics")
+async def get_storage_metrics(user: AuthorizedUser):
+    """Get per-operation storage latency metrics for this worker"""
+    return storage.storage_metrics()
+
+@router.get("/index-metrics")
+async def get_index_metrics(user: AuthorizedUser):
+    """Get vector index residency and hit-rate metrics for this worker"""
+    return index_cache.index_cache_stats()
+
+@router.get("/search-cache-metrics")
+async def get_search_cache_metrics(user: AuthorizedUser):
+    """Get search result cache hit-rate metrics for this worker"""
+    return search_cache.search_cache_stats()
+
+@router.get("/answer-cache-metrics")
+async def get_answer_cache_metrics(user: AuthorizedUser):
+    """Get semantic answer cache hit-rate metrics for this worker"""
+    return answer_cache.answer_cache_stats()
+
+@router.get("/llm-metrics")
+async def get_llm_metrics(user: AuthorizedUser):
+    """Get chat completion concurrency, queue wait and latency metrics for this worker"""
+    return llm_client.llm_metrics()
+
+@router.get("/coalescing-metrics")
+async def get_coalescing_metrics(user: AuthorizedUser):
+    """Get how many chat, search and embedding calls joined an identical one in flight on this worker"""
+    return single_flight.single_flight_stats()
+
+@router.get("/search-batching-metrics")
+async def get_search_batching_metrics(user: AuthorizedUser):
+    """Get how many concurrent searches were scored together in one matrix product on this worker"""
+    return search_batcher.search_batcher_stats()
@@ -1,24 +1,38 @@
-from fastapi import APIRouter, HTTPException, Depends, Request
+from fastapi import APIRouter, HTTPException, Depends, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator, Awaitable, Callable
+from contextlib import aclosing
 import databutton as db
 import json
-import re
+import os
 import pdfplumber
-from app.apis.embeddings import search, SearchRequest
+from app.apis.embeddings import SearchRequest, SearchResult, RetrievalContext, retrieve, embed_query, search_user_id
 import io
 from app.auth import AuthorizedUser
 from datetime import datetime
 import time
 from app.apis.analytics import QueryMetrics
 import asyncio
+from app.libs import answer_cache, chat_sessions, llm_client, prompt_budget, search_cache, single_flight
+from app.libs.response_formatter import ResponseFormatter
 
 # Import documents API directly
 from app.apis.documents import list_documents, get_document_content
 
 router = APIRouter()
 
+# Relevance gate for first questions, on the best semantic score retrieved (cosine
+# similarity). Below RELEVANCE_GATE_MIN_SCORE the insufficient-data answer is
+# returned without a completion; below RELEVANCE_GATE_FULL_SCORE the answer is
+# generated with the cheaper RELEVANCE_GATE_CHEAP_MODEL. Set both to 0 to disable.
+RELEVANCE_GATE_MIN_SCORE = float(os.environ.get("RELEVANCE_GATE_MIN_SCORE", "0.72"))
+RELEVANCE_GATE_FULL_SCORE = float(os.environ.get("RELEVANCE_GATE_FULL_SCORE", "0.78"))
+RELEVANCE_GATE_CHEAP_MODEL = os.environ.get("RELEVANCE_GATE_CHEAP_MODEL", "gpt-3.5-turbo")
+
+# Model for every other chat completion
+CHAT_MODEL = "gpt-4"
+
 # Define models for API requests and responses
 class ChatMessage(BaseModel):
     role: str  # Either 'user' or 'assistant'
@@ -26,7 +40,9 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     message: str
-    conversation_history: Optional[List[ChatMessage]] = []
+    conversation_history: Optional[List[ChatMessage]] = []  # Ignored when session_id is given
+    session_id: Optional[str] = None  # Server-side conversation, see /chat/sessions
+    multi_query: bool = False  # Retrieve with several query variants, see SearchRequest.multi_query
 
 class SourceMetadata(BaseModel):
     upload_date: Optional[str] = None  # For documents
@@ -59,72 +75,207 @@ class ChatResponse(BaseModel):
     message: str
     confidence_level: Optional[str] = None  # HIGH, MODERATE, LOW, or INSUFFICIENT
     sources: List[Source] = []
-
-@router.post("/chat")
-async def chat(request: ChatRequest, user: AuthorizedUser, fastapi_request: Request):
-    start_time = time.time()
+    cache_hit: bool = False  # True when answered from the semantic answer cache
+    session_id: Optional[str] = None
+
+class ChatSessionResponse(BaseModel):
+    session_id: str
+
+class ChatPrompt(BaseModel):
+    messages: List[Dict[str, str]]
+    used_document_ids: List[str] = []  # Documents whose content made it into the prompt
+    token_counts: Dict[str, int] = {}  # Tokens per prompt section, see build_chat_prompt
+    model: str = CHAT_MODEL
+    relevance_gate: Optional[str] = None  # "skip", "cheap" or "full", see relevance_gate
+
+def build_sources(results: List[SearchResult]) -> List[Source]:
+    """Create the Source entries shown with an answer from its retrieved results"""
+    sources = []
+    for result in results:
+        if result.source_type == "document":
+            doc_id = result.metadata.get("document_id") if result.metadata else None
+            doc_name = result.metadata.get("document_name", "Unknown Document") if result.metadata else "Unknown Document"
+
+            # Add any document that's related to the query as a source
+            sources.append(Source(
+                document_id=doc_id or "",
+                document_name=doc_name,
+                excerpt=result.text[:300] + "..." if len(result.text) > 300 else result.text,
+                source_type="document",
+
+                # Direct access scores for new UI
+                score=round(result.score, 2) if result.score is not None else None,
+                semantic_score=round(result.semantic_score, 2) if result.semantic_score is not None else None,
+                credibility_score=round(result.credibility_score, 2) if result.credibility_score is not None else None,
+                recency_score=round(result.recency_score, 2) if result.recency_score is not None else None,
+                category_score=round(result.category_score, 2) if result.category_score is not None else None,
+
+                # Legacy ranking info structure for backward compatibility
+                ranking_info={
+                    "semantic_score": round(result.semantic_score, 2) if result.semantic_score is not None else None,
+                    "recency_score": round(result.recency_score, 2) if result.recency_score is not None else None,
+                    "credibility_score": round(result.credibility_score, 2) if result.credibility_score is not None else None,
+                    "category_score": round(result.category_score, 2) if result.category_score is not None else None,
+                    "composite_score": round(result.score, 2) if result.score is not None else None
+                },
+
+                # Metadata object
+                metadata=SourceMetadata(
+                    upload_date=result.metadata.get("upload_date") if result.metadata else None,
+                    publication_date=result.metadata.get("publication_date") if result.metadata else None,
+                    credibility_rating=result.metadata.get("credibility_rating") if result.metadata else None,
+                    category=result.metadata.get("category") if result.metadata else None
+                )
+            ))
+        elif result.source_type == "url":
+            url_id = result.metadata.get("url_id") if result.metadata else None
+            url_title = result.metadata.get('url_title', 'Unknown URL') if result.metadata else 'Unknown URL'
+            url = result.metadata.get('url', '') if result.metadata else ''
+
+            # Add any URL that's related to the query as a source
+            sources.append(Source(
+                # Store URL ID in both fields for compatibility
+                url_id=url_id or "",
+                document_id=url_id or "",  # Backward compatibility
+                url_title=url_title,
+                document_name=f"{url_title} ({url})",  # Backward compatibility
+                excerpt=result.text[:300] + "..." if len(result.text) > 300 else result.text,
+                source_type="url",
+
+                # Direct access scores for new UI
+                score=round(result.score, 2) if result.score is not None else None,
+                semantic_score=round(result.semantic_score, 2) if result.semantic_score is not None else None,
+                credibility_score=round(result.credibility_score, 2) if result.credibility_score is not None else None,
+                recency_score=round(result.recency_score, 2) if result.recency_score is not None else None,
+                category_score=round(result.category_score, 2) if result.category_score is not None else None,
+
+                # Legacy ranking info structure for backward compatibility
+                ranking_info={
+                    "semantic_score": round(result.semantic_score, 2) if result.semantic_score is not None else None,
+                    "recency_score": round(result.recency_score, 2) if result.recency_score is not None else None,
+                    "credibility_score": round(result.credibility_score, 2) if result.credibility_score is not None else None,
+                    "category_score": round(result.category_score, 2) if result.category_score is not None else None,
+                    "composite_score": round(result.score, 2) if result.score is not None else None
+                },
+
+                # Metadata object
+                metadata=SourceMetadata(
+                    added_date=result.metadata.get("added_date") if result.metadata else None,
+                    credibility_rating=result.metadata.get("raw_credibility_score") if result.metadata else None,
+                    category=result.metadata.get("category") if result.metadata else None
+                )
+            ))
+    return sources
+
+def build_prompt_context(retrieval: RetrievalContext, max_tokens: int) -> Tuple[str, List[str]]:
+    """Repository context for the prompt, and the ids of the documents in it
+
+    Results are added best first until max_tokens is reached.
+    """
+    blocks = []
+    document_ids = []
+
+    # Check if we have any results
+    if retrieval.results:
+        # Add each result to our context
+        print(f"[DEBUG CHAT] Processing {len(retrieval.results)} search results")
+        for i, result in enumerate(retrieval.results):
+            # Add source information
+            print(f"[DEBUG CHAT] Result {i} source_type: {result.source_type}")
+            if result.source_type == "document":
+                doc_id = result.metadata.get("document_id")
+                doc_name = result.metadata.get("document_name")
+                blocks.append(f"Document Name: {doc_name}\nDocument ID: {doc_id}\nContent:\n{result.text}\n\n")
+                document_ids.append(doc_id)
+            elif result.source_type == "url":
+                url_id = result.metadata.get("url_id")
+                url_title = result.metadata.get("url_title")
+                url = result.metadata.get("url")
+                blocks.append(f"URL ID: {url_id}\nTitle: {url_title}\nURL: {url}\nContent:\n{result.text}\n\n")
+                document_ids.append(None)
+    else:
+        # Fallback if no search results
+        return "No relevant information found in the repository for this query.\n\n", []
+
+    kept, _ = prompt_budget.fit_blocks(blocks, max_tokens)
+    if len(kept) < len(blocks):
+        print(f"[DEBUG CHAT] Context budget of {max_tokens} tokens fits {len(kept)} of {len(blocks)} results")
+    used_document_ids = [doc_id for doc_id in document_ids[:len(kept)] if doc_id is not None]
+    return "".join(kept), used_document_ids
+
+def build_query_metrics(query: str, user_id: str, response_text: str, confidence_level: Optional[str], sources: List[Source], source_types: Dict[str, int], processing_time_ms: int, retrieval_time_ms: Optional[float] = None, token_counts: Optional[Dict[str, int]] = None, relevance_gate: Optional[str] = None, top_semantic_score: Optional[float] = None) -> QueryMetrics:
+    """Create the analytics record for one chat answer"""
+    # Calculate average scores from sources
+    semantic_scores = [s.ranking_info.get("semantic_score") for s in sources if s.ranking_info and s.ranking_info.get("semantic_score") is not None]
+    avg_semantic_score = sum(semantic_scores) / len(semantic_scores) if semantic_scores else None
+
+    credibility_scores = [s.ranking_info.get("credibility_score") for s in sources if s.ranking_info and s.ranking_info.get("credibility_score") is not None]
+    avg_credibility_score = sum(credibility_scores) / len(credibility_scores) if credibility_scores else None
+
+    recency_scores = [s.ranking_info.get("recency_score") for s in sources if s.ranking_info and s.ranking_info.get("recency_score") is not None]
+    avg_recency_score = sum(recency_scores) / len(recency_scores) if recency_scores else None
+
+    # Check for potential hallucinations (simple heuristic: if confidence is low but no sources)
+    hallucination_detected = len(sources) == 0 and confidence_level not in ["INSUFFICIENT DATA", None]
+
+    return QueryMetrics(
+        query=query,
+        timestamp=datetime.now().isoformat(),
+        user_id=user_id,
+        confidence_level=confidence_level,
+        response_length=len(response_text),
+        processing_time_ms=processing_time_ms,
+        retrieval_time_ms=retrieval_time_ms,
+        prompt_tokens=token_counts.get("prompt") if token_counts else None,
+        history_tokens=token_counts.get("history") if token_counts else None,
+        context_tokens=token_counts.get("context") if token_counts else None,
+        relevance_gate=relevance_gate,
+        top_semantic_score=top_semantic_score,
+        num_sources=len(sources),
+        avg_semantic_score=avg_semantic_score,
+        avg_credibility_score=avg_credibility_score,
+        avg_recency_score=avg_recency_score,
+        source_types=source_types,
+        hallucination_detected=hallucination_detected
+    )
+
+def log_chat_metrics(metrics: QueryMetrics, user: AuthorizedUser) -> None:
+    """Log metrics asynchronously (don't wait for it to complete)"""
     try:
-        # Get API key from secrets
-        api_key = db.secrets.get("OPENAI_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
-
-        # Initialize OpenAI client
-        client = OpenAI(api_key=api_key)
-
-        # Use RAG search to find relevant content based on the user's query
-        context = "Context information from repository:\n\n"
-        used_document_ids = []
-
-        try:
-            # Debug log user ID
-            print(f"[DEBUG CHAT] User ID: {user.sub}")
-
-            # Prepare search request
-            search_request = SearchRequest(
-                query=request.message,
-                top_k=5  # Get top 5 most relevant chunks
-            )
-            print(f"[DEBUG CHAT] Search request: {search_request}")
-
-            # Search for relevant content
-            print(f"[DEBUG CHAT] Calling search function...")
-            search_response = await search(search_request, user)
-            print(f"[DEBUG CHAT] Search response received with {len(search_response.results)} results")
-
-            # Check if we have any results
-            if search_response and search_response.results:
-                print(f"[DEBUG CHAT] Search response has {len(search_response.results)} results")
-                # Add each result to our context
-                print(f"[DEBUG CHAT] Processing {len(search_response.results)} search results")
-                for i, result in enumerate(search_response.results or []):
-                    # Add source information
-                    print(f"[DEBUG CHAT] Result {i} source_type: {result.source_type}")
-                    if result.source_type == "document":
-                        doc_id = result.metadata.get("document_id")
-                        doc_name = result.metadata.get("document_name")
-                        context += f"Document Name: {doc_name}\nDocument ID: {doc_id}\nContent:\n{result.text}\n\n"
-                        used_document_ids.append(doc_id)
-                    elif result.source_type == "url":
-                        url_id = result.metadata.get("url_id")
-                        url_title = result.metadata.get("url_title")
-                        url = result.metadata.get("url")
-                        context += f"URL ID: {url_id}\nTitle: {url_title}\nURL: {url}\nContent:\n{result.text}\n\n"
-            else:
-                # Fallback if no search results
-                context += "No relevant information found in the repository for this query.\n\n"
-        except Exception as e:
-            print(f"[DEBUG CHAT] Error in RAG search: {str(e)}")
-            import traceback
-            print(f"[DEBUG CHAT] Traceback: {traceback.format_exc()}")
-            # Fallback message if search fails
-            context += "Unable to search the repository due to an error.\n\n"
-
-        # Prepare conversation history for OpenAI
-        openai_messages = []
-
-        # Add system prompt
-        system_prompt = """
+        from app.apis.analytics import log_query
+        asyncio.create_task(log_query(metrics, user))
+    except Exception as e:
+        print(f"Error logging chat metrics: {str(e)}")
+
+def reuse_chat_response(response: ChatResponse, answered_query: str, query: str, user: AuthorizedUser, start_time: float) -> ChatResponse:
+    """Adapt a response produced for another copy of the question, logging metrics for this one"""
+    # The structured answer repeats the question it was asked with
+    response.message = response.message.replace(f"### Query\n\n{answered_query}\n", f"### Query\n\n{query}\n", 1)
+
+    source_types = {}
+    for source in response.sources:
+        if source.source_type:
+            source_types[source.source_type] = source_types.get(source.source_type, 0) + 1
+
+    log_chat_metrics(build_query_metrics(
+        query,
+        user.sub,
+        response.message,
+        response.confidence_level,
+        response.sources,
+        source_types,
+        int((time.time() - start_time) * 1000)
+    ), user)
+    return response
+
+def cached_chat_response(cached: Dict[str, Any], query: str, user: AuthorizedUser, start_time: float) -> ChatResponse:
+    """Answer a near-duplicate question from the semantic answer cache"""
+    response = ChatResponse(**cached["response"])
+    response.cache_hit = True
+    return reuse_chat_response(response, cached["query"], query, user, start_time)
+
+# System prompt for every chat completion
+SYSTEM_PROMPT = """
         You are an AI assistant for healthcare professionals called MediVault AI. Your role is to provide accurate, evidence-based responses to medical questions using only the provided context information from the organization's document repository. 
 
         IMPORTANT GUIDELINES FOR AUTHORITATIVE RESPONSES:
@@ -173,343 +324,373 @@ async def chat(request: ChatRequest, user: AuthorizedUser, fastapi_request: Requ
         While I found some general information about the topic [Document: Healthcare Procedures Overview], there are no detailed protocols for implementation in your repository. I recommend consulting your organization's official protocols or speaking with a specialist."
         """
 
-        # Add system message
-        openai_messages.append({"role": "system", "content": system_prompt})
+# Answer used when the relevance gate skips the completion
+INSUFFICIENT_DATA_ANSWER = """[INSUFFICIENT DATA] Your document repository doesn't contain information relevant to this question.
+
+No indexed document or URL matched it closely enough to support an answer. Try rephrasing the question, or add resources on this topic to the knowledge base."""
+
+# Wrap a formatted completion in the structured sections shown to the user
+def format_structured_response(formatter: ResponseFormatter, query: str) -> str:
+    confidence_level = formatter.confidence_level or "INSUFFICIENT DATA"
+    formatted_content = formatter.text
+
+    # No need to build source references in the response text as they will be displayed separately in the UI
+    # This prevents duplication of sources
+
+    # Map confidence level to RAG rating
+    rag_rating_map = {
+        "HIGH CONFIDENCE": "Green",
+        "MODERATE CONFIDENCE": "Amber",
+        "LOW CONFIDENCE": "Red",
+        "INSUFFICIENT DATA": "Red"
+    }
+
+    rag_rating = rag_rating_map.get(confidence_level, "Red")
+
+    # Generate explanation based on confidence level
+    explanation = ""
+    if rag_rating == "Green":
+        explanation = "This response is based on high-quality source material that directly addresses your query with reliable information."
+    elif rag_rating == "Amber":
+        explanation = "This response is based on related sources, but may not fully address all aspects of your query or may come from less authoritative sources."
+    elif rag_rating == "Red":
+        explanation = "This response has limited or no supporting evidence in the knowledge base. Consider consulting additional sources or refining your query."
+
+    # Determine if next steps are needed
+    next_steps = ""
+    if rag_rating != "Green":
+        next_steps = "\n\n### Actionable Next Steps\n\n"
+        if rag_rating == "Red":
+            next_steps += "- Consider consulting a healthcare professional for more specific information\n"
+            next_steps += "- Your organization may want to add more resources on this topic to the knowledge base\n"
+            next_steps += "- Try rephrasing your query to be more specific\n"
+        elif rag_rating == "Amber":
+            next_steps += "- Review the provided sources for partial information\n"
+            next_steps += "- Consider consulting additional clinical resources for complete information\n"
+
+    # Construct the final structured response
+    structured_response = f"""### Query
 
-        # Add conversation history
-        if request.conversation_history is not None:
-            for msg in request.conversation_history:
-                openai_messages.append({"role": msg.role, "content": msg.content})
+{query}
 
-        # Prepare the user message with context
-        user_message = f"""I need information about: {request.message}
+### Response
 
-        {context}
-        """
+{formatted_content}
 
-        # Add the current message to the conversation
-        openai_messages.append({"role": "user", "content": user_message})
+### RAG Confidence Rating: {rag_rating}
 
-        # Call OpenAI API
-        print(f"[DEBUG CHAT] Calling OpenAI API with {len(openai_messages)} messages")
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=openai_messages,
-            max_tokens=1500,
-            temperature=0.0
-        )
+{explanation}{next_steps}"""
 
-        # Extract response text
-        response_text = response.choices[0].message.content
-        print(f"[DEBUG CHAT] Got response from OpenAI: {response_text[:100]}...")
-
-        # Process the response into structured format with sections
-        def format_structured_response(text, query, sources):
-            # Remove extra newlines at the beginning
-            text = text.strip()
-
-            # Extract confidence level if present
-            confidence_level = "INSUFFICIENT DATA"
-            confidence_patterns = {
-                '[HIGH CONFIDENCE]': "Green", 
-                '[MODERATE CONFIDENCE]': "Amber", 
-                '[LOW CONFIDENCE]': "Red", 
-                '[INSUFFICIENT DATA]': "Red"
-            }
-
-            for pattern, rating in confidence_patterns.items():
-                if pattern in text[:100]:
-                    confidence_level = pattern.strip('[]')
-                    text = text.replace(pattern, "", 1).strip()
-                    break
-
-            # Format text for better readability
-            formatted_content = ""
-            lines = text.split('\n')
-
-            # Ultra-simple formatting that maintains bullet point structure
-            formatted_text = ""
-            
-            # First pass: combine lines into paragraphs but keep bullet points separate
-            current_paragraph = []
-            in_bullet_list = False
-            
-            for line in lines:
-                line = line.strip()
-                is_bullet = bool(re.match(r'^\s*[\*\-]\s+', line))
-                
-                # Handle bullet point transitions
-                if is_bullet:
-                    # If we were building a paragraph, finish it
-                    if current_paragraph:
-                        formatted_text += " ".join(current_paragraph) + "\n\n"
-                        current_paragraph = []
-                    
-                    # Add the bullet point
-                    if not in_bullet_list and formatted_text and not formatted_text.endswith("\n\n"):
-                        formatted_text += "\n"
-                    formatted_text += line + "\n"
-                    in_bullet_list = True
-                # Handle regular text
-                elif line:
-                    # If we're transitioning out of a bullet list
-                    if in_bullet_list:
-                        in_bullet_list = False
-                        if not formatted_text.endswith("\n\n"):
-                            formatted_text += "\n"
-                    
-                    # Add to current paragraph
-                    current_paragraph.append(line)
-                # Handle empty lines
-                elif current_paragraph:
-                    # Finish the current paragraph
-                    formatted_text += " ".join(current_paragraph) + "\n\n"
-                    current_paragraph = []
-            
-            # Add any final paragraph
-            if current_paragraph:
-                formatted_text += " ".join(current_paragraph)
-            
-            # Convert back to lines for final formatting
-            formatted_lines = formatted_text.split("\n")
-            previous_empty = False
-            for line in formatted_lines:
-                if not line:
-                    if not previous_empty:
-                        formatted_content += "\n\n"
-                        previous_empty = True
-                else:
-                    formatted_content += line + "\n\n"
-                    previous_empty = False
-
-            formatted_content = formatted_content.strip()
-
-            # No need to build source references in the response text as they will be displayed separately in the UI
-            # This prevents duplication of sources
-
-            # Map confidence level to RAG rating
-            rag_rating_map = {
-                "HIGH CONFIDENCE": "Green",
-                "MODERATE CONFIDENCE": "Amber",
-                "LOW CONFIDENCE": "Red",
-                "INSUFFICIENT DATA": "Red"
-            }
-
-            rag_rating = rag_rating_map.get(confidence_level, "Red")
-
-            # Generate explanation based on confidence level
-            explanation = ""
-            if rag_rating == "Green":
-                explanation = "This response is based on high-quality source material that directly addresses your query with reliable information."
-            elif rag_rating == "Amber":
-                explanation = "This response is based on related sources, but may not fully address all aspects of your query or may come from less authoritative sources."
-            elif rag_rating == "Red":
-                explanation = "This response has limited or no supporting evidence in the knowledge base. Consider consulting additional sources or refining your query."
-
-            # Determine if next steps are needed
-            next_steps = ""
-            if rag_rating != "Green":
-                next_steps = "\n\n### Actionable Next Steps\n\n"
-                if rag_rating == "Red":
-                    next_steps += "- Consider consulting a healthcare professional for more specific information\n"
-                    next_steps += "- Your organization may want to add more resources on this topic to the knowledge base\n"
-                    next_steps += "- Try rephrasing your query to be more specific\n"
-                elif rag_rating == "Amber":
-                    next_steps += "- Review the provided sources for partial information\n"
-                    next_steps += "- Consider consulting additional clinical resources for complete information\n"
-
-            # Construct the final structured response
-            structured_response = f"""### Query
+    return structured_response
 
-{query}
+async def load_chat_session(request: ChatRequest, user: AuthorizedUser) -> Optional[Dict[str, Any]]:
+    """The request's server-side session, or None when the client sends its own history"""
+    if not request.session_id:
+        return None
+    try:
+        return await chat_sessions.get(user.sub, request.session_id)
+    except chat_sessions.SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+async def record_session_turn(session: Optional[Dict[str, Any]], user: AuthorizedUser, question: str, answer: str, api_key: str) -> Optional[Dict[str, Any]]:
+    """Add a question and answer to the session, folding old turns into its summary in the background
+
+    Returns the updated session, or None if there is no session or it could
+    not be updated.
+    """
+    if session is None:
+        return None
+    try:
+        session = await chat_sessions.append_turn(user.sub, session["id"], question, answer)
+        chat_sessions.schedule_summary(user.sub, session, api_key)
+        return session
+    except Exception as e:
+        print(f"[DEBUG CHAT] Error recording session turn: {str(e)}")
+        return None
+
+def is_first_question(request: ChatRequest, session: Optional[Dict[str, Any]] = None) -> bool:
+    """Whether the message starts a conversation, with no history sent or stored"""
+    if session is not None:
+        return not chat_sessions.has_history(session)
+    return not request.conversation_history
+
+async def check_answer_cache(request: ChatRequest, user: AuthorizedUser, start_time: float, session: Optional[Dict[str, Any]] = None) -> Tuple[Optional[ChatResponse], Optional[str], Optional[List[float]]]:
+    """Answer near-duplicate first questions from the semantic answer cache
+
+    Returns the cached response and its raw completion text (or None, None)
+    and the query embedding, which is only computed for first questions and
+    is needed to cache their answer.
+    """
+    if not is_first_question(request, session):
+        return None, None, None
+
+    query_embedding = None
+    cached = None
+    try:
+        query_embedding = await embed_query(request.message)
+        cached = await answer_cache.lookup(search_user_id(user.sub), query_embedding)
+    except Exception as e:
+        print(f"[DEBUG CHAT] Error checking answer cache: {str(e)}")
+    if cached is None:
+        return None, None, query_embedding
 
-### Response
+    print(f"[DEBUG CHAT] Answer cache hit ({cached['similarity']:.3f}) for earlier query: {cached['query']}")
+    return cached_chat_response(cached, request.message, user, start_time), cached["answer"], query_embedding
 
-{formatted_content}
+def earlier_questions(request: ChatRequest, session: Optional[Dict[str, Any]] = None) -> List[str]:
+    """The conversation's previous questions still held verbatim, oldest first"""
+    if session is not None:
+        _, messages = chat_sessions.history(session)
+        return [message["content"] for message in messages if message["role"] == "user"]
+    return [message.content for message in request.conversation_history or [] if message.role == "user"]
 
-### RAG Confidence Rating: {rag_rating}
+async def retrieve_chat_context(request: ChatRequest, user: AuthorizedUser, session: Optional[Dict[str, Any]] = None) -> Tuple[RetrievalContext, bool]:
+    """Use RAG search to find relevant content based on the user's query
 
-{explanation}{next_steps}"""
+    Returns the retrieval and whether the search failed.
+    """
+    retrieval = RetrievalContext(query=request.message, user_id=search_user_id(user.sub))
 
-            return structured_response
+    try:
+        # Debug log user ID
+        print(f"[DEBUG CHAT] User ID: {user.sub}")
 
-        # Extract document and URL citations in format [Document: XXX] and [URL: XXX]
-        doc_name_citations = re.findall(r'\[Document: ([^\]]+)\]', response_text)
-        url_citations = re.findall(r'\[URL: ([^\]]+)\]', response_text)
-        
-        # Legacy format for backward compatibility
-        doc_id_citations = re.findall(r'\[Document ID: ([^\]]+)\]', response_text)
-        
-        print(f"[DEBUG CHAT] Found citations: doc_names={doc_name_citations}, urls={url_citations}, doc_ids={doc_id_citations}")
-        print(f"[DEBUG CHAT] Used document IDs: {used_document_ids}")
-        
-        # Initialize sources list
-        sources = []
-        
-        # Get the search results to use as sources
+        # Retrieve once; the prompt, sources and metrics all use these results
+        search_request = SearchRequest(
+            query=request.message,
+            top_k=5,  # Get top 5 most relevant chunks
+            multi_query=request.multi_query,
+            earlier_questions=earlier_questions(request, session) if request.multi_query else None
+        )
+        print(f"[DEBUG CHAT] Search request: {search_request}")
+        retrieval = await retrieve(search_request, user.sub)
+        print(f"[DEBUG CHAT] Retrieved {len(retrieval.results)} results in {retrieval.timings.get('total_ms')} ms")
+        return retrieval, False
+    except Exception as e:
+        print(f"[DEBUG CHAT] Error in RAG search: {str(e)}")
+        import traceback
+        print(f"[DEBUG CHAT] Traceback: {traceback.format_exc()}")
+        return retrieval, True
+
+def top_semantic_score(retrieval: RetrievalContext) -> Optional[float]:
+    return max((result.semantic_score for result in retrieval.results), default=None)
+
+def relevance_gate(request: ChatRequest, retrieval: RetrievalContext, search_failed: bool, session: Optional[Dict[str, Any]] = None) -> str:
+    """How to answer, given how relevant the retrieved results are
+
+    "skip" answers with INSUFFICIENT_DATA_ANSWER without a completion, "cheap"
+    uses RELEVANCE_GATE_CHEAP_MODEL and "full" the regular model. Follow-up
+    questions always get "full", since the conversation may hold the answer
+    even when retrieval does not, and so do failed searches.
+    """
+    if not is_first_question(request, session) or search_failed:
+        return "full"
+    score = top_semantic_score(retrieval)
+    if score is None or score < RELEVANCE_GATE_MIN_SCORE:
+        return "skip"
+    if score < RELEVANCE_GATE_FULL_SCORE:
+        return "cheap"
+    return "full"
+
+def build_chat_prompt(request: ChatRequest, retrieval: RetrievalContext, search_failed: bool = False, session: Optional[Dict[str, Any]] = None) -> ChatPrompt:
+    """Prepare the OpenAI messages within the prompt token budgets
+
+    The system prompt and the question are always sent. History keeps its most
+    recent messages and context its best results, each within its budget and
+    the room left in the context window after the answer is reserved. For a
+    session, history is its rolling summary, which goes first, and its recent
+    turns. token_counts reports the tokens used for "system", "history",
+    "context" and the whole "prompt". When the relevance gate skips the
+    completion, the prompt has no messages.
+    """
+    gate = relevance_gate(request, retrieval, search_failed, session)
+    print(f"[DEBUG CHAT] Relevance gate: {gate} (top semantic score {top_semantic_score(retrieval)})")
+    if gate == "skip":
+        return ChatPrompt(messages=[], relevance_gate=gate)
+
+    system_message = {"role": "system", "content": SYSTEM_PROMPT}
+
+    def user_message(context: str) -> Dict[str, str]:
+        return {"role": "user", "content": f"""I need information about: {request.message}
+
+        {context}
+        """}
+
+    header = "Context information from repository:\n\n"
+    system_tokens = prompt_budget.message_tokens(system_message)
+    available = (
+        prompt_budget.CONTEXT_WINDOW_TOKENS
+        - prompt_budget.ANSWER_TOKENS
+        - prompt_budget.REPLY_OVERHEAD_TOKENS
+        - system_tokens
+        - prompt_budget.message_tokens(user_message(header))
+    )
+
+    # Add conversation history, most recent first
+    if session is not None:
+        summary, turns = chat_sessions.history(session)
+    else:
+        summary, turns = "", [{"role": msg.role, "content": msg.content} for msg in request.conversation_history or []]
+    history_budget = max(0, min(prompt_budget.HISTORY_TOKENS, available))
+    history, history_tokens = [], 0
+    if summary:
+        history, history_tokens = prompt_budget.fit_messages(
+            [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}], history_budget
+        )
+    recent, recent_tokens = prompt_budget.fit_messages(turns, history_budget - history_tokens)
+    history += recent
+    history_tokens += recent_tokens
+    if len(recent) < len(turns):
+        print(f"[DEBUG CHAT] History budget fits {len(recent)} of {len(turns)} messages")
+
+    used_document_ids = []
+    if search_failed:
+        # Fallback message if search fails
+        context = header + "Unable to search the repository due to an error.\n\n"
+    else:
+        context_budget = max(0, min(prompt_budget.CONTEXT_TOKENS, available - history_tokens))
+        retrieved_context, used_document_ids = build_prompt_context(retrieval, context_budget)
+        context = header + retrieved_context
+
+    final_message = user_message(context)
+    messages = [system_message, *history, final_message]
+    token_counts = {
+        "system": system_tokens,
+        "history": history_tokens,
+        "context": prompt_budget.count_tokens(context),
+        "prompt": system_tokens + history_tokens + prompt_budget.message_tokens(final_message) + prompt_budget.REPLY_OVERHEAD_TOKENS,
+    }
+    print(f"[DEBUG CHAT] Prompt tokens: {token_counts}")
+    return ChatPrompt(
+        messages=messages,
+        used_document_ids=used_document_ids,
+        token_counts=token_counts,
+        model=RELEVANCE_GATE_CHEAP_MODEL if gate == "cheap" else CHAT_MODEL,
+        relevance_gate=gate
+    )
+
+def format_completion(response_text: str) -> ResponseFormatter:
+    """Format a complete (non-streamed) completion"""
+    formatter = ResponseFormatter()
+    formatter.feed(response_text)
+    formatter.close()
+    return formatter
+
+async def finalize_chat_response(request: ChatRequest, user: AuthorizedUser, answer_text: str, formatter: ResponseFormatter, retrieval: RetrievalContext, prompt: ChatPrompt, start_time: float, query_embedding: Optional[List[float]] = None) -> ChatResponse:
+    """Turn the formatted completion into the structured ChatResponse, logging metrics
+
+    formatter must have consumed the whole completion, answer_text, and
+    been closed.
+    """
+    used_document_ids = prompt.used_document_ids
+
+    # Document and URL citations in format [Document: XXX] and [URL: XXX], and the legacy [Document ID: XXX]
+    print(f"[DEBUG CHAT] Found citations: doc_names={formatter.document_citations}, urls={formatter.url_citations}, doc_ids={formatter.document_id_citations}")
+    print(f"[DEBUG CHAT] Used document IDs: {used_document_ids}")
+    
+    # Include ALL retrieved results as sources if we have citations
+    # This is important because we want to show all sources that contributed to the answer
+    sources = []
+    if formatter.has_citations or used_document_ids:
         try:
-            # Search again with the same query to get the same results
-            # We do this to avoid passing too much data between functions
-            search_request = SearchRequest(
-                query=request.message,
-                top_k=5
-            )
-            
-            search_response = await search(search_request, user)
-            print(f"[DEBUG CHAT] Got {len(search_response.results or [])} search results for source extraction")
-            
-            # Include ALL relevant search results as sources if we have citations
-            # This is important because we want to show all sources that contributed to the answer
-            if doc_name_citations or url_citations or doc_id_citations or used_document_ids:
-                for result in search_response.results or []:
-                    if result.source_type == "document":
-                        doc_id = result.metadata.get("document_id") if result.metadata else None
-                        doc_name = result.metadata.get("document_name", "Unknown Document") if result.metadata else "Unknown Document"
-                        
-                        # Add any document that's related to the query as a source
-                        sources.append(Source(
-                            document_id=doc_id or "",
-                            document_name=doc_name,
-                            excerpt=result.text[:300] + "..." if len(result.text) > 300 else result.text,
-                            source_type="document",
-                            
-                            # Direct access scores for new UI
-                            score=round(result.score, 2) if result.score is not None else None,
-                            semantic_score=round(result.semantic_score, 2) if result.semantic_score is not None else None,
-                            credibility_score=round(result.credibility_score, 2) if result.credibility_score is not None else None,
-                            recency_score=round(result.recency_score, 2) if result.recency_score is not None else None,
-                            category_score=round(result.category_score, 2) if result.category_score is not None else None,
-                            
-                            # Legacy ranking info structure for backward compatibility
-                            ranking_info={
-                                "semantic_score": round(result.semantic_score, 2) if result.semantic_score is not None else None,
-                                "recency_score": round(result.recency_score, 2) if result.recency_score is not None else None,
-                                "credibility_score": round(result.credibility_score, 2) if result.credibility_score is not None else None,
-                                "category_score": round(result.category_score, 2) if result.category_score is not None else None,
-                                "composite_score": round(result.score, 2) if result.score is not None else None
-                            },
-                            
-                            # Metadata object
-                            metadata=SourceMetadata(
-                                upload_date=result.metadata.get("upload_date") if result.metadata else None,
-                                publication_date=result.metadata.get("publication_date") if result.metadata else None,
-                                credibility_rating=result.metadata.get("credibility_rating") if result.metadata else None,
-                                category=result.metadata.get("category") if result.metadata else None
-                            )
-                        ))
-                    elif result.source_type == "url":
-                        url_id = result.metadata.get("url_id") if result.metadata else None
-                        url_title = result.metadata.get('url_title', 'Unknown URL') if result.metadata else 'Unknown URL'
-                        url = result.metadata.get('url', '') if result.metadata else ''
-                        
-                        # Add any URL that's related to the query as a source
-                        sources.append(Source(
-                            # Store URL ID in both fields for compatibility
-                            url_id=url_id or "",
-                            document_id=url_id or "",  # Backward compatibility
-                            url_title=url_title,
-                            document_name=f"{url_title} ({url})",  # Backward compatibility
-                            excerpt=result.text[:300] + "..." if len(result.text) > 300 else result.text,
-                            source_type="url",
-                            
-                            # Direct access scores for new UI
-                            score=round(result.score, 2) if result.score is not None else None,
-                            semantic_score=round(result.semantic_score, 2) if result.semantic_score is not None else None,
-                            credibility_score=round(result.credibility_score, 2) if result.credibility_score is not None else None,
-                            recency_score=round(result.recency_score, 2) if result.recency_score is not None else None,
-                            category_score=round(result.category_score, 2) if result.category_score is not None else None,
-                            
-                            # Legacy ranking info structure for backward compatibility
-                            ranking_info={
-                                "semantic_score": round(result.semantic_score, 2) if result.semantic_score is not None else None,
-                                "recency_score": round(result.recency_score, 2) if result.recency_score is not None else None,
-                                "credibility_score": round(result.credibility_score, 2) if result.credibility_score is not None else None,
-                                "category_score": round(result.category_score, 2) if result.category_score is not None else None,
-                                "composite_score": round(result.score, 2) if result.score is not None else None
-                            },
-                            
-                            # Metadata object
-                            metadata=SourceMetadata(
-                                added_date=result.metadata.get("added_date") if result.metadata else None,
-                                credibility_rating=result.metadata.get("raw_credibility_score") if result.metadata else None,
-                                category=result.metadata.get("category") if result.metadata else None
-                            )
-                        ))
-            
+            sources = build_sources(retrieval.results)
             print(f"[DEBUG CHAT] Created {len(sources)} source objects")
-
         except Exception as e:
             print(f"Error creating source references: {str(e)}")
-            
-        # Apply structured formatting
-        response_text = format_structured_response(response_text, request.message, sources)
-
-        # Extract confidence level from response
-        confidence_level = None
-        confidence_patterns = [
-            r'\[(HIGH CONFIDENCE)\]',
-            r'\[(MODERATE CONFIDENCE)\]',
-            r'\[(LOW CONFIDENCE)\]',
-            r'\[(INSUFFICIENT DATA)\]'
-        ]
-
-        for pattern in confidence_patterns:
-            match = re.search(pattern, response_text)
-            if match:
-                confidence_level = match.group(1)
-                break
-
-        # Calculate query metrics for analytics
-        processing_time_ms = int((time.time() - start_time) * 1000)
-
-        # Calculate average scores from sources
-        semantic_scores = [s.ranking_info.get("semantic_score") for s in sources if s.ranking_info and s.ranking_info.get("semantic_score") is not None]
-        avg_semantic_score = sum(semantic_scores) / len(semantic_scores) if semantic_scores else None
-
-        credibility_scores = [s.ranking_info.get("credibility_score") for s in sources if s.ranking_info and s.ranking_info.get("credibility_score") is not None]
-        avg_credibility_score = sum(credibility_scores) / len(credibility_scores) if credibility_scores else None
-
-        recency_scores = [s.ranking_info.get("recency_score") for s in sources if s.ranking_info and s.ranking_info.get("recency_score") is not None]
-        avg_recency_score = sum(recency_scores) / len(recency_scores) if recency_scores else None
-
-        # Count source types
-        source_types = {}
-        for result in search_response.results or []:
-            if result.source_type:
-                source_types[result.source_type] = source_types.get(result.source_type, 0) + 1
-
-        # Check for potential hallucinations (simple heuristic: if confidence is low but no sources)
-        hallucination_detected = len(sources) == 0 and confidence_level not in ["INSUFFICIENT DATA", None]
-
-        # Create metrics object
-        metrics = QueryMetrics(
-            query=request.message,
-            timestamp=datetime.now().isoformat(),
-            user_id=user.sub,
-            confidence_level=confidence_level,
-            response_length=len(response_text),
-            processing_time_ms=processing_time_ms,
-            num_sources=len(sources),
-            avg_semantic_score=avg_semantic_score,
-            avg_credibility_score=avg_credibility_score,
-            avg_recency_score=avg_recency_score,
-            source_types=source_types,
-            hallucination_detected=hallucination_detected
-        )
-
-        # Log metrics asynchronously (don't wait for it to complete)
+        
+    # Apply structured formatting
+    response_text = format_structured_response(formatter, request.message)
+    confidence_level = formatter.confidence_level
+
+    # Calculate query metrics for analytics
+    processing_time_ms = int((time.time() - start_time) * 1000)
+
+    # Create and log metrics object
+    log_chat_metrics(build_query_metrics(
+        request.message,
+        user.sub,
+        response_text,
+        confidence_level,
+        sources,
+        retrieval.source_types(),
+        processing_time_ms,
+        retrieval.timings.get("total_ms"),
+        prompt.token_counts,
+        prompt.relevance_gate,
+        top_semantic_score(retrieval)
+    ), user)
+
+    response = ChatResponse(
+        message=response_text,
+        confidence_level=confidence_level,
+        sources=sources
+    )
+
+    # Remember first-question answers grounded on repository sources; a skipped
+    # question may become answerable as soon as a relevant document is added
+    if query_embedding is not None and prompt.relevance_gate != "skip":
         try:
-            from app.apis.analytics import log_query
-            asyncio.create_task(log_query(metrics, user))
+            await answer_cache.store(retrieval.user_id, request.message, query_embedding, response.dict(), answer_text, retrieval.source_generations)
         except Exception as e:
-            print(f"Error logging chat metrics: {str(e)}")
+            print(f"[DEBUG CHAT] Error caching answer: {str(e)}")
 
-        response = ChatResponse(
-            message=response_text,
-            confidence_level=confidence_level,
-            sources=sources
-        )
+    return response
+
+@router.post("/chat")
+async def chat(request: ChatRequest, user: AuthorizedUser, fastapi_request: Request):
+    start_time = time.time()
+    session = await load_chat_session(request, user)
+    try:
+        # Get API key from secrets
+        api_key = db.secrets.get("OPENAI_API_KEY")
+        if not api_key:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+
+        cached, cached_text, query_embedding = await check_answer_cache(request, user, start_time, session)
+        if cached is not None:
+            await record_session_turn(session, user, request.message, cached_text, api_key)
+            cached.session_id = request.session_id
+            return cached
+
+        async def answer() -> Tuple[ChatResponse, str, str]:
+            """The response, the raw completion and the question as asked"""
+            retrieval, search_failed = await retrieve_chat_context(request, user, session)
+            prompt = build_chat_prompt(request, retrieval, search_failed, session)
 
+            if prompt.relevance_gate == "skip":
+                response_text = INSUFFICIENT_DATA_ANSWER
+            else:
+                # Call OpenAI API
+                print(f"[DEBUG CHAT] Calling OpenAI API ({prompt.model}) with {len(prompt.messages)} messages")
+                completion = await llm_client.chat_completion(
+                    api_key,
+                    model=prompt.model,
+                    messages=prompt.messages,
+                    max_tokens=prompt_budget.ANSWER_TOKENS,
+                    temperature=0.0
+                )
+
+                # Extract response text
+                response_text = completion.choices[0].message.content
+                print(f"[DEBUG CHAT] Got response from OpenAI: {response_text[:100]}...")
+
+            response = await finalize_chat_response(
+                request, user, response_text, format_completion(response_text), retrieval, prompt, start_time, query_embedding
+            )
+            return response, response_text, request.message
+
+        if is_first_question(request, session):
+            # Identical first questions already in flight share one retrieval and completion
+            key = (search_user_id(user.sub), "chat", search_cache.normalize_query(request.message), request.multi_query)
+            (response, response_text, answered_query), shared = await single_flight.run(key, answer)
+            if shared:
+                print("[DEBUG CHAT] Joined an identical question already in flight")
+                response = reuse_chat_response(response, answered_query, request.message, user, start_time)
+        else:
+            response, response_text, _ = await answer()
+
+        await record_session_turn(session, user, request.message, response_text, api_key)
+        response.session_id = request.session_id
         return response
 
     except Exception as e:
@@ -519,8 +700,193 @@ async def chat(request: ChatRequest, user: AuthorizedUser, fastapi_request: Requ
         print(f"Traceback: {traceback.format_exc()}")
         # Print request details for debugging
         print(f"Request message: {request.message}")
-        if request.conversation_history is not None:
+        if request.session_id:
+            print(f"Request session: {request.session_id}")
+        elif request.conversation_history is not None:
             print(f"Request history length: {len(request.conversation_history)}")
         else:
             print("Request history is None")
         raise HTTPException(status_code=500, detail=error_msg)
+
+async def chat_events(request: ChatRequest, user: AuthorizedUser, api_key: str, start_time: float, session: Optional[Dict[str, Any]] = None, is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> AsyncIterator[Tuple[str, Any]]:
+    """Answer one chat message as a sequence of (event, data) pairs
+
+    Events, in order:
+    - sources: the retrieved sources, sent before generation starts
+    - token: {"content": ...} for each piece of the completion as it arrives
+    - formatted: {"content": ...} for each piece of the normalized Markdown
+      answer, as soon as it is final; together they make up the Response
+      section of the done message
+    - done: the final ChatResponse, with the structured message, confidence
+      level and cited sources exactly as /chat returns them
+    - error: {"detail": ...} if the answer could not be completed
+
+    If is_disconnected() turns true, or the caller stops iterating, the
+    upstream completion is aborted. session, if given, is updated in place
+    with the new turn.
+    """
+    try:
+        cached, cached_text, query_embedding = await check_answer_cache(request, user, start_time, session)
+        if cached is not None:
+            updated = await record_session_turn(session, user, request.message, cached_text, api_key)
+            if updated is not None:
+                session.update(updated)
+            cached.session_id = request.session_id
+            yield "sources", [source.dict() for source in cached.sources]
+            yield "done", cached.dict()
+            return
+
+        retrieval, search_failed = await retrieve_chat_context(request, user, session)
+        prompt = build_chat_prompt(request, retrieval, search_failed, session)
+        if prompt.relevance_gate == "skip":
+            # No completion to stream; the answer is not grounded on any source
+            yield "sources", []
+            yield "token", {"content": INSUFFICIENT_DATA_ANSWER}
+            response_text = INSUFFICIENT_DATA_ANSWER
+            formatter = format_completion(response_text)
+            yield "formatted", {"content": formatter.text}
+        else:
+            yield "sources", [source.dict() for source in build_sources(retrieval.results)]
+
+            print(f"[DEBUG CHAT] Streaming completion ({prompt.model}) for: {request.message[:100]}")
+            parts = []
+            formatter = ResponseFormatter()
+            # Leaving this block closes the stream, aborting the upstream request if still running
+            async with llm_client.chat_completion_stream(
+                api_key,
+                model=prompt.model,
+                messages=prompt.messages,
+                max_tokens=prompt_budget.ANSWER_TOKENS,
+                temperature=0.0
+            ) as stream:
+                async for chunk in stream:
+                    if is_disconnected is not None and await is_disconnected():
+                        print("[DEBUG CHAT] Client disconnected, aborting completion")
+                        return
+                    content = chunk.choices[0].delta.content if chunk.choices else None
+                    if content:
+                        parts.append(content)
+                        yield "token", {"content": content}
+                        formatted = formatter.feed(content)
+                        if formatted:
+                            yield "formatted", {"content": formatted}
+            response_text = "".join(parts)
+            formatted = formatter.close()
+            if formatted:
+                yield "formatted", {"content": formatted}
+
+        response = await finalize_chat_response(
+            request, user, response_text, formatter, retrieval, prompt, start_time, query_embedding
+        )
+        updated = await record_session_turn(session, user, request.message, response_text, api_key)
+        if updated is not None:
+            session.update(updated)
+        response.session_id = request.session_id
+        yield "done", response.dict()
+    except asyncio.CancelledError:
+        print("[DEBUG CHAT] Chat stream cancelled")
+        raise
+    except Exception as e:
+        error_msg = f"Error in chat stream: {str(e)}"
+        print(error_msg)
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
+        yield "error", {"detail": error_msg}
+
+def sse_event(event: str, data: Any) -> str:
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/chat/stream")
+async def chat_stream(request: ChatRequest, user: AuthorizedUser, fastapi_request: Request):
+    """Stream a chat answer as server-sent events
+
+    The events are those of chat_events: sources, then tokens, then done or
+    error. If the client disconnects, the upstream completion is aborted.
+    """
+    start_time = time.time()
+
+    # Get API key from secrets
+    api_key = db.secrets.get("OPENAI_API_KEY")
+    if not api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    session = await load_chat_session(request, user)
+
+    async def events():
+        async for event, data in chat_events(request, user, api_key, start_time, session, fastapi_request.is_disconnected):
+            yield sse_event(event, data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket, user: AuthorizedUser, session_id: Optional[str] = None):
+    """Chat over one persistent WebSocket connection
+
+    The token is checked once, when the connection opens: send it as the
+    Sec-WebSocket-Protocol "Authorization.Bearer.<token>", alongside a plain
+    protocol such as "chat" for the server to accept. The conversation is a
+    server-side session held in memory for the life of the connection; pass
+    ?session_id= to resume one from /chat/sessions.
+
+    The first message sent is {"event": "session", "data": {"session_id": ...}}.
+    Then send {"message": "..."} for each question; it is answered with the
+    events of chat_events as {"event": ..., "data": ...} messages, ending with
+    done or error. Messages sent while an answer streams are answered in turn.
+    """
+    api_key = db.secrets.get("OPENAI_API_KEY")
+    if not api_key:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="OpenAI API key not configured")
+        return
+
+    try:
+        session = await chat_sessions.get(user.sub, session_id) if session_id else await chat_sessions.create(user.sub)
+    except chat_sessions.SessionNotFoundError:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Chat session not found")
+        return
+
+    # Echo a protocol other than the token, as browsers require one to be chosen
+    protocols = [p.strip() for p in websocket.headers.get("sec-websocket-protocol", "").split(",") if p.strip()]
+    await websocket.accept(subprotocol=next((p for p in protocols if not p.startswith("Authorization.Bearer.")), None))
+    await websocket.send_json({"event": "session", "data": {"session_id": session["id"]}})
+    print(f"[DEBUG CHAT] WebSocket connected for user {user.sub}, session {session['id']}")
+
+    try:
+        while True:
+            try:
+                payload = json.loads(await websocket.receive_text())
+                message = payload["message"]
+                if not isinstance(message, str) or not message.strip():
+                    raise ValueError("message must be a non-empty string")
+            except (ValueError, KeyError, TypeError) as e:
+                await websocket.send_json({"event": "error", "data": {"detail": f"Invalid chat message: {str(e)}"}})
+                continue
+
+            request = ChatRequest(message=message, session_id=session["id"])
+            async with aclosing(chat_events(request, user, api_key, time.time(), session)) as events:
+                async for event, data in events:
+                    await websocket.send_json({"event": event, "data": data})
+    except WebSocketDisconnect:
+        print(f"[DEBUG CHAT] WebSocket disconnected for session {session['id']}")
+
+@router.post("/chat/sessions", response_model=ChatSessionResponse)
+async def create_chat_session(user: AuthorizedUser):
+    """Start a server-side conversation
+
+    Send the returned session_id with each /chat message instead of
+    conversation_history; the server keeps the history and summarizes older
+    turns.
+    """
+    session = await chat_sessions.create(user.sub)
+    return ChatSessionResponse(session_id=session["id"])
+
+@router.delete("/chat/sessions/{session_id}", status_code=204)
+async def delete_chat_session(session_id: str, user: AuthorizedUser):
+    """Delete a server-side conversation"""
+    try:
+        await chat_sessions.delete(user.sub, session_id)
+    except chat_sessions.SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Chat session not found")
@@ -4,6 +4,7 @@ from typing import List, Dict, Any, Optional
 import databutton as db
 from datetime import datetime, timedelta
 from app.auth import AuthorizedUser
+from app.libs.metadata_store import documents_store, urls_store
 import json
 import re
 import httpx
@@ -61,22 +62,12 @@ async def get_content_metrics(user: AuthorizedUser):
             }
         )
         
-        # Get all documents by using storage directly
-        meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-        try:
-            all_docs = db.storage.json.get(meta_key)
-            documents = all_docs.get("documents", [])
-        except FileNotFoundError:
-            documents = []
+        # Get all documents from the metadata store
+        documents, _ = await documents_store.list(user.sub)
         response.document_count = len(documents)
         
-        # Get all URLs by using storage directly
-        meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-        try:
-            all_urls = db.storage.json.get(meta_key)
-            urls = all_urls.get("urls", [])
-        except FileNotFoundError:
-            urls = []
+        # Get all URLs from the metadata store
+        urls, _ = await urls_store.list(user.sub)
         response.url_count = len(urls)
         
         # Process documents
@@ -1,12 +1,13 @@
-from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Query
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Annotated, List, Optional
 import uuid
 import datetime
 import re
 from app.auth import AuthorizedUser
+from app.libs.metadata_store import MAX_PAGE_SIZE, documents_store
+from app.libs import index_cache, storage, vector_index
 import httpx
-import databutton as db
 import mimetypes
 
 router = APIRouter(prefix="/documents")
@@ -56,6 +57,7 @@ class DocumentResponse(BaseModel):
 
 class DocumentsListResponse(BaseModel):
     documents: List[DocumentResponse]
+    total_count: Optional[int] = None
 
 class UpdateDocumentRequest(BaseModel):
     category: Optional[str] = None
@@ -90,7 +92,7 @@ async def upload_document(
     
     # Store file in binary storage
     file_key = sanitize_storage_key(f"documents/{user.sub}/{doc_id}")
-    db.storage.binary.put(file_key, file_content)
+    await storage.binary_put(file_key, file_content)
     
     # Store metadata in JSON storage
     now = datetime.datetime.now().isoformat()
@@ -105,16 +107,8 @@ async def upload_document(
         "indexed": False
     }
     
-    # Get existing metadata or create new list
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        all_docs = {"documents": []}
-    
     # Add new document metadata
-    all_docs["documents"].append(metadata)
-    db.storage.json.put(meta_key, all_docs)
+    await documents_store.create(user.sub, metadata)
     
     # Directly index the document without making HTTP requests
     try:
@@ -131,13 +125,7 @@ async def upload_document(
                 print(f"Error in background indexing for document {doc_id}: {str(e)}")
                 # Update document metadata to show indexing failed
                 try:
-                    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-                    doc_meta = db.storage.json.get(meta_key)
-                    for i, doc in enumerate(doc_meta["documents"]):
-                        if doc["id"] == doc_id:
-                            doc_meta["documents"][i]["indexed"] = None
-                            db.storage.json.put(meta_key, doc_meta)
-                            break
+                    await documents_store.update(user.sub, doc_id, {"indexed": None})
                 except Exception as update_err:
                     print(f"Failed to update document metadata: {str(update_err)}")
         
@@ -150,71 +138,42 @@ async def upload_document(
     return DocumentResponse(**metadata)
 
 @router.get("", response_model=DocumentsListResponse)
-async def list_documents(user: AuthorizedUser, category: Optional[str] = None):
-    """List all documents uploaded by the user"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    
-    try:
-        all_docs = db.storage.json.get(meta_key)
-        
-        # Debug log metadata
-        if all_docs and "documents" in all_docs and len(all_docs["documents"]) > 0:
-            print(f"[DEBUG] Document list - found {len(all_docs['documents'])} documents")
-            for i, doc in enumerate(all_docs["documents"]):
-                indexed_value = doc.get("indexed", "NOT PRESENT")
-                indexed_type = type(indexed_value).__name__ if indexed_value != "NOT PRESENT" else "N/A"
-                print(f"[DEBUG] Document {i}: id={doc.get('id')}, indexed={indexed_value} (type: {indexed_type})")
-    except FileNotFoundError:
-        return DocumentsListResponse(documents=[])
-    
-    # Filter by category if specified
-    if category:
-        filtered_docs = [doc for doc in all_docs["documents"] if doc.get("category") == category]
-        return DocumentsListResponse(documents=filtered_docs)
-    
-    return DocumentsListResponse(documents=all_docs["documents"])
+async def list_documents(user: AuthorizedUser, category: Optional[str] = None, page: Annotated[Optional[int], Query(ge=1)] = None, page_size: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 100):
+    """List documents uploaded by the user, optionally one page at a time"""
+    # Without a page number, return every document as before
+    offset = (page - 1) * page_size if page else 0
+    limit = page_size if page else None
+    
+    documents, total_count = await documents_store.list(
+        user.sub,
+        offset=offset,
+        limit=limit,
+        categories=[category] if category else None
+    )
+    print(f"[DEBUG] Document list - returning {len(documents)} of {total_count} documents")
+    
+    return DocumentsListResponse(documents=documents, total_count=total_count)
 
 @router.get("/{document_id}", response_model=DocumentResponse)
 async def get_document(document_id: str, user: AuthorizedUser):
     """Get a specific document's metadata"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
+    doc = await documents_store.get(user.sub, document_id)
+    if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Find the document
-    for doc in all_docs["documents"]:
-        if doc["id"] == document_id:
-            return DocumentResponse(**doc)
-    
-    raise HTTPException(status_code=404, detail="Document not found")
+    return DocumentResponse(**doc)
 
 @router.get("/{document_id}/content")
 async def get_document_content(document_id: str, user: AuthorizedUser):
     """Get a specific document's content"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Find the document
-    doc_meta = None
-    for doc in all_docs["documents"]:
-        if doc["id"] == document_id:
-            doc_meta = doc
-            break
-    
+    doc_meta = await documents_store.get(user.sub, document_id)
     if not doc_meta:
         raise HTTPException(status_code=404, detail="Document not found")
     
     # Get document content
     file_key = sanitize_storage_key(f"documents/{user.sub}/{document_id}")
     try:
-        content = db.storage.binary.get(file_key)
+        content = await storage.binary_get(file_key)
         from fastapi.responses import Response
         return Response(
             content=content,
@@ -229,44 +188,30 @@ async def get_document_content(document_id: str, user: AuthorizedUser):
 @router.put("/{document_id}", response_model=DocumentResponse)
 async def update_document(document_id: str, data: UpdateDocumentRequest, user: AuthorizedUser):
     """Update a document's metadata"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
+    # Update fields
+    fields = {}
+    if data.category is not None:
+        fields["category"] = data.category
     
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
+    doc = await documents_store.update(user.sub, document_id, fields)
+    if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    # Find and update the document
-    for i, doc in enumerate(all_docs["documents"]):
-        if doc["id"] == document_id:
-            # Update fields
-            if data.category is not None:
-                all_docs["documents"][i]["category"] = data.category
-            
-            # Save updated metadata
-            db.storage.json.put(meta_key, all_docs)
-            return DocumentResponse(**all_docs["documents"][i])
+    # Keep the metadata used for search ranking in step
+    try:
+        index_cache.schedule_refresh(
+            user.sub, await vector_index.update_source_metadata(user.sub, "document", document_id, fields)
+        )
+    except Exception as e:
+        # Log but continue since the metadata is already updated
+        print(f"Error updating document metadata in vector index: {e}")
     
-    raise HTTPException(status_code=404, detail="Document not found")
+    return DocumentResponse(**doc)
 
 @router.delete("/{document_id}", status_code=204)
 async def delete_document(document_id: str, user: AuthorizedUser):
     """Delete a document and its content"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Document not found")
-    
-    # Find the document
-    doc_to_delete = None
-    for i, doc in enumerate(all_docs["documents"]):
-        if doc["id"] == document_id:
-            doc_to_delete = doc
-            all_docs["documents"].pop(i)
-            break
-    
+    doc_to_delete = await documents_store.delete(user.sub, document_id)
     if not doc_to_delete:
         raise HTTPException(status_code=404, detail="Document not found")
     
@@ -275,30 +220,20 @@ async def delete_document(document_id: str, user: AuthorizedUser):
     try:
         # Since db.storage.binary doesn't have a direct delete method,
         # we just overwrite with empty bytes
-        db.storage.binary.put(file_key, b"")
+        await storage.binary_put(file_key, b"")
     except Exception as e:
-        # Log but continue since we still want to delete the metadata
+        # Log but continue since the metadata is already deleted
         print(f"Error deleting document content: {e}")
     
-    # Update metadata
-    db.storage.json.put(meta_key, all_docs)
+    # Drop its chunks from the search index
+    try:
+        index_cache.schedule_refresh(user.sub, await vector_index.remove_source(user.sub, "document", document_id))
+    except Exception as e:
+        print(f"Error removing document from vector index: {e}")
     
     return None
 
 @router.get("/categories/list", response_model=List[str])
 async def list_categories(user: AuthorizedUser):
     """List all categories used by the user"""
-    meta_key = sanitize_storage_key(f"documents_meta/{user.sub}")
-    
-    try:
-        all_docs = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        return []
-    
-    # Extract unique categories
-    categories = set()
-    for doc in all_docs["documents"]:
-        if doc.get("category"):
-            categories.add(doc["category"])
-    
-    return list(categories)
+    return await documents_store.categories(user.sub)
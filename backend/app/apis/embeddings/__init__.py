@@ -1,11 +1,14 @@
 from fastapi import APIRouter, HTTPException, Depends
 from pydantic import BaseModel
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Tuple
 import datetime
+import asyncio
+import os
+import time
+from collections import OrderedDict
 import databutton as db
+from app.libs import storage
 import re
-import uuid
-import json
 import pdfplumber
 import io
 import requests
@@ -14,6 +17,8 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 import numpy as np
 from app.auth import AuthorizedUser
+from app.libs.metadata_store import documents_store, urls_store
+from app.libs import index_cache, multi_query, search_batcher, search_cache, single_flight, storage_cache, vector_index, vector_quantization
 
 # Import document and URL APIs directly
 from app.apis.documents import get_document, get_document_content
@@ -47,6 +52,8 @@ class SearchRequest(BaseModel):
     document_ids: Optional[List[str]] = None
     url_ids: Optional[List[str]] = None
     categories: Optional[List[str]] = None
+    multi_query: bool = False  # Also search rewrites of the query and fuse the rankings
+    earlier_questions: Optional[List[str]] = None  # Previous questions of the conversation, oldest first, for multi_query
 
 class SearchResult(BaseModel):
     id: str
@@ -62,12 +69,48 @@ class SearchResult(BaseModel):
 class SearchResponse(BaseModel):
     results: List[SearchResult]
 
+class BatchSearchRequest(BaseModel):
+    requests: List[SearchRequest]
+
+class BatchSearchResponse(BaseModel):
+    responses: List[SearchResponse]  # In request order
+
+class RetrievalContext(BaseModel):
+    """One retrieval run, shared by everything that builds on its results"""
+    query: str
+    user_id: str  # Owner of the index that was searched
+    generation: int = 0  # Index generation the results were ranked against
+    results: List[SearchResult] = []
+    cache_hit: bool = False
+    coalesced: bool = False  # Ranked by an identical search that was already in flight
+    query_variants: List[str] = []  # Queries whose rankings were fused, in multi-query mode
+    timings: Dict[str, float] = {}  # Milliseconds per retrieval step
+    source_generations: Dict[str, Optional[int]] = {}  # Per-source generation of the result sources in the ranked snapshot
+    
+    def source_keys(self) -> List[str]:
+        """Index keys of the distinct sources behind the results, best first"""
+        keys = []
+        for result in self.results:
+            source_id = result.metadata.get("document_id") if result.source_type == "document" else result.metadata.get("url_id")
+            if source_id:
+                keys.append(vector_index.source_key(result.source_type, source_id))
+        return list(dict.fromkeys(keys))
+    
+    def source_types(self) -> Dict[str, int]:
+        """Number of results per source type"""
+        source_types = {}
+        for result in self.results:
+            if result.source_type:
+                source_types[result.source_type] = source_types.get(result.source_type, 0) + 1
+        return source_types
+
 # Helper functions
-async def extract_text_from_document(user: AuthorizedUser, document_id: str) -> str:
+async def extract_text_from_document(user: AuthorizedUser, document_id: str, doc_response=None) -> str:
     """Extract text from a document based on its content type"""
     try:
-        # Get document metadata
-        doc_response = await get_document(document_id=document_id, user=user)
+        # Get document metadata unless the caller already has it
+        if doc_response is None:
+            doc_response = await get_document(document_id=document_id, user=user)
         
         # Get document content
         content_response = await get_document_content(document_id=document_id, user=user)
@@ -106,11 +149,12 @@ async def extract_text_from_document(user: AuthorizedUser, document_id: str) ->
         print(f"Error extracting text from document {document_id}: {str(e)}")
         return f"Error extracting text: {str(e)}"
 
-async def scrape_url_content(user: AuthorizedUser, url_id: str) -> str:
+async def scrape_url_content(user: AuthorizedUser, url_id: str, url_response=None) -> str:
     """Scrape content from a URL"""
     try:
-        # Get URL metadata
-        url_response = await get_url(url_id=url_id, user=user)
+        # Get URL metadata unless the caller already has it
+        if url_response is None:
+            url_response = await get_url(url_id=url_id, user=user)
         
         # Scrape the URL
         try:
@@ -163,72 +207,78 @@ async def generate_embeddings(chunks: List[str]) -> List[List[float]]:
         # Initialize OpenAI embeddings
         embeddings = OpenAIEmbeddings(openai_api_key=api_key)
         
-        # Generate embeddings
-        return embeddings.embed_documents(chunks)
+        # Generate embeddings without blocking the event loop
+        return await embeddings.aembed_documents(chunks)
     except Exception as e:
         print(f"Error generating embeddings: {str(e)}")
         raise e
 
+# Most searches accepted by one /search/batch request
+SEARCH_BATCH_MAX_REQUESTS = int(os.environ.get("SEARCH_BATCH_MAX_REQUESTS", "256"))
+
+# Recent query embeddings, so a question embedded for the answer cache and
+# then searched costs one embedding call
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+_query_embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+
+async def embed_query(query: str) -> List[float]:
+    """Embedding of a search query, reusing recent identical queries"""
+    embedding = _query_embeddings.get(query)
+    if embedding is None:
+        async def compute():
+            return (await generate_embeddings([query]))[0]
+        
+        # Concurrent misses for the same text share one embedding call
+        embedding, _ = await single_flight.run(("embedding", query), compute)
+        _query_embeddings[query] = embedding
+        while len(_query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embeddings.popitem(last=False)
+    _query_embeddings.move_to_end(query)
+    return embedding
+
+async def embed_queries(queries: List[str]) -> List[List[float]]:
+    """Embeddings of several search queries, with all cache misses in one provider call"""
+    distinct = list(dict.fromkeys(queries))
+    found = {query: _query_embeddings[query] for query in distinct if query in _query_embeddings}
+    missing = [query for query in distinct if query not in found]
+    if missing:
+        found.update(zip(missing, await generate_embeddings(missing)))
+
+    # The queries of this call become the most recent entries, so trimming drops older ones first
+    for query in distinct:
+        _query_embeddings[query] = found[query]
+        _query_embeddings.move_to_end(query)
+    while len(_query_embeddings) > QUERY_EMBEDDING_CACHE_SIZE:
+        _query_embeddings.popitem(last=False)
+    return [found[query] for query in queries]
+
 async def store_document_embeddings(user_id: str, document_id: str, chunks: List[str], embeddings: List[List[float]], metadata: Dict[str, Any]):
     """Store document chunks and embeddings"""
     try:
-        # Prepare chunks with embeddings
-        chunk_data = []
-        
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            chunk_id = f"{document_id}_chunk_{i}"
-            
-            chunk_data.append({
-                "chunk_id": chunk_id,
-                "document_id": document_id,
-                "text": chunk,
-                "embedding": embedding,  # This is a list of floats
-                "metadata": metadata
-            })
-        
-        # Store chunks
-        chunks_key = sanitize_storage_key(f"embeddings/documents/{user_id}/{document_id}")
-        db.storage.json.put(chunks_key, {"chunks": chunk_data})
+        # Store chunks as a new segment of the user's vector index
+        manifest = await vector_index.add_source(
+            user_id=user_id,
+            source_type="document",
+            source_id=document_id,
+            chunk_ids=[f"{document_id}_chunk_{i}" for i in range(len(chunks))],
+            texts=chunks,
+            embeddings=embeddings,
+            metadata=metadata
+        )
+        # Start building the new index snapshot for this user's searches
+        index_cache.schedule_refresh(user_id, manifest)
         
         # Update document metadata to mark as indexed
-        doc_meta_key = sanitize_storage_key(f"documents_meta/{user_id}")
-        
         try:
-            all_docs = db.storage.json.get(doc_meta_key)
-            print(f"[DEBUG] Updating document {document_id} indexed status")
-            print(f"[DEBUG] Pre-update document metadata: {all_docs['documents'][0].keys()}")
+            print(f"[DEBUG] Setting document {document_id} indexed=True and chunk_count={len(chunks)}")
+            updated = await documents_store.update(
+                user_id,
+                document_id,
+                {"indexed": True, "chunk_count": len(chunks), "index_generation": vector_index.generation_of(manifest)}
+            )
             
-            # Mark document as indexed
-            document_found = False
-            for i, doc in enumerate(all_docs["documents"]):
-                if doc["id"] == document_id:
-                    document_found = True
-                    print(f"[DEBUG] Found document {document_id} at index {i}")
-                    print(f"[DEBUG] Current indexed value: {doc.get('indexed', 'NOT PRESENT')}")
-                    print(f"[DEBUG] Setting indexed=True and chunk_count={len(chunks)}")
-                    
-                    # Explicit boolean assignment
-                    all_docs["documents"][i]["indexed"] = True
-                    all_docs["documents"][i]["chunk_count"] = len(chunks)
-                    break
-            
-            if not document_found:
+            if updated is None:
                 print(f"[DEBUG] Document {document_id} not found in metadata!")
-            
-            # Store the updated metadata
-            db.storage.json.put(doc_meta_key, all_docs)
-            print(f"[DEBUG] Updated metadata saved successfully")
-            
-            # Verify the update
-            try:
-                verification = db.storage.json.get(doc_meta_key)
-                for doc in verification["documents"]:
-                    if doc["id"] == document_id:
-                        print(f"[DEBUG] Verification - indexed value is now: {doc.get('indexed', 'NOT PRESENT')}")
-                        print(f"[DEBUG] Verification - indexed type: {type(doc.get('indexed')).__name__}")
-                        break
-            except Exception as ve:
-                print(f"[DEBUG] Verification failed: {str(ve)}")
         except Exception as e:
             print(f"Error updating document metadata: {str(e)}")
         
@@ -240,63 +290,30 @@ async def store_document_embeddings(user_id: str, document_id: str, chunks: List
 async def store_url_embeddings(user_id: str, url_id: str, chunks: List[str], embeddings: List[List[float]], metadata: Dict[str, Any]):
     """Store URL chunks and embeddings"""
     try:
-        # Prepare chunks with embeddings
-        chunk_data = []
-        
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            chunk_id = f"{url_id}_chunk_{i}"
-            
-            chunk_data.append({
-                "chunk_id": chunk_id,
-                "url_id": url_id,
-                "text": chunk,
-                "embedding": embedding,  # This is a list of floats
-                "metadata": metadata
-            })
-        
-        # Store chunks
-        chunks_key = sanitize_storage_key(f"embeddings/urls/{user_id}/{url_id}")
-        db.storage.json.put(chunks_key, {"chunks": chunk_data})
+        # Store chunks as a new segment of the user's vector index
+        manifest = await vector_index.add_source(
+            user_id=user_id,
+            source_type="url",
+            source_id=url_id,
+            chunk_ids=[f"{url_id}_chunk_{i}" for i in range(len(chunks))],
+            texts=chunks,
+            embeddings=embeddings,
+            metadata=metadata
+        )
+        # Start building the new index snapshot for this user's searches
+        index_cache.schedule_refresh(user_id, manifest)
         
         # Update URL metadata to mark as indexed
-        url_meta_key = sanitize_storage_key(f"urls_meta/{user_id}")
-        
         try:
-            all_urls = db.storage.json.get(url_meta_key)
-            print(f"[DEBUG] Updating URL {url_id} indexed status")
-            print(f"[DEBUG] Pre-update URL metadata: {all_urls['urls'][0].keys()}")
-            
-            # Mark URL as indexed
-            url_found = False
-            for i, url in enumerate(all_urls["urls"]):
-                if url["id"] == url_id:
-                    url_found = True
-                    print(f"[DEBUG] Found URL {url_id} at index {i}")
-                    print(f"[DEBUG] Current indexed value: {url.get('indexed', 'NOT PRESENT')}")
-                    print(f"[DEBUG] Setting indexed=True and chunk_count={len(chunks)}")
-                    
-                    # Explicit boolean assignment
-                    all_urls["urls"][i]["indexed"] = True
-                    all_urls["urls"][i]["chunk_count"] = len(chunks)
-                    break
+            print(f"[DEBUG] Setting URL {url_id} indexed=True and chunk_count={len(chunks)}")
+            updated = await urls_store.update(
+                user_id,
+                url_id,
+                {"indexed": True, "chunk_count": len(chunks), "index_generation": vector_index.generation_of(manifest)}
+            )
             
-            if not url_found:
+            if updated is None:
                 print(f"[DEBUG] URL {url_id} not found in metadata!")
-            
-            # Store the updated metadata
-            db.storage.json.put(url_meta_key, all_urls)
-            print(f"[DEBUG] Updated URL metadata saved successfully")
-            
-            # Verify the update
-            try:
-                verification = db.storage.json.get(url_meta_key)
-                for url in verification["urls"]:
-                    if url["id"] == url_id:
-                        print(f"[DEBUG] Verification - URL indexed value is now: {url.get('indexed', 'NOT PRESENT')}")
-                        print(f"[DEBUG] Verification - URL indexed type: {type(url.get('indexed')).__name__}")
-                        break
-            except Exception as ve:
-                print(f"[DEBUG] Verification failed: {str(ve)}")
         except Exception as e:
             print(f"Error updating URL metadata: {str(e)}")
         
@@ -305,11 +322,47 @@ async def store_url_embeddings(user_id: str, url_id: str, chunks: List[str], emb
         print(f"Error storing URL embeddings: {str(e)}")
         return False
 
-async def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
-    """Calculate cosine similarity between two vectors"""
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
+_legacy_migrations: Dict[str, asyncio.Lock] = {}
+
+async def migrate_legacy_embeddings(user_id: str) -> None:
+    """Pack a user's legacy per-source chunk blobs into their first index segment"""
+    lock = _legacy_migrations.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        if await vector_index.load_manifest(user_id) is not None:
+            return
+        
+        docs, _ = await documents_store.list(user_id, indexed=True)
+        urls, _ = await urls_store.list(user_id, indexed=True)
+        chunk_sets = await storage.json_get_many(
+            [sanitize_storage_key(f"embeddings/documents/{user_id}/{doc['id']}") for doc in docs]
+            + [sanitize_storage_key(f"embeddings/urls/{user_id}/{url['id']}") for url in urls]
+        )
+        
+        sources = []
+        for source, chunk_set in zip(
+            [("document", doc) for doc in docs] + [("url", url) for url in urls], chunk_sets
+        ):
+            source_type, record = source
+            if not chunk_set or not chunk_set.get("chunks"):
+                continue
+            chunks = chunk_set["chunks"]
+            metadata = dict(chunks[0].get("metadata") or {})
+            if source_type == "url":
+                metadata["url"] = record.get("url")
+            sources.append({
+                "source_type": source_type,
+                "source_id": record["id"],
+                "chunk_ids": [chunk["chunk_id"] for chunk in chunks],
+                "texts": [chunk["text"] for chunk in chunks],
+                "embeddings": [chunk["embedding"] for chunk in chunks],
+                "metadata": metadata
+            })
+        
+        if sources:
+            print(f"[DEBUG SEARCH] Migrating {len(sources)} legacy embedding sets for user {user_id}")
+            await vector_index.add_sources(user_id, sources)
+        else:
+            await vector_index.create_manifest(user_id)
 
 async def calculate_recency_score(date_str: str) -> float:
     """Calculate a recency score from 0-1 based on the date string
@@ -330,240 +383,435 @@ async def calculate_recency_score(date_str: str) -> float:
         print(f"Error calculating recency score: {str(e)}")
         return 0.5  # Default mid-range value for recency
 
-async def calculate_composite_score(semantic_score: float, recency_score: Optional[float] = None, 
-                                   credibility_score: Optional[float] = None, category_score: Optional[float] = None) -> float:
-    """Calculate a composite score from individual ranking factors
-    Weights each factor according to its importance"""
-    # Define weights for each factor (sums to 1.0)
-    semantic_weight = 0.60  # Semantic similarity is most important
-    recency_weight = 0.15   # Recent content is somewhat important
-    credibility_weight = 0.20  # Credibility is important for healthcare info
-    category_weight = 0.05  # Category is least important
-    
-    # Start with semantic score, which is always available
-    total_score = semantic_score * semantic_weight
-    used_weight = semantic_weight
+# Ranking weights for each factor (sums to 1.0)
+SEMANTIC_WEIGHT = 0.60  # Semantic similarity is most important
+RECENCY_WEIGHT = 0.15   # Recent content is somewhat important
+CREDIBILITY_WEIGHT = 0.20  # Credibility is important for healthcare info
+CATEGORY_WEIGHT = 0.05  # Category is least important
+
+async def score_sources(sources: List[Dict[str, Any]], categories: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Calculate the non-semantic ranking factors once per indexed source
     
-    # Add recency if available
-    if recency_score is not None:
-        total_score += recency_score * recency_weight
-        used_weight += recency_weight
+    Returns per-source arrays so that, for every row r of source s,
+    composite = (SEMANTIC_WEIGHT * semantic[r] + offset[s]) / weight[s]
+    is the weighted average of the ranking factors available for the source.
+    """
+    requested_categories = set(categories) if categories else set()
+    recency, credibility, category, offset, weight = [], [], [], [], []
     
-    # Add credibility if available
-    if credibility_score is not None:
-        total_score += credibility_score * credibility_weight
-        used_weight += credibility_weight
+    for source in sources:
+        meta = source["metadata"]
+        if source["source_type"] == "document":
+            # Calculate recency score based on upload date
+            date = meta.get("upload_date")
+            # For documents, we assume professional content but no explicit credibility score
+            # Use content type to estimate credibility (PDFs are often more formal documents)
+            credibility_score = 0.85 if "pdf" in (meta.get("content_type") or "").lower() else 0.75
+        else:
+            # Calculate recency score based on added date
+            date = meta.get("added_date")
+            # Use explicit credibility score if available (normalize to 0-1 range)
+            raw_cred_score = meta.get("credibility_score")
+            credibility_score = raw_cred_score / 5.0 if raw_cred_score else 0.6  # Default if not set
+        
+        recency_score = await calculate_recency_score(date) if date else None
+        
+        # Calculate category score (1.0 if category is in requested categories)
+        source_category = meta.get("category")
+        category_score = 1.0 if source_category and source_category in requested_categories else 0.5
+        
+        total, used = credibility_score * CREDIBILITY_WEIGHT, SEMANTIC_WEIGHT + CREDIBILITY_WEIGHT
+        if recency_score is not None:
+            total += recency_score * RECENCY_WEIGHT
+            used += RECENCY_WEIGHT
+        if categories:
+            total += category_score * CATEGORY_WEIGHT
+            used += CATEGORY_WEIGHT
+        
+        recency.append(recency_score)
+        credibility.append(credibility_score)
+        category.append(category_score if categories else None)
+        offset.append(total)
+        weight.append(used)
     
-    # Add category if available
-    if category_score is not None:
-        total_score += category_score * category_weight
-        used_weight += category_weight
+    return {
+        "recency": recency,
+        "credibility": credibility,
+        "category": category,
+        "offset": np.asarray(offset, dtype=np.float32),
+        "weight": np.asarray(weight, dtype=np.float32)
+    }
+
+def source_filter_mask(sources: List[Dict[str, Any]], document_ids: Optional[List[str]] = None, url_ids: Optional[List[str]] = None, categories: Optional[List[str]] = None) -> np.ndarray:
+    """Boolean mask of the sources that pass the request filters"""
+    mask = np.ones(len(sources), dtype=bool)
+    for i, source in enumerate(sources):
+        # Filter documents and URLs by ID if provided
+        if source["source_type"] == "document" and document_ids and source["source_id"] not in document_ids:
+            mask[i] = False
+        elif source["source_type"] == "url" and url_ids and source["source_id"] not in url_ids:
+            mask[i] = False
+        # Filter by category if provided
+        elif categories and source["metadata"].get("category") not in categories:
+            mask[i] = False
+    return mask
+
+def build_search_result(index: vector_index.TenantIndex, row: int, chunk: Tuple[str, str], semantic_score: float, composite_score: float, source_scores: Dict[str, Any]) -> SearchResult:
+    """Create the SearchResult for one row of the index"""
+    chunk_id, text = chunk
+    position = int(index.row_source[row])
+    source = index.sources[position]
+    meta = source["metadata"]
     
-    # Normalize by dividing by the total weight used
-    if used_weight > 0:
-        normalized_score = total_score / used_weight
+    if source["source_type"] == "document":
+        metadata = {
+            **meta,
+            "document_id": source["source_id"],
+            "document_name": meta.get("filename"),
+            "upload_date": meta.get("upload_date")
+        }
     else:
-        normalized_score = semantic_score  # Fallback to semantic score
+        metadata = {
+            **meta,
+            "url_id": source["source_id"],
+            "url": meta.get("url"),
+            "url_title": meta.get("title"),
+            "added_date": meta.get("added_date"),
+            "raw_credibility_score": meta.get("credibility_score")
+        }
     
-    return normalized_score
+    return SearchResult(
+        id=chunk_id,
+        text=text,
+        metadata=metadata,
+        score=composite_score,
+        source_type=source["source_type"],
+        semantic_score=semantic_score,
+        recency_score=source_scores["recency"][position],
+        credibility_score=source_scores["credibility"][position],
+        category_score=source_scores["category"][position]
+    )
 
-async def search_embeddings(user_id: str, query_embedding: List[float], top_k: int = 5, document_ids: Optional[List[str]] = None, url_ids: Optional[List[str]] = None, categories: Optional[List[str]] = None) -> List[SearchResult]:
-    """Search for similar chunks based on embeddings with advanced ranking"""
-    print(f"[DEBUG SEARCH] Starting search for user_id: {user_id}")
-    
+async def load_search_index(user_id: str, current: bool = False) -> vector_index.TenantIndex:
+    """The user's vector index (kept warm by index_cache), migrating legacy chunk blobs on first use
+
+    With current, the latest manifest is read and its snapshot awaited; used
+    to retry a search whose snapshot raised StaleIndexError.
+    """
+    manifest = await vector_index.load_manifest(user_id, fresh=current)
+    if manifest is None:
+        await migrate_legacy_embeddings(user_id)
+        manifest = await vector_index.load_manifest(user_id)
+    return await index_cache.get_index(user_id, manifest, wait=current)
+
+def search_user_id(user_id: str) -> str:
+    """The user whose index a search runs against"""
     # TEMPORARY FIX: If test-user-id is used, also search in the actual user's documents
     if user_id == "test-user-id":
         real_user_id = "v81muli0aIPaki39n9Ltt6gPW9z1"  # The actual user ID with data
         print(f"[DEBUG SEARCH] Using real user ID for testing: {real_user_id}")
-        user_id = real_user_id
+        return real_user_id
+    return user_id
+
+async def rank_scores(index: vector_index.TenantIndex, semantic_scores: np.ndarray, query_embeddings: List[List[float]], top_k: int = 5, document_ids: Optional[List[str]] = None, url_ids: Optional[List[str]] = None, categories: Optional[List[str]] = None, source_scores: Optional[Dict[str, Any]] = None) -> List[SearchResult]:
+    """Rank the chunks of one index snapshot given their semantic scores
     
-    results = []
-    requested_categories = set(categories) if categories else set()
+    semantic_scores has one row per query variant (query_embeddings). A
+    single variant is ranked by composite score; several are ranked each and
+    the rankings combined with reciprocal-rank fusion, and results carry the
+    scores of the variant that matched them best.
+    
+    Scores from a quantized index are approximate. Each variant's best
+    max(top_k, RESCORE_ROWS) rows by composite score, after filtering, are
+    rescored at full precision and only those rows are ranked.
+    """
+    if index.size == 0:
+        return []
+    
+    if source_scores is None:
+        source_scores = await score_sources(index.sources, categories)
+    
+    def composite(scores: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        sources = index.row_source[rows]
+        return (SEMANTIC_WEIGHT * scores + source_scores["offset"][sources]) / source_scores["weight"][sources]
+    
+    all_rows = np.arange(index.size)
+    composite_scores = composite(semantic_scores, all_rows)
+    
+    # Exclude chunks whose source is filtered out
+    row_mask = source_filter_mask(index.sources, document_ids, url_ids, categories)[index.row_source]
+    composite_scores = np.where(row_mask, composite_scores, -np.inf)
+    
+    k = min(top_k, int(row_mask.sum()))
+    if k <= 0:
+        return []
+    
+    if index.quantized:
+        candidates = vector_quantization.shortlist(composite_scores, max(k, vector_index.RESCORE_ROWS))
+        candidates = candidates[row_mask[candidates]]
+        semantic_scores = np.array(semantic_scores, dtype=np.float32)
+        semantic_scores[:, candidates] = index.rescore(query_embeddings, candidates)
+        composite_scores = np.full(composite_scores.shape, -np.inf, dtype=composite_scores.dtype)
+        composite_scores[:, candidates] = composite(semantic_scores[:, candidates], candidates)
+    
+    if len(composite_scores) == 1:
+        best_variant = np.zeros(index.size, dtype=np.intp)
+        best_scores = ranking_scores = composite_scores[0]
+    else:
+        best_variant = composite_scores.argmax(axis=0)
+        best_scores = composite_scores[best_variant, np.arange(index.size)]
+        ranking_scores = multi_query.reciprocal_rank_fusion(composite_scores, depth=max(top_k, multi_query.RRF_DEPTH))
+    
+    # Select the top_k rows (highest first), ties going to the better composite score
+    top_rows = np.argpartition(-ranking_scores, k - 1)[:k]
+    top_rows = top_rows[np.lexsort((-best_scores[top_rows], -ranking_scores[top_rows]))]
+    
+    # Only the winning rows need their text
+    chunks = await index.fetch_chunks([int(row) for row in top_rows])
+    
+    return [
+        build_search_result(index, int(row), chunk, float(semantic_scores[best_variant[row], row]), float(best_scores[row]), source_scores)
+        for row, chunk in zip(top_rows, chunks)
+    ]
+
+async def rank_index(index: vector_index.TenantIndex, query_embedding: List[float], top_k: int = 5, document_ids: Optional[List[str]] = None, url_ids: Optional[List[str]] = None, categories: Optional[List[str]] = None) -> List[SearchResult]:
+    """Rank the chunks of one index snapshot against a query embedding"""
+    # Score every indexed chunk against the query, together with concurrent searches of the same index
+    semantic_scores = await search_batcher.similarities(index, [query_embedding])
+    return await rank_scores(index, semantic_scores, [query_embedding], top_k, document_ids, url_ids, categories)
+
+async def rank_index_fused(index: vector_index.TenantIndex, query_embeddings: List[List[float]], top_k: int = 5, document_ids: Optional[List[str]] = None, url_ids: Optional[List[str]] = None, categories: Optional[List[str]] = None) -> List[SearchResult]:
+    """Rank the chunks of one index snapshot against several query variants, fused by rank"""
+    # Score every variant against every indexed chunk in one matrix-matrix product
+    semantic_scores = await search_batcher.similarities(index, query_embeddings)
+    return await rank_scores(index, semantic_scores, query_embeddings, top_k, document_ids, url_ids, categories)
+
+def query_variants(request: SearchRequest) -> List[str]:
+    """The queries a search ranks for: the query, and its variants in multi-query mode"""
+    if request.multi_query:
+        return multi_query.variants(request.query, request.earlier_questions)
+    return [request.query]
+
+def search_cache_key(index: vector_index.TenantIndex, request: SearchRequest, variants: List[str]) -> Tuple:
+    key = search_cache.make_key(
+        index.user_id,
+        index.generation,
+        request.query,
+        request.top_k,
+        request.document_ids,
+        request.url_ids,
+        request.categories
+    )
+    if len(variants) > 1:
+        # Fused results depend on every variant
+        key += tuple(search_cache.normalize_query(variant) for variant in variants[1:])
+    return key
+
+async def retrieve(request: SearchRequest, user_id: str) -> RetrievalContext:
+    """Run the search pipeline once and keep everything later steps need
+    
+    Used by /search and /chat; the returned context carries the ranked
+    results, the index generation they came from and step timings.
+    """
+    start = time.perf_counter()
+    timings = {}
+    index_user_id = search_user_id(user_id)
     
-    # Search document embeddings
-    doc_meta_key = sanitize_storage_key(f"documents_meta/{user_id}")
     try:
-        all_docs = db.storage.json.get(doc_meta_key)
-        
-        # Filter documents by ID if provided
-        filtered_docs = all_docs["documents"]
-        if document_ids:
-            filtered_docs = [doc for doc in filtered_docs if doc["id"] in document_ids]
-        
-        # Filter documents by category if provided
-        if categories:
-            filtered_docs = [doc for doc in filtered_docs if doc.get("category") in categories]
-        
-        # Search through indexed documents
-        for doc in filtered_docs:
-            if doc.get("indexed"):
-                doc_id = doc["id"]
-                doc_chunks_key = sanitize_storage_key(f"embeddings/documents/{user_id}/{doc_id}")
-                
-                try:
-                    doc_chunks = db.storage.json.get(doc_chunks_key)
-                    
-                    for chunk in doc_chunks["chunks"]:
-                        # Calculate semantic similarity score
-                        semantic_score = float(await cosine_similarity(query_embedding, chunk["embedding"]))
-                        
-                        # Calculate recency score based on upload date
-                        upload_date = doc.get("upload_date")
-                        recency_score = await calculate_recency_score(upload_date) if upload_date else None
-                        
-                        # Calculate category score (1.0 if category is in requested categories)
-                        doc_category = doc.get("category")
-                        category_score = 1.0 if doc_category and doc_category in requested_categories else 0.5
-                        
-                        # For documents, we assume professional content but no explicit credibility score
-                        # Use content type to estimate credibility (PDFs are often more formal documents)
-                        content_type = doc.get("content_type", "")
-                        credibility_score = 0.85 if "pdf" in content_type.lower() else 0.75
-                        
-                        # Calculate composite score
-                        composite_score = await calculate_composite_score(
-                            semantic_score=semantic_score,
-                            recency_score=recency_score,
-                            credibility_score=credibility_score,
-                            category_score=category_score if categories else None
-                        )
-                        
-                        # Add to results
-                        results.append(SearchResult(
-                            id=chunk["chunk_id"],
-                            text=chunk["text"],
-                            metadata={
-                                **chunk["metadata"],
-                                "document_id": doc_id,
-                                "document_name": doc["filename"],
-                                "upload_date": upload_date
-                            },
-                            score=composite_score,
-                            source_type="document",
-                            semantic_score=semantic_score,
-                            recency_score=recency_score,
-                            credibility_score=credibility_score,
-                            category_score=category_score if categories else None
-                        ))
-                except Exception as e:
-                    print(f"Error searching document {doc_id}: {str(e)}")
+        index = await load_search_index(index_user_id)
     except Exception as e:
-        print(f"Error searching document embeddings: {str(e)}")
+        print(f"Error loading vector index: {str(e)}")
+        return RetrievalContext(query=request.query, user_id=index_user_id)
+    timings["index_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    
+    variants = query_variants(request)
     
-    # Search URL embeddings
-    url_meta_key = sanitize_storage_key(f"urls_meta/{user_id}")
+    # Identical searches against the same index generation rank identically
+    cache_key = search_cache_key(index, request, variants)
+    results = search_cache.get(cache_key)
+    cache_hit = results is not None
+    coalesced = False
+    
+    if not cache_hit:
+        async def embed_and_rank():
+            step_timings = {}
+            
+            step = time.perf_counter()
+            if len(variants) > 1:
+                # Embed all variants in one call and fuse their rankings
+                query_embeddings = await embed_queries(variants)
+            else:
+                # Generate embedding for the query
+                query_embeddings = [await embed_query(request.query)]
+            step_timings["embedding_ms"] = round((time.perf_counter() - step) * 1000, 2)
+            
+            async def rank(snapshot: vector_index.TenantIndex) -> List[SearchResult]:
+                if len(query_embeddings) > 1:
+                    return await rank_index_fused(
+                        snapshot,
+                        query_embeddings=query_embeddings,
+                        top_k=request.top_k,
+                        document_ids=request.document_ids,
+                        url_ids=request.url_ids,
+                        categories=request.categories
+                    )
+                # Search for similar chunks
+                return await rank_index(
+                    snapshot,
+                    query_embedding=query_embeddings[0],
+                    top_k=request.top_k,
+                    document_ids=request.document_ids,
+                    url_ids=request.url_ids,
+                    categories=request.categories
+                )
+            
+            step = time.perf_counter()
+            ranked_index = index
+            try:
+                ranked = await rank(ranked_index)
+            except vector_index.StaleIndexError as e:
+                # Segments this snapshot reads were merged away and deleted; rank against the current index
+                print(f"[DEBUG SEARCH] {str(e)}, reloading the index")
+                ranked_index = await load_search_index(index_user_id, current=True)
+                ranked = await rank(ranked_index)
+            step_timings["ranking_ms"] = round((time.perf_counter() - step) * 1000, 2)
+            search_cache.put(search_cache_key(ranked_index, request, variants), ranked)
+            return ranked, step_timings, ranked_index
+        
+        # Identical searches already in flight share one embedding and ranking
+        (results, step_timings, index), coalesced = await single_flight.run(("search",) + cache_key, embed_and_rank)
+        timings.update(step_timings)
+    
+    timings["total_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    retrieval = RetrievalContext(
+        query=request.query,
+        user_id=index_user_id,
+        generation=index.generation,
+        results=results,
+        cache_hit=cache_hit,
+        coalesced=coalesced,
+        query_variants=variants if len(variants) > 1 else [],
+        timings=timings
+    )
+    retrieval.source_generations = index.source_generations(retrieval.source_keys())
+    return retrieval
+
+async def rank_batch(index: vector_index.TenantIndex, searches: List[Tuple[SearchRequest, List[str]]], embeddings: List[List[float]], query_rows: Dict[str, int]) -> List[List[SearchResult]]:
+    """Rank several searches against one index snapshot, scoring all their queries together"""
+    # Score all queries against every indexed chunk in one matrix-matrix product
+    semantic_scores = index.similarities_many(embeddings)
+    
+    # Source scores depend only on the requested categories
+    source_scores: Dict[Tuple[str, ...], Dict[str, Any]] = {}
+    ranked = []
+    for request, variants in searches:
+        categories = tuple(sorted(set(request.categories))) if request.categories else ()
+        if categories not in source_scores:
+            source_scores[categories] = await score_sources(index.sources, request.categories)
+        rows = [query_rows[variant] for variant in variants]
+        ranked.append(await rank_scores(
+            index,
+            semantic_scores[rows],
+            [embeddings[row] for row in rows],
+            top_k=request.top_k,
+            document_ids=request.document_ids,
+            url_ids=request.url_ids,
+            categories=request.categories,
+            source_scores=source_scores[categories]
+        ))
+    return ranked
+
+async def retrieve_batch(requests: List[SearchRequest], user_id: str) -> List[List[SearchResult]]:
+    """Results of many searches against one index snapshot, in request order
+    
+    Searches found in the search cache are answered from it. All others share
+    one embedding call for their query texts and one queries x chunks matrix
+    product, then are ranked with their own filters.
+    """
+    index_user_id = search_user_id(user_id)
     try:
-        all_urls = db.storage.json.get(url_meta_key)
-        
-        # Filter URLs by ID if provided
-        filtered_urls = all_urls["urls"]
-        if url_ids:
-            filtered_urls = [url for url in filtered_urls if url["id"] in url_ids]
-        
-        # Filter URLs by category if provided
-        if categories:
-            filtered_urls = [url for url in filtered_urls if url.get("category") in categories]
-        
-        # Search through indexed URLs
-        for url in filtered_urls:
-            if url.get("indexed"):
-                url_id = url["id"]
-                url_chunks_key = sanitize_storage_key(f"embeddings/urls/{user_id}/{url_id}")
-                
-                try:
-                    url_chunks = db.storage.json.get(url_chunks_key)
-                    
-                    for chunk in url_chunks["chunks"]:
-                        # Calculate semantic similarity score
-                        semantic_score = float(await cosine_similarity(query_embedding, chunk["embedding"]))
-                        
-                        # Calculate recency score based on added date
-                        added_date = url.get("added_date")
-                        recency_score = await calculate_recency_score(added_date) if added_date else None
-                        
-                        # Use explicit credibility score if available (normalize to 0-1 range)
-                        raw_cred_score = url.get("credibility_score")
-                        credibility_score = raw_cred_score / 5.0 if raw_cred_score else 0.6  # Default if not set
-                        
-                        # Calculate category score (1.0 if category is in requested categories)
-                        url_category = url.get("category")
-                        category_score = 1.0 if url_category and url_category in requested_categories else 0.5
-                        
-                        # Calculate composite score
-                        composite_score = await calculate_composite_score(
-                            semantic_score=semantic_score,
-                            recency_score=recency_score,
-                            credibility_score=credibility_score,
-                            category_score=category_score if categories else None
-                        )
-                        
-                        # Add to results
-                        results.append(SearchResult(
-                            id=chunk["chunk_id"],
-                            text=chunk["text"],
-                            metadata={
-                                **chunk["metadata"],
-                                "url_id": url_id,
-                                "url": url["url"],
-                                "url_title": url["title"],
-                                "added_date": added_date,
-                                "raw_credibility_score": raw_cred_score
-                            },
-                            score=composite_score,
-                            source_type="url",
-                            semantic_score=semantic_score,
-                            recency_score=recency_score,
-                            credibility_score=credibility_score,
-                            category_score=category_score if categories else None
-                        ))
-                except Exception as e:
-                    print(f"Error searching URL {url_id}: {str(e)}")
+        index = await load_search_index(index_user_id)
     except Exception as e:
-        print(f"Error searching URL embeddings: {str(e)}")
+        print(f"Error loading vector index: {str(e)}")
+        return [[] for _ in requests]
+    
+    cache_keys: List[Tuple] = []
+    results: List[Optional[List[SearchResult]]] = []
+    pending: Dict[Tuple, Tuple[SearchRequest, List[str]]] = {}
+    for request in requests:
+        variants = query_variants(request)
+        cache_key = search_cache_key(index, request, variants)
+        cached = search_cache.get(cache_key)
+        cache_keys.append(cache_key)
+        results.append(cached)
+        if cached is None:
+            pending.setdefault(cache_key, (request, variants))
+    
+    if pending:
+        # Embed every distinct query text in one provider call
+        queries = list(dict.fromkeys(variant for _, variants in pending.values() for variant in variants))
+        query_rows = {query: row for row, query in enumerate(queries)}
+        embeddings = await embed_queries(queries)
+        
+        searches = list(pending.values())
+        try:
+            rankings = await rank_batch(index, searches, embeddings, query_rows)
+        except vector_index.StaleIndexError as e:
+            # Segments this snapshot reads were merged away and deleted; rank against the current index
+            print(f"[DEBUG SEARCH] {str(e)}, reloading the index")
+            index = await load_search_index(index_user_id, current=True)
+            rankings = await rank_batch(index, searches, embeddings, query_rows)
+        
+        ranked: Dict[Tuple, List[SearchResult]] = {}
+        for cache_key, (request, variants), ranking in zip(pending, searches, rankings):
+            ranked[cache_key] = ranking
+            search_cache.put(search_cache_key(index, request, variants), ranking)
+        
+        results = [result if result is not None else ranked[key] for key, result in zip(cache_keys, results)]
     
-    # Sort results by composite score (highest first) and limit to top_k
-    results.sort(key=lambda x: x.score, reverse=True)
-    return results[:top_k]
+    return results
 
 # Endpoints
 @router.post("/index/document/{document_id}")
 async def index_document(document_id: str, user: AuthorizedUser):
     """Extract text, chunk, and generate embeddings for a document"""
     try:
-        # Get document metadata
-        doc_response = await get_document(document_id=document_id, user=user)
-        
-        # Extract text from document
-        text = await extract_text_from_document(user=user, document_id=document_id)
-        
-        if text.startswith("Error"):
-            raise HTTPException(status_code=400, detail=text)
-        
-        # Split text into chunks
-        chunks = await chunk_text(text)
-        
-        if not chunks:
-            raise HTTPException(status_code=400, detail="No text chunks could be created from document")
-        
-        # Generate embeddings
-        embeddings = await generate_embeddings(chunks)
-        
-        # Prepare metadata
-        metadata = {
-            "filename": doc_response.filename,
-            "content_type": doc_response.content_type,
-            "category": doc_response.category,
-            "upload_date": doc_response.upload_date
-        }
-        
-        # Store embeddings
-        success = await store_document_embeddings(
-            user_id=user.sub,
-            document_id=document_id,
-            chunks=chunks,
-            embeddings=embeddings,
-            metadata=metadata
-        )
+        # Memoize metadata reads so the steps below share a single storage read
+        with storage_cache.request_scope():
+            # Get document metadata
+            doc_response = await get_document(document_id=document_id, user=user)
+            
+            # Extract text from document
+            text = await extract_text_from_document(user=user, document_id=document_id, doc_response=doc_response)
+            
+            if text.startswith("Error"):
+                raise HTTPException(status_code=400, detail=text)
+            
+            # Split text into chunks
+            chunks = await chunk_text(text)
+            
+            if not chunks:
+                raise HTTPException(status_code=400, detail="No text chunks could be created from document")
+            
+            # Generate embeddings
+            embeddings = await generate_embeddings(chunks)
+            
+            # Prepare metadata
+            metadata = {
+                "filename": doc_response.filename,
+                "content_type": doc_response.content_type,
+                "category": doc_response.category,
+                "upload_date": doc_response.upload_date
+            }
+            
+            # Store embeddings
+            success = await store_document_embeddings(
+                user_id=user.sub,
+                document_id=document_id,
+                chunks=chunks,
+                embeddings=embeddings,
+                metadata=metadata
+            )
         
         if not success:
             raise HTTPException(status_code=500, detail="Failed to store document embeddings")
@@ -576,41 +824,44 @@ async def index_document(document_id: str, user: AuthorizedUser):
 async def index_url(url_id: str, user: AuthorizedUser):
     """Scrape, chunk, and generate embeddings for a URL"""
     try:
-        # Get URL metadata
-        url_response = await get_url(url_id=url_id, user=user)
-        
-        # Scrape content from URL
-        text = await scrape_url_content(user=user, url_id=url_id)
-        
-        if text.startswith("Error"):
-            raise HTTPException(status_code=400, detail=text)
-        
-        # Split text into chunks
-        chunks = await chunk_text(text)
-        
-        if not chunks:
-            raise HTTPException(status_code=400, detail="No text chunks could be created from URL")
-        
-        # Generate embeddings
-        embeddings = await generate_embeddings(chunks)
-        
-        # Prepare metadata
-        metadata = {
-            "title": url_response.title,
-            "description": url_response.description,
-            "category": url_response.category,
-            "credibility_score": url_response.credibility_score,
-            "added_date": url_response.added_date
-        }
-        
-        # Store embeddings
-        success = await store_url_embeddings(
-            user_id=user.sub,
-            url_id=url_id,
-            chunks=chunks,
-            embeddings=embeddings,
-            metadata=metadata
-        )
+        # Memoize metadata reads so the steps below share a single storage read
+        with storage_cache.request_scope():
+            # Get URL metadata
+            url_response = await get_url(url_id=url_id, user=user)
+            
+            # Scrape content from URL
+            text = await scrape_url_content(user=user, url_id=url_id, url_response=url_response)
+            
+            if text.startswith("Error"):
+                raise HTTPException(status_code=400, detail=text)
+            
+            # Split text into chunks
+            chunks = await chunk_text(text)
+            
+            if not chunks:
+                raise HTTPException(status_code=400, detail="No text chunks could be created from URL")
+            
+            # Generate embeddings
+            embeddings = await generate_embeddings(chunks)
+            
+            # Prepare metadata
+            metadata = {
+                "title": url_response.title,
+                "description": url_response.description,
+                "category": url_response.category,
+                "credibility_score": url_response.credibility_score,
+                "added_date": url_response.added_date,
+                "url": url_response.url
+            }
+            
+            # Store embeddings
+            success = await store_url_embeddings(
+                user_id=user.sub,
+                url_id=url_id,
+                chunks=chunks,
+                embeddings=embeddings,
+                metadata=metadata
+            )
         
         if not success:
             raise HTTPException(status_code=500, detail="Failed to store URL embeddings")
@@ -729,19 +980,18 @@ async def batch_index_all(user: AuthorizedUser, force: bool = False):
 async def search(request: SearchRequest, user: AuthorizedUser):
     """Search for relevant chunks based on a query"""
     try:
-        # Generate embedding for the query
-        query_embedding = (await generate_embeddings([request.query]))[0]
-        
-        # Search for similar chunks
-        results = await search_embeddings(
-            user_id=user.sub,
-            query_embedding=query_embedding,
-            top_k=request.top_k,
-            document_ids=request.document_ids,
-            url_ids=request.url_ids,
-            categories=request.categories
-        )
-        
-        return SearchResponse(results=results)
+        retrieval = await retrieve(request, user.sub)
+        return SearchResponse(results=retrieval.results)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error searching: {str(e)}")
+
+@router.post("/search/batch", response_model=BatchSearchResponse)
+async def search_batch(request: BatchSearchRequest, user: AuthorizedUser):
+    """Run many searches in one request, embedding and scoring all queries together"""
+    if len(request.requests) > SEARCH_BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"At most {SEARCH_BATCH_MAX_REQUESTS} searches per batch")
+    try:
+        results = await retrieve_batch(request.requests, user.sub)
+        return BatchSearchResponse(responses=[SearchResponse(results=ranked) for ranked in results])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error searching: {str(e)}")
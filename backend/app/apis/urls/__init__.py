@@ -1,12 +1,13 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query
 from pydantic import BaseModel, validator, HttpUrl
-from typing import List, Optional
+from typing import Annotated, List, Optional
 import uuid
 import datetime
 import re
 from app.auth import AuthorizedUser
+from app.libs.metadata_store import MAX_PAGE_SIZE, urls_store
+from app.libs import index_cache, vector_index
 import httpx
-import databutton as db
 
 router = APIRouter(prefix="/urls")
 
@@ -58,6 +59,7 @@ class URLResponse(BaseModel):
 
 class URLsListResponse(BaseModel):
     urls: List[URLResponse]
+    total_count: Optional[int] = None
 
 class UpdateURLRequest(BaseModel):
     title: Optional[str] = None
@@ -92,16 +94,8 @@ async def add_url(user: AuthorizedUser, data: URLCreateRequest):
         "indexed": False
     }
     
-    # Get existing URL metadata or create new list
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-    try:
-        all_urls = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        all_urls = {"urls": []}
-    
     # Add new URL metadata
-    all_urls["urls"].append(url_data)
-    db.storage.json.put(meta_key, all_urls)
+    await urls_store.create(user.sub, url_data)
     
     # Directly index the URL without making HTTP requests
     try:
@@ -118,13 +112,7 @@ async def add_url(user: AuthorizedUser, data: URLCreateRequest):
                 print(f"Error in background indexing for URL {url_id}: {str(e)}")
                 # Update URL metadata to show indexing failed
                 try:
-                    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-                    url_meta = db.storage.json.get(meta_key)
-                    for i, url in enumerate(url_meta["urls"]):
-                        if url["id"] == url_id:
-                            url_meta["urls"][i]["indexed"] = None
-                            db.storage.json.put(meta_key, url_meta)
-                            break
+                    await urls_store.update(user.sub, url_id, {"indexed": None})
                 except Exception as update_err:
                     print(f"Failed to update URL metadata: {str(update_err)}")
         
@@ -137,117 +125,80 @@ async def add_url(user: AuthorizedUser, data: URLCreateRequest):
     return URLResponse(**url_data)
 
 @router.get("", response_model=URLsListResponse)
-async def list_urls(user: AuthorizedUser, category: Optional[str] = None):
-    """List all URLs added by the user"""
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-    
-    try:
-        all_urls = db.storage.json.get(meta_key)
-        
-        # Debug log metadata
-        if all_urls and "urls" in all_urls and len(all_urls["urls"]) > 0:
-            print(f"[DEBUG] URL list - found {len(all_urls['urls'])} URLs")
-            for i, url in enumerate(all_urls["urls"]):
-                indexed_value = url.get("indexed", "NOT PRESENT")
-                indexed_type = type(indexed_value).__name__ if indexed_value != "NOT PRESENT" else "N/A"
-                print(f"[DEBUG] URL {i}: id={url.get('id')}, indexed={indexed_value} (type: {indexed_type})")
-    except FileNotFoundError:
-        return URLsListResponse(urls=[])
-    
-    # Filter by category if specified
-    if category:
-        filtered_urls = [url for url in all_urls["urls"] if url.get("category") == category]
-        return URLsListResponse(urls=filtered_urls)
-    
-    return URLsListResponse(urls=all_urls["urls"])
+async def list_urls(user: AuthorizedUser, category: Optional[str] = None, page: Annotated[Optional[int], Query(ge=1)] = None, page_size: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = 100):
+    """List URLs added by the user, optionally one page at a time"""
+    # Without a page number, return every URL as before
+    offset = (page - 1) * page_size if page else 0
+    limit = page_size if page else None
+    
+    urls, total_count = await urls_store.list(
+        user.sub,
+        offset=offset,
+        limit=limit,
+        categories=[category] if category else None
+    )
+    print(f"[DEBUG] URL list - returning {len(urls)} of {total_count} URLs")
+    
+    return URLsListResponse(urls=urls, total_count=total_count)
 
 @router.get("/{url_id}", response_model=URLResponse)
 async def get_url(url_id: str, user: AuthorizedUser):
     """Get a specific URL's metadata"""
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-    
-    try:
-        all_urls = db.storage.json.get(meta_key)
-    except FileNotFoundError:
+    url = await urls_store.get(user.sub, url_id)
+    if not url:
         raise HTTPException(status_code=404, detail="URL not found")
     
-    # Find the URL
-    for url in all_urls["urls"]:
-        if url["id"] == url_id:
-            return URLResponse(**url)
-    
-    raise HTTPException(status_code=404, detail="URL not found")
+    return URLResponse(**url)
 
 @router.put("/{url_id}", response_model=URLResponse)
 async def update_url(url_id: str, data: UpdateURLRequest, user: AuthorizedUser):
     """Update a URL's metadata"""
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
+    # Update fields if provided
+    fields = {}
+    if data.title is not None:
+        fields["title"] = data.title
+    if data.description is not None:
+        fields["description"] = data.description
+    if data.category is not None:
+        fields["category"] = data.category
+    if data.credibility_score is not None:
+        fields["credibility_score"] = data.credibility_score
+    
+    url = await urls_store.update(user.sub, url_id, fields)
+    if not url:
+        raise HTTPException(status_code=404, detail="URL not found")
     
+    # Keep the metadata used for search ranking in step
     try:
-        all_urls = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="URL not found")
+        index_cache.schedule_refresh(
+            user.sub, await vector_index.update_source_metadata(user.sub, "url", url_id, fields)
+        )
+    except Exception as e:
+        # Log but continue since the metadata is already updated
+        print(f"Error updating URL metadata in vector index: {e}")
     
-    # Find and update the URL
-    for i, url in enumerate(all_urls["urls"]):
-        if url["id"] == url_id:
-            # Update fields if provided
-            if data.title is not None:
-                all_urls["urls"][i]["title"] = data.title
-            if data.description is not None:
-                all_urls["urls"][i]["description"] = data.description
-            if data.category is not None:
-                all_urls["urls"][i]["category"] = data.category
-            if data.credibility_score is not None:
-                all_urls["urls"][i]["credibility_score"] = data.credibility_score
-            
-            # Save updated metadata
-            db.storage.json.put(meta_key, all_urls)
-            return URLResponse(**all_urls["urls"][i])
-    
-    raise HTTPException(status_code=404, detail="URL not found")
+    return URLResponse(**url)
 
 @router.delete("/{url_id}", status_code=204)
 async def delete_url(url_id: str, user: AuthorizedUser):
     """Delete a URL"""
     print(f"[DEBUG] Attempting to delete URL with ID: {url_id}")
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
     
-    try:
-        all_urls = db.storage.json.get(meta_key)
-        print(f"[DEBUG] Found URL metadata with {len(all_urls['urls'])} URLs")
-    except FileNotFoundError:
-        print(f"[DEBUG] URL metadata not found for user {user.sub}")
+    deleted_url = await urls_store.delete(user.sub, url_id)
+    if not deleted_url:
+        print(f"[DEBUG] URL with ID {url_id} not found in metadata")
         raise HTTPException(status_code=404, detail="URL not found")
     
-    # Find the URL to delete
-    url_found = False
-    for i, url in enumerate(all_urls["urls"]):
-        if url["id"] == url_id:
-            url_found = True
-            print(f"[DEBUG] URL found at index {i}, removing it")
-            all_urls["urls"].pop(i)
-            db.storage.json.put(meta_key, all_urls)
-            print(f"[DEBUG] URL successfully deleted. New count: {len(all_urls['urls'])}")
-            return None
-    
-    print(f"[DEBUG] URL with ID {url_id} not found in metadata")
-    raise HTTPException(status_code=404, detail="URL not found")
+    # Drop its chunks from the search index
+    try:
+        index_cache.schedule_refresh(user.sub, await vector_index.remove_source(user.sub, "url", url_id))
+    except Exception as e:
+        print(f"Error removing URL from vector index: {e}")
+    
+    print(f"[DEBUG] URL {url_id} successfully deleted")
+    return None
 
 @router.get("/categories/list", response_model=List[str])
 async def list_url_categories(user: AuthorizedUser):
     """List all URL categories used by the user"""
-    meta_key = sanitize_storage_key(f"urls_meta/{user.sub}")
-    
-    try:
-        all_urls = db.storage.json.get(meta_key)
-    except FileNotFoundError:
-        return []
-    
-    # Extract unique categories
-    categories = set()
-    for url in all_urls["urls"]:
-        if url.get("category"):
-            categories.add(url["category"])
-    
-    return list(categories)
\ No newline at end of file
+    return await urls_store.categories(user.sub)
@@ -0,0 +1,140 @@
+"""Semantic cache of chat answers for near-duplicate questions.
+
+Users often ask the same question in slightly different words. For a first
+message (no conversation history), the chat endpoint looks here for an
+earlier answer whose query embedding has cosine similarity of at least
+SEMANTIC_CACHE_THRESHOLD with the new one. The answer is reused only if
+every source it was grounded on is unchanged: still indexed at the same
+per-source generation (see `vector_index.source_generations`). Entries also
+expire after SEMANTIC_CACHE_TTL_SECONDS, because new documents can make an
+older answer incomplete without touching its sources.
+
+Answers are kept per user and per worker, bounded by
+SEMANTIC_CACHE_MAX_ENTRIES per user and SEMANTIC_CACHE_MAX_USERS users (least
+recently used first out).
+
+Usage:
+
+    from app.libs import answer_cache
+
+    hit = await answer_cache.lookup(user_id, query_embedding)
+    if hit is None:
+        ...
+        await answer_cache.store(user_id, query, query_embedding, response.dict(), answer_text, source_generations)
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.libs import vector_index
+
+# Minimum cosine similarity between two questions for an answer to be reused
+SIMILARITY_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+# Seconds an answer may be reused for
+TTL_SECONDS = float(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+# Answers kept per user, and users kept per worker
+MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "256"))
+MAX_USERS = int(os.environ.get("SEMANTIC_CACHE_MAX_USERS", "1024"))
+
+
+class _Entry:
+    def __init__(self, query: str, vector: np.ndarray, response: Dict[str, Any], answer: str, sources: Dict[str, Optional[int]]):
+        self.query = query
+        self.vector = vector
+        self.response = response
+        self.answer = answer
+        self.sources = sources
+        self.expires_at = time.monotonic() + TTL_SECONDS
+
+
+# user_id -> entries, oldest first
+_entries: "OrderedDict[str, List[_Entry]]" = OrderedDict()
+
+_stats = {"hits": 0, "misses": 0, "stale": 0, "stores": 0}
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+async def lookup(user_id: str, query_embedding: List[float]) -> Optional[Dict[str, Any]]:
+    """The closest still-valid cached answer, or None
+
+    Returns {"query", "response", "answer", "similarity"}, where response is
+    the cached ChatResponse as a dict and answer the raw completion text.
+    """
+    entries = _entries.get(user_id)
+    now = time.monotonic()
+    if entries:
+        entries[:] = [entry for entry in entries if entry.expires_at > now]
+    if not entries:
+        _stats["misses"] += 1
+        return None
+
+    similarities = np.stack([entry.vector for entry in entries]) @ _normalize(query_embedding)
+    manifest = await vector_index.load_manifest(user_id)
+    for position in np.argsort(-similarities):
+        if similarities[position] < SIMILARITY_THRESHOLD:
+            break
+        entry = entries[position]
+        if vector_index.source_generations(manifest, list(entry.sources)) != entry.sources:
+            # A source was re-indexed, recategorized or removed since this answer
+            _stats["stale"] += 1
+            continue
+        _entries.move_to_end(user_id)
+        _stats["hits"] += 1
+        return {"query": entry.query, "response": entry.response, "answer": entry.answer, "similarity": float(similarities[position])}
+
+    _stats["misses"] += 1
+    return None
+
+
+async def store(user_id: str, query: str, query_embedding: List[float], response: Dict[str, Any], answer: str, source_generations: Dict[str, Optional[int]]) -> None:
+    """Remember an answer and the state of the sources it was grounded on
+
+    answer is the raw completion the response was formatted from, which is
+    what a conversation records as the assistant's turn.
+
+    source_generations maps each source's index key to its generation in the
+    index snapshot the answer was retrieved from, so a source changed since
+    that retrieval already makes the entry stale.
+    """
+    if not source_generations:
+        # Nothing to check the answer against later
+        return
+    entries = _entries.setdefault(user_id, [])
+    entries.append(_Entry(query, _normalize(query_embedding), response, answer, dict(source_generations)))
+    del entries[:-MAX_ENTRIES]
+    _stats["stores"] += 1
+
+    _entries.move_to_end(user_id)
+    while len(_entries) > MAX_USERS:
+        _entries.popitem(last=False)
+
+
+def answer_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters and current size"""
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate": round(_stats["hits"] / lookups, 4) if lookups else None,
+        "users": len(_entries),
+        "entries": sum(len(entries) for entries in _entries.values()),
+        "threshold": SIMILARITY_THRESHOLD,
+    }
+
+
+__all__ = [
+    "SIMILARITY_THRESHOLD",
+    "answer_cache_stats",
+    "lookup",
+    "store",
+]
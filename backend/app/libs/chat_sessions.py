@@ -0,0 +1,208 @@
+"""Server-side chat sessions.
+
+A session keeps a conversation on the server, so clients send a session id
+and the new message instead of the whole history on every turn. Turns are
+stored compactly: the question as asked and the model's raw answer, without
+the structured formatting and sources added for display.
+
+Once the stored turns exceed SESSION_RECENT_TOKENS, the oldest ones are
+folded into a rolling summary of the conversation. Each fold extends the
+previous summary with the turns being folded, so every turn is summarized
+exactly once, and the summary is stored with the session. Prompts therefore
+carry the summary plus a few recent turns, which keeps both request payloads
+and prompt size flat as a conversation grows.
+
+Usage:
+
+    from app.libs import chat_sessions
+
+    session = await chat_sessions.create(user_id)
+    session = await chat_sessions.get(user_id, session_id)
+    session = await chat_sessions.append_turn(user_id, session_id, question, answer)
+    chat_sessions.schedule_summary(user_id, session, api_key)
+"""
+
+import asyncio
+import os
+import random
+import re
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.libs import llm_client, prompt_budget, storage_cache
+
+# Tokens of recent turns kept verbatim before the oldest are folded into the summary
+RECENT_TOKENS = int(os.environ.get("SESSION_RECENT_TOKENS", "1000"))
+
+# Length limit and model of the rolling summary
+SUMMARY_TOKENS = int(os.environ.get("SESSION_SUMMARY_TOKENS", "400"))
+SUMMARY_MODEL = os.environ.get("SESSION_SUMMARY_MODEL", "gpt-4")
+
+# Attempts made by a compare-and-swap write before giving up
+MAX_CAS_RETRIES = 8
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a healthcare professional and an assistant that answers from a document repository.
+Extend the summary with the new turns. Keep the questions asked, the key facts and recommendations given, the documents cited and any open follow-ups. Drop pleasantries and repetition.
+Reply with the updated summary only."""
+
+# session key -> summary in progress, so a session is summarized by one task at a time per worker
+_summarizing: Dict[str, asyncio.Task] = {}
+
+
+class SessionNotFoundError(Exception):
+    """Raised when a session does not exist or belongs to another user"""
+
+
+def sanitize_storage_key(key: str) -> str:
+    """Sanitize storage key to only allow alphanumeric and ._- symbols"""
+    # Remove slashes first
+    key = key.replace("/", "")
+    # Then filter other characters
+    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+
+
+def session_key(user_id: str, session_id: str) -> str:
+    return sanitize_storage_key(f"chat_session_{user_id}_{session_id}")
+
+
+def _turn_tokens(turns: List[Dict[str, str]]) -> int:
+    return sum(prompt_budget.message_tokens(turn) for turn in turns)
+
+
+async def _update(user_id: str, session_id: str, change: Callable[[Dict[str, Any]], None]) -> Dict[str, Any]:
+    """Apply change(session) with compare-and-swap, retrying on conflicts"""
+    key = session_key(user_id, session_id)
+    for attempt in range(MAX_CAS_RETRIES):
+        session = await storage_cache.json_get(key, default=None, fresh=attempt > 0)
+        if session is None:
+            raise SessionNotFoundError(session_id)
+        expected = session["version"]
+        change(session)
+        session["version"] = expected + 1
+        session["updated_at"] = datetime.now().isoformat()
+        if await storage_cache.compare_and_put(key, expected, session):
+            return session
+        await asyncio.sleep(random.uniform(0, 0.005 * (2 ** attempt)))
+    raise RuntimeError(f"Chat session {session_id} kept changing during update")
+
+
+async def create(user_id: str) -> Dict[str, Any]:
+    """Start an empty session"""
+    now = datetime.now().isoformat()
+    session = {
+        "id": uuid.uuid4().hex,
+        "version": 1,
+        "created_at": now,
+        "updated_at": now,
+        "summary": "",
+        "summarized_turns": 0,  # Turns folded into the summary so far
+        "turns": [],            # Turns not yet summarized, oldest first
+    }
+    await storage_cache.compare_and_put(session_key(user_id, session["id"]), None, session)
+    return session
+
+
+async def get(user_id: str, session_id: str) -> Dict[str, Any]:
+    session = await storage_cache.json_get(session_key(user_id, session_id), default=None)
+    if session is None:
+        raise SessionNotFoundError(session_id)
+    return session
+
+
+async def delete(user_id: str, session_id: str) -> None:
+    await get(user_id, session_id)
+    # Storage has no delete; an empty value reads as a missing session
+    await storage_cache.json_put(session_key(user_id, session_id), None)
+
+
+def has_history(session: Dict[str, Any]) -> bool:
+    return bool(session["summary"] or session["turns"])
+
+
+def history(session: Dict[str, Any]) -> Tuple[str, List[Dict[str, str]]]:
+    """The session's summary and its recent turns as chat messages"""
+    return session["summary"], [{"role": turn["role"], "content": turn["content"]} for turn in session["turns"]]
+
+
+async def append_turn(user_id: str, session_id: str, question: str, answer: str) -> Dict[str, Any]:
+    """Record one question and its answer"""
+    def change(session: Dict[str, Any]) -> None:
+        session["turns"].append({"role": "user", "content": question})
+        session["turns"].append({"role": "assistant", "content": answer})
+
+    return await _update(user_id, session_id, change)
+
+
+def _turns_to_fold(turns: List[Dict[str, str]]) -> int:
+    """How many of the oldest turns to fold so the rest fit in RECENT_TOKENS
+
+    The latest question and answer are always kept verbatim for follow-ups.
+    """
+    count = 0
+    while count < len(turns) - 2 and _turn_tokens(turns[count:]) > RECENT_TOKENS:
+        # Fold question and answer together
+        count += 2
+    return count
+
+
+async def summarize(user_id: str, session: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+    """Fold the oldest turns into the session summary if the recent turns are over budget"""
+    fold = _turns_to_fold(session["turns"])
+    if not fold:
+        return session
+
+    folded = session["turns"][:fold]
+    transcript = "\n\n".join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in folded)
+    response = await llm_client.chat_completion(
+        api_key,
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Summary so far:\n{session['summary'] or '(none)'}\n\nNew turns:\n{transcript}"},
+        ],
+        max_tokens=SUMMARY_TOKENS,
+        temperature=0.0
+    )
+    summary = response.choices[0].message.content.strip()
+    start = session["summarized_turns"]
+
+    def change(current: Dict[str, Any]) -> None:
+        if current["summarized_turns"] != start:
+            # Another worker folded these turns first
+            return
+        current["summary"] = summary
+        current["summarized_turns"] = start + fold
+        del current["turns"][:fold]
+
+    return await _update(user_id, session["id"], change)
+
+
+def schedule_summary(user_id: str, session: Dict[str, Any], api_key: str) -> None:
+    """Summarize in the background once the recent turns are over budget"""
+    key = session_key(user_id, session["id"])
+    if key in _summarizing or not _turns_to_fold(session["turns"]):
+        return
+
+    task = asyncio.ensure_future(summarize(user_id, session, api_key))
+    _summarizing[key] = task
+
+    def done(task: asyncio.Task) -> None:
+        _summarizing.pop(key, None)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[CHAT SESSIONS] Summarizing session {session['id']} failed: {str(task.exception())}")
+
+    task.add_done_callback(done)
+
+
+__all__ = [
+    "SessionNotFoundError",
+    "append_turn",
+    "create",
+    "delete",
+    "get",
+    "has_history",
+    "history",
+    "schedule_summary",
+    "summarize",
+]
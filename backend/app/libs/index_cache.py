@@ -0,0 +1,188 @@
+"""Per-worker cache of loaded tenant vector indexes.
+
+Loading a user's index costs storage (or disk) reads and memory, so loaded
+indexes are kept between searches. Each entry is built for one index
+generation (see `vector_index.generation`) and never changes afterwards.
+
+Entries are double-buffered. When the generation moves on, searches keep
+getting the resident snapshot while the next one is built in the
+background, then the new snapshot is swapped in. A search therefore never
+waits for a rebuild once a tenant is warm, and always scores one consistent
+generation. Writers call `schedule_refresh` after changing an index so the
+rebuild starts straight away. A search whose snapshot turned out to be too
+old to read (see `vector_index.StaleIndexError`) asks for `wait=True` to get
+the snapshot of the manifest it passes in.
+
+Resident indexes share a global memory budget (VECTOR_INDEX_MEMORY_BUDGET_MB).
+When a load would exceed it, the least recently used indexes are evicted, so
+hot tenants stay warm and cold tenants cost nothing until their next search.
+An index larger than the whole budget is served but not kept.
+
+Usage:
+
+    from app.libs import index_cache
+
+    index = await index_cache.get_index(user_id, manifest)
+    index_cache.schedule_refresh(user_id, await vector_index.remove_source(...))
+    stats = index_cache.index_cache_stats()
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from app.libs import vector_index
+from app.libs.vector_index import TenantIndex
+
+# Bytes of index data kept resident per worker
+MEMORY_BUDGET_BYTES = int(float(os.environ.get("VECTOR_INDEX_MEMORY_BUDGET_MB", "512")) * 1024 * 1024)
+
+# user_id -> (index, bytes), least recently used first
+_resident: "OrderedDict[str, Tuple[TenantIndex, int]]" = OrderedDict()
+_resident_bytes = 0
+
+# user_id -> (generation, load in progress), so concurrent searches share one load
+_loading: Dict[str, Tuple[int, asyncio.Task]] = {}
+
+_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "reloads": 0, "evictions": 0, "oversized": 0}
+
+
+def index_bytes(index: TenantIndex) -> int:
+    """Approximate memory held by an index"""
+    total = index.row_source.nbytes + index.row_segment.nbytes + index.row_offset.nbytes
+    for segment_id, vectors, live in index.segments:
+        total += live.nbytes
+        quantized = index.quantized.get(segment_id)
+        if quantized is None:
+            total += vectors.nbytes
+        else:
+            # Searches scan the quantized copy; mapped full-precision vectors are only read for rescoring
+            total += quantized.nbytes + (0 if isinstance(vectors, np.memmap) else vectors.nbytes)
+    return total
+
+
+def _evict(user_id: str) -> None:
+    global _resident_bytes
+    entry = _resident.pop(user_id, None)
+    if entry is not None:
+        _resident_bytes -= entry[1]
+
+
+def _admit(user_id: str, index: TenantIndex) -> None:
+    global _resident_bytes
+    current = _resident.get(user_id)
+    if current is not None and current[0].generation > index.generation:
+        # A newer load finished first
+        return
+    _evict(user_id)
+    size = index_bytes(index)
+    if size > MEMORY_BUDGET_BYTES:
+        _stats["oversized"] += 1
+        return
+
+    while _resident and _resident_bytes + size > MEMORY_BUDGET_BYTES:
+        _evict(next(iter(_resident)))
+        _stats["evictions"] += 1
+
+    _resident[user_id] = (index, size)
+    _resident_bytes += size
+
+
+async def _load(user_id: str, manifest: Optional[Dict[str, Any]]) -> TenantIndex:
+    current = _resident.get(user_id)
+    index = await vector_index.load_index(user_id, manifest, previous=current[0] if current else None)
+    if user_id in _resident:
+        _stats["reloads"] += 1
+    _admit(user_id, index)
+    return index
+
+
+def _start_load(user_id: str, manifest: Optional[Dict[str, Any]]) -> asyncio.Task:
+    """Build the index for manifest's generation, joining a load already in flight"""
+    generation = vector_index.generation_of(manifest)
+    pending = _loading.get(user_id)
+    if pending is not None and pending[0] >= generation:
+        return pending[1]
+
+    task = asyncio.ensure_future(_load(user_id, manifest))
+    _loading[user_id] = (generation, task)
+
+    def done(task: asyncio.Task) -> None:
+        if _loading.get(user_id, (None, None))[1] is task:
+            del _loading[user_id]
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[INDEX CACHE] Loading index for user {user_id} failed: {str(task.exception())}")
+
+    task.add_done_callback(done)
+    return task
+
+
+def schedule_refresh(user_id: str, manifest: Optional[Dict[str, Any]] = None) -> None:
+    """Rebuild a resident index in the background after its generation changed
+
+    Tenants that are not resident are left cold; their next search loads them.
+    """
+    if manifest is None or user_id not in _resident:
+        return
+    if _resident[user_id][0].generation < vector_index.generation_of(manifest):
+        _start_load(user_id, manifest)
+
+
+async def get_index(user_id: str, manifest: Optional[Dict[str, Any]] = None, wait: bool = False) -> TenantIndex:
+    """The user's index snapshot, loading it only if the tenant is cold
+
+    With wait, an older resident snapshot is not served; the call waits for
+    the one of manifest's generation instead.
+    """
+    if manifest is None:
+        manifest = await vector_index.load_manifest(user_id)
+    generation = vector_index.generation_of(manifest)
+
+    entry = _resident.get(user_id)
+    if entry is not None:
+        _resident.move_to_end(user_id)
+        if entry[0].generation >= generation:
+            _stats["hits"] += 1
+        elif wait:
+            _stats["misses"] += 1
+            return await asyncio.shield(_start_load(user_id, manifest))
+        else:
+            # Serve the current snapshot while the next one is built
+            _stats["stale_hits"] += 1
+            _start_load(user_id, manifest)
+        return entry[0]
+
+    _stats["misses"] += 1
+    return await asyncio.shield(_start_load(user_id, manifest))
+
+
+def invalidate(user_id: str) -> None:
+    """Drop a user's resident index"""
+    _evict(user_id)
+
+
+def index_cache_stats() -> Dict[str, Any]:
+    """Residency and hit-rate counters for this worker"""
+    lookups = _stats["hits"] + _stats["stale_hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate": round((_stats["hits"] + _stats["stale_hits"]) / lookups, 4) if lookups else None,
+        "loading": len(_loading),
+        "resident_tenants": len(_resident),
+        "resident_bytes": _resident_bytes,
+        "budget_bytes": MEMORY_BUDGET_BYTES,
+        "quantization": vector_index.QUANTIZATION or None,
+    }
+
+
+__all__ = [
+    "MEMORY_BUDGET_BYTES",
+    "get_index",
+    "index_bytes",
+    "index_cache_stats",
+    "invalidate",
+    "schedule_refresh",
+]
@@ -0,0 +1,128 @@
+"""Shared async OpenAI client with process-wide concurrency control.
+
+Chat completions run on one AsyncOpenAI client per worker so they never
+block the event loop. At most LLM_MAX_CONCURRENCY completions (streamed or
+not) run at once per worker; further calls wait for a slot, and the time
+they spend waiting is recorded. Each call is bounded by LLM_TIMEOUT_SECONDS.
+
+Usage:
+
+    from app.libs import llm_client
+
+    response = await llm_client.chat_completion(api_key, model="gpt-4", messages=messages)
+
+    async with llm_client.chat_completion_stream(api_key, model="gpt-4", messages=messages) as stream:
+        async for chunk in stream:
+            ...
+"""
+
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+from openai import AsyncOpenAI
+
+from app.libs.metrics import LatencyMetrics
+
+# Completions running at once per worker
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))
+
+# Seconds a completion may take; for streams, the longest gap between chunks
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "120"))
+
+_clients: Dict[str, AsyncOpenAI] = {}
+_semaphore: Optional[asyncio.Semaphore] = None
+
+_queue_wait = LatencyMetrics()
+_latency: Dict[str, LatencyMetrics] = {}
+_state = {"waiting": 0, "in_flight": 0, "timeouts": 0}
+
+
+def get_client(api_key: str) -> AsyncOpenAI:
+    """The worker's AsyncOpenAI client for an API key"""
+    client = _clients.get(api_key)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key, timeout=LLM_TIMEOUT_SECONDS)
+        _clients[api_key] = client
+    return client
+
+
+@asynccontextmanager
+async def _slot(operation: str):
+    """Hold one of the LLM_MAX_CONCURRENCY slots, recording queue wait and call latency"""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+    queued_at = time.perf_counter()
+    _state["waiting"] += 1
+    try:
+        await _semaphore.acquire()
+    finally:
+        _state["waiting"] -= 1
+    _queue_wait.record((time.perf_counter() - queued_at) * 1000)
+
+    _state["in_flight"] += 1
+    started_at = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except asyncio.TimeoutError:
+        failed = True
+        _state["timeouts"] += 1
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _state["in_flight"] -= 1
+        _semaphore.release()
+        _latency.setdefault(operation, LatencyMetrics()).record((time.perf_counter() - started_at) * 1000, failed)
+
+
+async def chat_completion(api_key: str, **params) -> Any:
+    """Run a chat completion, waiting for a free slot first"""
+    async with _slot("chat.completion"):
+        try:
+            return await asyncio.wait_for(get_client(api_key).chat.completions.create(**params), LLM_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise asyncio.TimeoutError(f"Chat completion timed out after {LLM_TIMEOUT_SECONDS:g}s")
+
+
+@asynccontextmanager
+async def chat_completion_stream(api_key: str, **params):
+    """Stream a chat completion, holding a slot until the block exits
+
+    Leaving the block early (including on cancellation) closes the stream,
+    which aborts the upstream request.
+    """
+    async with _slot("chat.stream"):
+        stream = await asyncio.wait_for(
+            get_client(api_key).chat.completions.create(stream=True, **params), LLM_TIMEOUT_SECONDS
+        )
+        try:
+            yield stream
+        finally:
+            await stream.close()
+
+
+def llm_metrics() -> Dict[str, Any]:
+    """Concurrency, queue wait and latency metrics for this worker"""
+    return {
+        **_state,
+        "max_concurrency": LLM_MAX_CONCURRENCY,
+        "queue_wait": _queue_wait.summary(),
+        "latency": {operation: metrics.summary() for operation, metrics in sorted(_latency.items())},
+    }
+
+
+__all__ = [
+    "LLM_MAX_CONCURRENCY",
+    "LLM_TIMEOUT_SECONDS",
+    "chat_completion",
+    "chat_completion_stream",
+    "get_client",
+    "llm_metrics",
+]
@@ -0,0 +1,509 @@
+"""Per-record metadata store for documents and URLs.
+
+Every record lives under its own storage key, so reading or updating a single
+document or URL costs one storage round trip no matter how many records the
+user has. A paginated index of compact entries (id, category, indexed) backs
+the list endpoints and category lookups without loading full records. Reads
+and writes go through `app.libs.storage_cache`.
+
+All writes are versioned. Record updates are compare-and-swap with retry, and
+index changes for a user are funnelled through a per-user write coalescer that
+applies every pending mutation to one fresh copy of the index and writes it
+once, so parallel indexing tasks never overwrite each other's updates.
+
+When the storage backend supports metadata queries (SQLite), records live in
+an indexed table instead and every operation below is a single SQL statement
+or transaction. A user's legacy blob is imported into the table once, on the
+first operation for that user.
+
+Usage:
+
+    from app.libs.metadata_store import documents_store
+
+    doc = await documents_store.get(user.sub, document_id)
+    docs, total = await documents_store.list(user.sub, offset=0, limit=50)
+"""
+
+import asyncio
+import random
+import re
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from app.libs import storage, storage_cache
+
+# Maximum number of entries held by a single index page
+INDEX_PAGE_SIZE = 500
+
+# Largest page of records the list endpoints return
+MAX_PAGE_SIZE = 1000
+
+# Record fields mirrored into the compact index entries
+INDEX_FIELDS = ("category", "indexed")
+
+# Attempts made by a compare-and-swap write before giving up
+MAX_CAS_RETRIES = 8
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a versioned write keeps losing to concurrent writers"""
+
+
+def sanitize_storage_key(key: str) -> str:
+    """Sanitize storage key to only allow alphanumeric and ._- symbols"""
+    # Remove slashes first
+    key = key.replace("/", "")
+    # Then filter other characters
+    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+
+
+async def _read_json(key: str, fresh: bool = False) -> Optional[Any]:
+    return await storage_cache.json_get(key, default=None, fresh=fresh)
+
+
+def _index_entry(record: Dict[str, Any], version: int) -> Dict[str, Any]:
+    entry = {"id": record["id"], "version": version}
+    for field in INDEX_FIELDS:
+        entry[field] = record.get(field)
+    return entry
+
+
+async def _backoff(attempt: int) -> None:
+    await asyncio.sleep(random.uniform(0, 0.005 * (2 ** attempt)))
+
+
+class _IndexState:
+    """A fresh snapshot of one user's index head and the pages touched so far"""
+
+    def __init__(self, store: "MetadataStore", user_id: str, head: Optional[Dict[str, Any]]):
+        self.store = store
+        self.user_id = user_id
+        self.head_version = head.get("version", 0) if head else None
+        self.head = head or {"version": 0, "next_page": 0, "pages": []}
+        self.pages: Dict[int, Dict[str, Any]] = {}
+        self.page_versions: Dict[int, Optional[int]] = {}
+        self.dirty = set()
+
+    @classmethod
+    async def load(cls, store: "MetadataStore", user_id: str) -> "_IndexState":
+        return cls(store, user_id, await _read_json(store._head_key(user_id), fresh=True))
+
+    async def page(self, page_id: int) -> List[Dict[str, Any]]:
+        if page_id not in self.pages:
+            page = await _read_json(self.store._page_key(self.user_id, page_id), fresh=True)
+            self.page_versions[page_id] = page.get("version", 0) if page else None
+            self.pages[page_id] = page or {"version": 0, "entries": []}
+        return self.pages[page_id]["entries"]
+
+    def page_info(self, page_id: int) -> Optional[Dict[str, Any]]:
+        for info in self.head["pages"]:
+            if info["id"] == page_id:
+                return info
+        return None
+
+    def touch(self, page_id: int) -> None:
+        self.dirty.add(page_id)
+        info = self.page_info(page_id)
+        if info is not None:
+            info["count"] = len(self.pages[page_id]["entries"])
+
+    async def commit(self) -> bool:
+        """Write dirty pages, then the head, each guarded by its version"""
+        for page_id in sorted(self.dirty):
+            page = self.pages[page_id]
+            expected = self.page_versions[page_id]
+            page["version"] = (expected or 0) + 1
+            if not await storage_cache.compare_and_put(
+                self.store._page_key(self.user_id, page_id), expected, page
+            ):
+                return False
+
+        if self.dirty or self.head_version is None:
+            self.head["version"] = (self.head_version or 0) + 1
+            if not await storage_cache.compare_and_put(
+                self.store._head_key(self.user_id), self.head_version, self.head
+            ):
+                return False
+        return True
+
+
+class _IndexWriter:
+    """Coalesces concurrent index mutations for one user into a single write
+
+    Mutations are idempotent coroutine functions of an _IndexState, so a batch
+    can be re-applied to a fresh snapshot when a write loses a version race.
+    """
+
+    def __init__(self, store: "MetadataStore", user_id: str):
+        self.store = store
+        self.user_id = user_id
+        self.pending: List[Tuple[Callable[[_IndexState], Any], asyncio.Future]] = []
+        self.flushing = False
+        # The running flush; held so the event loop cannot garbage-collect it mid-batch
+        self.task: Optional[asyncio.Task] = None
+
+    async def submit(self, mutation: Callable[[_IndexState], Any]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((mutation, future))
+        if not self.flushing:
+            self.flushing = True
+            self.task = asyncio.create_task(self._flush())
+            self.task.add_done_callback(self._flushed)
+        return await future
+
+    async def _flush(self) -> None:
+        try:
+            # Yield once so mutations submitted in the same tick join the batch
+            await asyncio.sleep(0)
+            while self.pending:
+                batch, self.pending = self.pending, []
+                try:
+                    results = await self._apply(batch)
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self.flushing = False
+            self.store._writers.pop(self.user_id, None)
+
+    def _flushed(self, task: asyncio.Task) -> None:
+        if self.task is task:
+            self.task = None
+
+    async def _apply(self, batch) -> List[Any]:
+        for attempt in range(MAX_CAS_RETRIES):
+            state = await _IndexState.load(self.store, self.user_id)
+            if state.head_version is None:
+                # Migrate the legacy blob before the first change to this user's index
+                await self.store._migrate_legacy(state)
+            results = [await mutation(state) for mutation, _ in batch]
+            if await state.commit():
+                return results
+            await _backoff(attempt)
+        raise ConcurrentUpdateError(f"Index for user {self.user_id} kept changing during update")
+
+
+class MetadataStore:
+    """Metadata records of one kind ("documents" or "urls") for all users.
+
+    Storage layout per user:
+
+        {kind}_index/{user}            head: version, page list with entry counts
+        {kind}_index/{user}/page_{n}   versioned compact index entries
+        {kind}_records/{user}/{id}     {"version", "page", "record"} envelope
+
+    A new record is written before its index entry, so every listed entry
+    has a record; its envelope gets the page once the entry is appended.
+
+    Users that still have the legacy single-blob layout ({kind}_meta/{user})
+    are migrated transparently on first access.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self._writers: Dict[str, _IndexWriter] = {}
+        # Users whose legacy blob this process has already imported into the SQL table
+        self._sql_imported: Set[str] = set()
+
+    # Storage keys
+    def _head_key(self, user_id: str) -> str:
+        return sanitize_storage_key(f"{self.kind}_index/{user_id}")
+
+    def _page_key(self, user_id: str, page_id: int) -> str:
+        return sanitize_storage_key(f"{self.kind}_index/{user_id}/page_{page_id}")
+
+    def _record_key(self, user_id: str, record_id: str) -> str:
+        return sanitize_storage_key(f"{self.kind}_records/{user_id}/{record_id}")
+
+    def _legacy_key(self, user_id: str) -> str:
+        return sanitize_storage_key(f"{self.kind}_meta/{user_id}")
+
+    # Index reads
+    async def _load_head(self, user_id: str) -> Dict[str, Any]:
+        head = await _read_json(self._head_key(user_id))
+        if head is None:
+            # No index yet: create it, migrating any legacy blob on the way
+            async def noop(state: _IndexState) -> None:
+                return None
+
+            await self._mutate_index(user_id, noop)
+            head = await _read_json(self._head_key(user_id)) or {"pages": []}
+        return head
+
+    async def _load_pages(self, user_id: str, page_ids: List[int]) -> List[Dict[str, Any]]:
+        pages = await storage_cache.json_get_many(
+            [self._page_key(user_id, page_id) for page_id in page_ids], default=None
+        )
+        entries = []
+        for page in pages:
+            if page:
+                entries.extend(page["entries"])
+        return entries
+
+    async def _migrate_legacy(self, state: _IndexState) -> None:
+        """Split a legacy {kind}_meta blob into per-record keys and index pages"""
+        legacy = await _read_json(self._legacy_key(state.user_id))
+        records = (legacy or {}).get(self.kind, [])
+
+        if records:
+            print(f"[METADATA] Migrating {len(records)} {self.kind} for user {state.user_id}")
+
+        for start in range(0, len(records), INDEX_PAGE_SIZE):
+            page_id = state.head["next_page"]
+            page_records = records[start:start + INDEX_PAGE_SIZE]
+            await asyncio.gather(*(
+                storage_cache.json_put(
+                    self._record_key(state.user_id, record["id"]),
+                    {"version": 1, "page": page_id, "record": record},
+                )
+                for record in page_records
+            ))
+            state.head["pages"].append({"id": page_id, "count": 0})
+            state.head["next_page"] = page_id + 1
+            (await state.page(page_id)).extend(_index_entry(r, 1) for r in page_records)
+            state.touch(page_id)
+
+    async def _mutate_index(self, user_id: str, mutation: Callable[[_IndexState], Any]) -> Any:
+        writer = self._writers.get(user_id)
+        if writer is None:
+            writer = self._writers[user_id] = _IndexWriter(self, user_id)
+        return await writer.submit(mutation)
+
+    # Records
+    async def _load_envelope(self, user_id: str, record_id: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        envelope = await _read_json(self._record_key(user_id, record_id), fresh=fresh)
+        if envelope is None and await _read_json(self._head_key(user_id)) is None:
+            # Record keys only exist once the user has been migrated
+            await self._load_head(user_id)
+            envelope = await _read_json(self._record_key(user_id, record_id))
+        if envelope is None or envelope.get("deleted"):
+            return None
+        return envelope
+
+    async def _swap_record(
+        self,
+        user_id: str,
+        record_id: str,
+        change: Callable[[Dict[str, Any]], Dict[str, Any]],
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Compare-and-swap a record envelope, returning (old, new) or None if missing"""
+        key = self._record_key(user_id, record_id)
+        for attempt in range(MAX_CAS_RETRIES):
+            envelope = await self._load_envelope(user_id, record_id, fresh=attempt > 0)
+            if envelope is None:
+                return None
+            new_envelope = change(envelope)
+            new_envelope["version"] = envelope["version"] + 1
+            if await storage_cache.compare_and_put(key, envelope["version"], new_envelope):
+                return envelope, new_envelope
+            await _backoff(attempt)
+        raise ConcurrentUpdateError(f"Record {record_id} kept changing during update")
+
+    # Backends with native metadata queries
+    @property
+    def _use_sql(self) -> bool:
+        return storage.backend().supports_metadata_queries
+
+    async def _sql(self, operation: str, user_id: str, *args) -> Any:
+        if user_id not in self._sql_imported:
+            await self._import_legacy_sql(user_id)
+        method = getattr(storage.backend(), f"metadata_{operation}")
+        return await storage.run(f"metadata.{operation}", method, self.kind, user_id, *args)
+
+    async def _import_legacy_sql(self, user_id: str) -> None:
+        """Copy a legacy {kind}_meta blob into the metadata table, once per user"""
+        legacy = await _read_json(self._legacy_key(user_id))
+        records = (legacy or {}).get(self.kind, [])
+        if records:
+            imported = await storage.run(
+                "metadata.import", storage.backend().metadata_import, self.kind, user_id, records
+            )
+            if imported:
+                print(f"[METADATA] Imported {imported} {self.kind} for user {user_id}")
+        self._sql_imported.add(user_id)
+
+    # Public API
+    async def get(self, user_id: str, record_id: str) -> Optional[Dict[str, Any]]:
+        """Get a single record, or None if it does not exist"""
+        if self._use_sql:
+            return await self._sql("get", user_id, record_id)
+        envelope = await self._load_envelope(user_id, record_id)
+        return envelope["record"] if envelope else None
+
+    async def entries(self, user_id: str) -> List[Dict[str, Any]]:
+        """Get the compact index entries for all of the user's records"""
+        if self._use_sql:
+            return await self._sql("entries", user_id)
+        head = await self._load_head(user_id)
+        return await self._load_pages(user_id, [page["id"] for page in head["pages"]])
+
+    async def list(
+        self,
+        user_id: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        ids: Optional[List[str]] = None,
+        categories: Optional[List[str]] = None,
+        indexed: Optional[bool] = None,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """List records in insertion order, returning (records, total matches)
+
+        Without filters only the index pages that overlap the requested window
+        are read. Filters are evaluated against the compact index entries, so
+        full records are only fetched for the returned window.
+        """
+        if self._use_sql:
+            return await self._sql("list", user_id, offset, limit, ids, categories, indexed)
+
+        head = await self._load_head(user_id)
+        filtered = ids is not None or categories is not None or indexed is not None
+
+        if filtered:
+            wanted_ids = set(ids) if ids is not None else None
+            matches = [
+                entry for entry in await self.entries(user_id)
+                if (wanted_ids is None or entry["id"] in wanted_ids)
+                and (categories is None or entry.get("category") in categories)
+                and (indexed is None or bool(entry.get("indexed")) == indexed)
+            ]
+            total = len(matches)
+            end = total if limit is None else offset + limit
+            window = matches[offset:end]
+        else:
+            total = sum(page["count"] for page in head["pages"])
+            end = total if limit is None else min(total, offset + limit)
+            # Only read the pages that overlap the requested window
+            page_ids = []
+            page_start = 0
+            window_start = None
+            for page in head["pages"]:
+                page_end = page_start + page["count"]
+                if page_end > offset and page_start < end:
+                    if window_start is None:
+                        window_start = page_start
+                    page_ids.append(page["id"])
+                page_start = page_end
+            entries = await self._load_pages(user_id, page_ids)
+            skip = offset - (window_start or 0)
+            window = entries[skip:skip + (end - offset)]
+
+        envelopes = await storage_cache.json_get_many(
+            [self._record_key(user_id, entry["id"]) for entry in window], default=None
+        )
+        records = [
+            envelope["record"] for envelope in envelopes
+            if envelope and not envelope.get("deleted")
+        ]
+        return records, total
+
+    async def categories(self, user_id: str) -> List[str]:
+        """List the distinct categories used by the user's records"""
+        if self._use_sql:
+            return await self._sql("categories", user_id)
+        categories = set()
+        for entry in await self.entries(user_id):
+            if entry.get("category"):
+                categories.add(entry["category"])
+        return list(categories)
+
+    async def create(self, user_id: str, record: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a new record and append it to the index"""
+        if self._use_sql:
+            await self._sql("insert", user_id, record)
+            return record
+
+        record_id = record["id"]
+        await storage_cache.json_put(
+            self._record_key(user_id, record_id),
+            {"version": 1, "page": None, "record": record},
+        )
+
+        async def append(state: _IndexState) -> int:
+            last = state.head["pages"][-1] if state.head["pages"] else None
+            if last is not None and last["count"] < INDEX_PAGE_SIZE:
+                page_id = last["id"]
+            else:
+                page_id = state.head["next_page"]
+                state.head["pages"].append({"id": page_id, "count": 0})
+                state.head["next_page"] = page_id + 1
+            entries = await state.page(page_id)
+            if not any(e["id"] == record_id for e in entries):
+                entries.append(_index_entry(record, 1))
+                state.touch(page_id)
+            return page_id
+
+        page_id = await self._mutate_index(user_id, append)
+        await self._swap_record(user_id, record_id, lambda envelope: {**envelope, "page": page_id})
+        return record
+
+    async def update(self, user_id: str, record_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply field updates to a record, returning the updated record or None"""
+        if self._use_sql:
+            return await self._sql("update", user_id, record_id, fields)
+
+        def change(envelope: Dict[str, Any]) -> Dict[str, Any]:
+            return {**envelope, "record": {**envelope["record"], **fields}}
+
+        swapped = await self._swap_record(user_id, record_id, change)
+        if swapped is None:
+            return None
+
+        old, new = swapped
+        if any(old["record"].get(f) != new["record"].get(f) for f in INDEX_FIELDS):
+            await self._mutate_index(
+                user_id, self._replace_entry(new["page"], new["record"], new["version"])
+            )
+        return new["record"]
+
+    async def delete(self, user_id: str, record_id: str) -> Optional[Dict[str, Any]]:
+        """Delete a record, returning the deleted record or None if it did not exist"""
+        if self._use_sql:
+            return await self._sql("delete", user_id, record_id)
+
+        # Storage has no delete, so leave a tombstone under the record key
+        def change(envelope: Dict[str, Any]) -> Dict[str, Any]:
+            return {"page": envelope["page"], "deleted": True}
+
+        swapped = await self._swap_record(user_id, record_id, change)
+        if swapped is None:
+            return None
+
+        old, new = swapped
+
+        async def remove(state: _IndexState) -> None:
+            entries = await state.page(new["page"])
+            kept = [e for e in entries if e["id"] != record_id]
+            if len(kept) != len(entries):
+                state.pages[new["page"]]["entries"] = kept
+                state.touch(new["page"])
+
+        await self._mutate_index(user_id, remove)
+        return old["record"]
+
+    @staticmethod
+    def _replace_entry(page_id: int, record: Dict[str, Any], version: int):
+        async def replace(state: _IndexState) -> None:
+            entries = await state.page(page_id)
+            for i, entry in enumerate(entries):
+                # Skip if a newer version of the record already reached the index
+                if entry["id"] == record["id"] and entry.get("version", 0) < version:
+                    entries[i] = _index_entry(record, version)
+                    state.touch(page_id)
+        return replace
+
+
+documents_store = MetadataStore("documents")
+urls_store = MetadataStore("urls")
+
+__all__ = [
+    "INDEX_PAGE_SIZE",
+    "MAX_PAGE_SIZE",
+    "ConcurrentUpdateError",
+    "MetadataStore",
+    "documents_store",
+    "urls_store",
+]
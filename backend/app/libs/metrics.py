@@ -0,0 +1,54 @@
+"""In-process latency metrics.
+
+Usage:
+
+    from app.libs.metrics import LatencyMetrics
+
+    metrics = LatencyMetrics()
+    metrics.record(elapsed_ms, failed=False)
+    summary = metrics.summary()
+"""
+
+from collections import deque
+from typing import Any, Dict
+
+# Number of recent latency samples kept per metric for percentiles
+LATENCY_SAMPLES = 1024
+
+
+class LatencyMetrics:
+    """Call count, error count and latency percentiles of one operation"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, elapsed_ms: float, failed: bool = False) -> None:
+        self.calls += 1
+        self.errors += int(failed)
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.samples.append(elapsed_ms)
+
+    def summary(self) -> Dict[str, Any]:
+        samples = sorted(self.samples)
+
+        def percentile(p: float):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 2) if samples else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(self.total_ms / self.calls, 2) if self.calls else None,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(self.max_ms, 2),
+        }
+
+
+__all__ = [
+    "LatencyMetrics",
+]
@@ -0,0 +1,136 @@
+"""Multi-query retrieval: query variants and reciprocal-rank fusion.
+
+Short or ambiguous questions ("dose in CKD?", "and for children?") often
+embed poorly. In multi-query mode a search is run for a few variants of the
+question and the rankings are fused, so a chunk that several variants rank
+highly beats one that only the literal question happens to match.
+
+Variants are derived from the text without a model call, so they cost one
+batched embedding request and one matrix-matrix product over the index:
+
+- the question as asked,
+- its content words, without question words and filler,
+- the question with common clinical abbreviations spelled out,
+- for follow-ups, the previous question followed by this one, so that "and
+  for children?" is searched in the context it was asked in.
+
+Rankings are fused with reciprocal-rank fusion: every variant contributes
+1 / (MULTI_QUERY_RRF_K + rank) for each chunk in its top MULTI_QUERY_RRF_DEPTH.
+
+Usage:
+
+    from app.libs import multi_query
+
+    variants = multi_query.variants(query, earlier_questions)
+    fused = multi_query.reciprocal_rank_fusion(scores)  # scores: variants x chunks
+"""
+
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Most variants searched per query, the question itself included
+MAX_VARIANTS = int(os.environ.get("MULTI_QUERY_MAX_VARIANTS", "4"))
+
+# RRF smoothing constant; larger values flatten the gap between ranks
+RRF_K = int(os.environ.get("MULTI_QUERY_RRF_K", "60"))
+
+# Ranks each variant contributes to the fusion
+RRF_DEPTH = int(os.environ.get("MULTI_QUERY_RRF_DEPTH", "50"))
+
+_WORD = re.compile(r"[\w\-]+")
+
+# Question words and filler that carry no topic
+_STOPWORDS = frozenset("""
+a about after all also an and any are as at be been before being between both but by can could
+did do does doing for from had has have how i if in into is it its me my of on or our should so
+some such than that the their them then there these they this those to under up was we were what
+when where which while who whom why will with would you your please tell explain describe give
+""".split())
+
+# Common clinical abbreviations and their expansions
+_ABBREVIATIONS: Dict[str, str] = {
+    "ace": "angiotensin-converting enzyme",
+    "af": "atrial fibrillation",
+    "aki": "acute kidney injury",
+    "bmi": "body mass index",
+    "bp": "blood pressure",
+    "ckd": "chronic kidney disease",
+    "copd": "chronic obstructive pulmonary disease",
+    "cvd": "cardiovascular disease",
+    "dvt": "deep vein thrombosis",
+    "egfr": "estimated glomerular filtration rate",
+    "gp": "general practitioner",
+    "hba1c": "glycated haemoglobin",
+    "hf": "heart failure",
+    "htn": "hypertension",
+    "mi": "myocardial infarction",
+    "nsaid": "non-steroidal anti-inflammatory drug",
+    "nsaids": "non-steroidal anti-inflammatory drugs",
+    "pe": "pulmonary embolism",
+    "t1dm": "type 1 diabetes mellitus",
+    "t2dm": "type 2 diabetes mellitus",
+    "tia": "transient ischaemic attack",
+    "uti": "urinary tract infection",
+}
+
+
+def _keywords(query: str) -> str:
+    return " ".join(word for word in _WORD.findall(query) if word.lower() not in _STOPWORDS)
+
+
+def _expand_abbreviations(query: str) -> str:
+    def expand(match: "re.Match") -> str:
+        expansion = _ABBREVIATIONS.get(match.group(0).lower())
+        return f"{match.group(0)} ({expansion})" if expansion else match.group(0)
+
+    return _WORD.sub(expand, query)
+
+
+def variants(query: str, earlier_questions: Optional[List[str]] = None) -> List[str]:
+    """The distinct variants to search for query, the query itself first
+
+    earlier_questions are the conversation's previous questions, oldest first.
+    """
+    candidates = [query, _expand_abbreviations(query)]
+    if earlier_questions:
+        candidates.append(f"{earlier_questions[-1]} {query}")
+    candidates.append(_keywords(query))
+
+    # Drop empty variants and ones that differ only in case and spacing
+    seen = set()
+    distinct = []
+    for candidate in candidates:
+        key = " ".join(candidate.lower().split())
+        if key and key not in seen:
+            seen.add(key)
+            distinct.append(candidate.strip())
+    return distinct[:max(MAX_VARIANTS, 1)]
+
+
+def reciprocal_rank_fusion(scores: np.ndarray, depth: int = RRF_DEPTH, k: int = RRF_K) -> np.ndarray:
+    """Fused score of every column of a (variants, chunks) score matrix
+
+    Each row is one variant's ranking; -inf marks chunks it must not rank.
+    """
+    fused = np.zeros(scores.shape[1], dtype=np.float64)
+    depth = min(depth, scores.shape[1])
+    if depth <= 0:
+        return fused
+    for row in scores:
+        top = np.argpartition(-row, depth - 1)[:depth]
+        top = top[np.argsort(-row[top], kind="stable")]
+        top = top[np.isfinite(row[top])]
+        fused[top] += 1.0 / (k + np.arange(1, len(top) + 1))
+    return fused
+
+
+__all__ = [
+    "MAX_VARIANTS",
+    "RRF_DEPTH",
+    "RRF_K",
+    "reciprocal_rank_fusion",
+    "variants",
+]
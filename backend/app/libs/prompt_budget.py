@@ -0,0 +1,126 @@
+"""Token budgets for chat prompts.
+
+A chat prompt has four sections that share the model's context window: the
+system prompt, the conversation history, the repository context and the
+answer. The system prompt and the new question are always sent in full and
+ANSWER_TOKENS are reserved for the answer. History gets at most
+HISTORY_TOKENS and repository context at most CONTEXT_TOKENS of what is left.
+
+When a section is over budget, its lowest-value parts go first: the oldest
+history messages, and the lowest-ranked context blocks. The part that
+straddles the limit is truncated if enough room is left for it to be useful,
+and dropped otherwise.
+
+Usage:
+
+    from app.libs import prompt_budget
+
+    tokens = prompt_budget.count_tokens(text)
+    history, history_tokens = prompt_budget.fit_messages(history, prompt_budget.HISTORY_TOKENS)
+    blocks, context_tokens = prompt_budget.fit_blocks(blocks, budget)
+"""
+
+import os
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import tiktoken
+
+# Model the prompts are counted for
+MODEL = os.environ.get("PROMPT_MODEL", "gpt-4")
+
+# Context window of MODEL, shared by prompt and answer
+CONTEXT_WINDOW_TOKENS = int(os.environ.get("PROMPT_CONTEXT_WINDOW_TOKENS", "8192"))
+
+# Tokens reserved for the answer (the completion's max_tokens)
+ANSWER_TOKENS = int(os.environ.get("PROMPT_ANSWER_TOKENS", "1500"))
+
+# Most tokens spent on conversation history and on repository context
+HISTORY_TOKENS = int(os.environ.get("PROMPT_HISTORY_TOKENS", "1500"))
+CONTEXT_TOKENS = int(os.environ.get("PROMPT_CONTEXT_TOKENS", "4000"))
+
+# A message or block cut shorter than this is dropped instead
+MIN_TRUNCATED_TOKENS = 64
+
+# Role and separator tokens added to every chat message, and priming for the reply
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text, disallowed_special=()))
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    """Tokens one chat message adds to a prompt"""
+    return MESSAGE_OVERHEAD_TOKENS + count_tokens(message["content"])
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """The start of text, at most max_tokens long"""
+    tokens = _encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _encoding().decode(tokens[:max(max_tokens, 0)])
+
+
+def fit_messages(messages: List[Dict[str, str]], max_tokens: int) -> Tuple[List[Dict[str, str]], int]:
+    """The most recent messages that fit in max_tokens, oldest first, and their token count"""
+    kept = []
+    used = 0
+    for message in reversed(messages):
+        tokens = message_tokens(message)
+        if used + tokens > max_tokens:
+            room = max_tokens - used - MESSAGE_OVERHEAD_TOKENS
+            if room >= MIN_TRUNCATED_TOKENS:
+                message = {**message, "content": truncate(message["content"], room)}
+                kept.append(message)
+                used += message_tokens(message)
+            break
+        kept.append(message)
+        used += tokens
+    kept.reverse()
+    return kept, used
+
+
+def fit_blocks(blocks: List[str], max_tokens: int) -> Tuple[List[str], int]:
+    """The leading blocks that fit in max_tokens, and their token count
+
+    Blocks are expected best first, so the ones dropped are the least relevant.
+    """
+    kept = []
+    used = 0
+    for block in blocks:
+        tokens = count_tokens(block)
+        if used + tokens > max_tokens:
+            room = max_tokens - used
+            if room >= MIN_TRUNCATED_TOKENS:
+                block = truncate(block, room)
+                kept.append(block)
+                used += count_tokens(block)
+            break
+        kept.append(block)
+        used += tokens
+    return kept, used
+
+
+__all__ = [
+    "ANSWER_TOKENS",
+    "CONTEXT_TOKENS",
+    "CONTEXT_WINDOW_TOKENS",
+    "HISTORY_TOKENS",
+    "REPLY_OVERHEAD_TOKENS",
+    "count_tokens",
+    "fit_blocks",
+    "fit_messages",
+    "message_tokens",
+    "truncate",
+]
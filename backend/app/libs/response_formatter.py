@@ -0,0 +1,139 @@
+"""Incremental formatting of chat completions.
+
+`ResponseFormatter` consumes a completion chunk by chunk, as it streams, and
+in the same single pass:
+
+- takes the confidence tag ("[HIGH CONFIDENCE]" etc.) off the start of the
+  answer and records the level,
+- collects [Document: ...], [URL: ...] and legacy [Document ID: ...]
+  citations,
+- normalizes the Markdown: lines of running text are joined into
+  paragraphs, bullet and numbered list items and headings stay on their own
+  lines, and blocks are separated by one blank line.
+
+`feed` returns the formatted Markdown that became final with the chunk, so
+callers can forward it immediately; `close` returns the rest. A paragraph
+is final once the line after it shows it has ended, and nothing is emitted
+until the confidence tag has been looked for in the first
+CONFIDENCE_TAG_WINDOW characters.
+
+Usage:
+
+    from app.libs.response_formatter import ResponseFormatter
+
+    formatter = ResponseFormatter()
+    for chunk in completion:
+        send(formatter.feed(chunk))
+    send(formatter.close())
+    formatter.text, formatter.confidence_level, formatter.document_citations
+"""
+
+import re
+from typing import List, Optional
+
+# Confidence tags, in the order they are looked for
+CONFIDENCE_LEVELS = ("HIGH CONFIDENCE", "MODERATE CONFIDENCE", "LOW CONFIDENCE", "INSUFFICIENT DATA")
+
+# The confidence tag only counts within this many leading characters
+CONFIDENCE_TAG_WINDOW = 100
+
+_DOCUMENT_CITATION = re.compile(r'\[Document: ([^\]]+)\]')
+_URL_CITATION = re.compile(r'\[URL: ([^\]]+)\]')
+_DOCUMENT_ID_CITATION = re.compile(r'\[Document ID: ([^\]]+)\]')
+
+# Lines that form a block of their own: bullet and numbered list items, headings
+_BLOCK_LINE = re.compile(r'^(?:[\*\-]\s+|\d+[.)]\s+|#{1,6}\s)')
+
+
+class ResponseFormatter:
+    """Single-pass Markdown normalizer and citation extractor for one completion"""
+
+    def __init__(self):
+        self.confidence_level: Optional[str] = None
+        self.document_citations: List[str] = []
+        self.url_citations: List[str] = []
+        self.document_id_citations: List[str] = []
+
+        self._head: Optional[str] = ""  # Text held back until the confidence tag is settled
+        self._line = ""                 # Incomplete last line
+        self._paragraph: List[str] = []
+        self._blocks = 0
+        self._output: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """Everything formatted so far"""
+        return "".join(self._output)
+
+    @property
+    def has_citations(self) -> bool:
+        return bool(self.document_citations or self.url_citations or self.document_id_citations)
+
+    def feed(self, chunk: str) -> str:
+        """Consume the next piece of the completion, returning newly formatted Markdown"""
+        start = len(self._output)
+        if self._head is not None:
+            self._head += chunk
+            if len(self._head.lstrip()) < CONFIDENCE_TAG_WINDOW:
+                return ""
+            chunk = self._take_confidence_tag()
+        self._consume(chunk)
+        return "".join(self._output[start:])
+
+    def close(self) -> str:
+        """Finish the completion, returning the rest of the formatted Markdown"""
+        start = len(self._output)
+        if self._head is not None:
+            self._consume(self._take_confidence_tag())
+        if self._line:
+            self._consume_line(self._line)
+            self._line = ""
+        self._end_paragraph()
+        return "".join(self._output[start:])
+
+    def _take_confidence_tag(self) -> str:
+        text = self._head.lstrip()
+        self._head = None
+        for level in CONFIDENCE_LEVELS:
+            tag = f"[{level}]"
+            if tag in text[:CONFIDENCE_TAG_WINDOW]:
+                self.confidence_level = level
+                return text.replace(tag, "", 1).lstrip()
+        return text
+
+    def _consume(self, chunk: str) -> None:
+        lines = (self._line + chunk).split("\n")
+        self._line = lines.pop()
+        for line in lines:
+            self._consume_line(line)
+
+    def _consume_line(self, line: str) -> None:
+        self.document_citations.extend(_DOCUMENT_CITATION.findall(line))
+        self.url_citations.extend(_URL_CITATION.findall(line))
+        self.document_id_citations.extend(_DOCUMENT_ID_CITATION.findall(line))
+
+        line = line.strip()
+        if not line:
+            self._end_paragraph()
+        elif _BLOCK_LINE.match(line):
+            self._end_paragraph()
+            self._emit(line)
+        else:
+            self._paragraph.append(line)
+
+    def _end_paragraph(self) -> None:
+        if self._paragraph:
+            self._emit(" ".join(self._paragraph))
+            self._paragraph = []
+
+    def _emit(self, block: str) -> None:
+        if self._blocks:
+            self._output.append("\n\n")
+        self._output.append(block)
+        self._blocks += 1
+
+
+__all__ = [
+    "CONFIDENCE_LEVELS",
+    "ResponseFormatter",
+]
@@ -0,0 +1,122 @@
+"""Micro-batching of concurrent searches against the same index.
+
+Scoring a query means one matrix-vector product over every vector of a
+tenant's index, which is bound by memory bandwidth: the whole index is read
+for a single query. When many users of one organisation search at the same
+moment, `similarities` collects their queries for up to
+SEARCH_BATCH_WINDOW_MS and scores them together in one matrix-matrix
+product, which reads the index once for the whole batch and lets BLAS use
+the cache and all its vector units. Each caller then gets back the rows for
+its own queries and ranks them with its own filters.
+
+A batch is scored early once it holds SEARCH_BATCH_MAX_QUERIES queries.
+Batches are per index snapshot (tenant and generation), so a search never
+waits on another tenant's. Set SEARCH_BATCH_WINDOW_MS to 0 to score every
+search on its own.
+
+Usage:
+
+    from app.libs import search_batcher
+
+    semantic_scores = await search_batcher.similarities(index, query_embeddings)
+"""
+
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.libs import vector_index
+
+# How long the first search of a batch waits for others to join
+WINDOW_MS = float(os.environ.get("SEARCH_BATCH_WINDOW_MS", "2"))
+
+# Queries scored together at most
+MAX_QUERIES = int(os.environ.get("SEARCH_BATCH_MAX_QUERIES", "64"))
+
+
+class _Batch:
+    """Queries waiting to be scored against one index snapshot"""
+
+    def __init__(self, index: vector_index.TenantIndex):
+        self.index = index
+        self.queries: List[List[float]] = []
+        self.waiters: List[Tuple[asyncio.Future, int, int]] = []  # (future, first row, row count)
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+# (tenant, generation) -> batch being collected
+_batches: Dict[Tuple[str, int], _Batch] = {}
+
+_stats = {"searches": 0, "batches": 0, "queries": 0, "largest_batch": 0}
+
+
+def _flush(key: Tuple[str, int], batch: _Batch) -> None:
+    if _batches.get(key) is batch:
+        del _batches[key]
+    if batch.timer is not None:
+        batch.timer.cancel()
+
+    _stats["batches"] += 1
+    _stats["queries"] += len(batch.queries)
+    _stats["largest_batch"] = max(_stats["largest_batch"], len(batch.queries))
+    try:
+        scores = batch.index.similarities_many(batch.queries)
+    except Exception as e:
+        for future, _, _ in batch.waiters:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for future, start, count in batch.waiters:
+        # Callers that went away no longer wait for their rows
+        if not future.done():
+            future.set_result(scores[start:start + count])
+
+
+async def similarities(index: vector_index.TenantIndex, query_embeddings: List[List[float]]) -> np.ndarray:
+    """Cosine similarity of each query against every row of index, one row per query
+
+    The queries are scored together with any other searches of the same
+    index that arrive within the batching window.
+    """
+    _stats["searches"] += 1
+    if WINDOW_MS <= 0 or len(query_embeddings) >= MAX_QUERIES:
+        _stats["batches"] += 1
+        _stats["queries"] += len(query_embeddings)
+        return index.similarities_many(query_embeddings)
+
+    key = (index.user_id, index.generation)
+    batch = _batches.get(key)
+    if batch is not None and len(batch.queries) + len(query_embeddings) > MAX_QUERIES:
+        # No room left; score the waiting batch now and start a new one
+        _flush(key, batch)
+        batch = None
+    loop = asyncio.get_running_loop()
+    if batch is None:
+        batch = _Batch(index)
+        _batches[key] = batch
+        batch.timer = loop.call_later(WINDOW_MS / 1000, _flush, key, batch)
+
+    future = loop.create_future()
+    batch.waiters.append((future, len(batch.queries), len(query_embeddings)))
+    batch.queries.extend(query_embeddings)
+    if len(batch.queries) >= MAX_QUERIES:
+        _flush(key, batch)
+    return await future
+
+
+def search_batcher_stats() -> Dict[str, Any]:
+    """How many searches were scored and in how many matrix products"""
+    return {
+        **_stats,
+        "average_batch_size": round(_stats["queries"] / _stats["batches"], 2) if _stats["batches"] else None,
+        "window_ms": WINDOW_MS,
+        "pending": sum(len(batch.queries) for batch in _batches.values()),
+    }
+
+
+__all__ = [
+    "search_batcher_stats",
+    "similarities",
+]
@@ -0,0 +1,99 @@
+"""Per-worker cache of ranked search results.
+
+Entries are keyed by tenant, index generation, normalized query text, top_k
+and filters. The generation is that of the index snapshot the results were
+ranked against (see `vector_index.generation`), so indexing, updating or
+deleting a document or URL makes a tenant's older entries unreachable
+without any explicit invalidation; they age out of the LRU.
+
+A hit skips both the query embedding call and ranking.
+
+Usage:
+
+    from app.libs import search_cache
+
+    key = search_cache.make_key(user_id, index.generation, query, top_k, document_ids, url_ids, categories)
+    results = search_cache.get(key)
+    if results is None:
+        results = ...
+        search_cache.put(key, results)
+"""
+
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Maximum number of result lists kept per worker
+MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "2048"))
+
+_entries: "OrderedDict[Tuple, List[Any]]" = OrderedDict()
+
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def normalize_query(query: str) -> str:
+    """Case and whitespace insensitive form of a query"""
+    return " ".join(query.lower().split())
+
+
+def _filter_key(values: Optional[List[str]]) -> Tuple[str, ...]:
+    return tuple(sorted(set(values))) if values else ()
+
+
+def make_key(
+    user_id: str,
+    generation: int,
+    query: str,
+    top_k: int,
+    document_ids: Optional[List[str]] = None,
+    url_ids: Optional[List[str]] = None,
+    categories: Optional[List[str]] = None,
+) -> Tuple:
+    return (
+        user_id,
+        generation,
+        normalize_query(query),
+        top_k,
+        _filter_key(document_ids),
+        _filter_key(url_ids),
+        _filter_key(categories),
+    )
+
+
+def get(key: Tuple) -> Optional[List[Any]]:
+    """Cached results for key, or None"""
+    results = _entries.get(key)
+    if results is None:
+        _stats["misses"] += 1
+        return None
+    _entries.move_to_end(key)
+    _stats["hits"] += 1
+    return list(results)
+
+
+def put(key: Tuple, results: List[Any]) -> None:
+    _entries[key] = list(results)
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def search_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters and current size"""
+    lookups = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "hit_rate": round(_stats["hits"] / lookups, 4) if lookups else None,
+        "entries": len(_entries),
+        "max_entries": MAX_ENTRIES,
+    }
+
+
+__all__ = [
+    "get",
+    "make_key",
+    "normalize_query",
+    "put",
+    "search_cache_stats",
+]
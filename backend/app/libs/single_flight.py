@@ -0,0 +1,72 @@
+"""Coalescing of identical in-flight requests.
+
+When the same question is asked several times within seconds, every copy
+would otherwise pay for its own embedding, ranking and completion. `run`
+makes concurrent calls with the same key share one computation: the first
+caller starts it and later callers await its result instead of starting
+their own. Once it finishes, the key is free again, so this only merges
+requests that overlap in time; caches cover repeats after that.
+
+The computation runs as its own task. A caller that goes away (for example a
+client disconnecting) stops waiting without cancelling it for the others.
+Callers that joined get a deep copy of the result, so no two requests share
+mutable objects. Keys are per worker and must include everything the result
+depends on, including the tenant for tenant data.
+
+Usage:
+
+    from app.libs import single_flight
+
+    results, shared = await single_flight.run((user_id, "search", query), compute)
+"""
+
+import asyncio
+import copy
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# key -> computation in progress
+_in_flight: Dict[Hashable, asyncio.Task] = {}
+
+_stats = {"leaders": 0, "joined": 0}
+
+
+async def run(key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+    """compute()'s result, shared with concurrent calls for the same key
+
+    Returns the result and whether it came from a computation started by
+    another caller.
+    """
+    task = _in_flight.get(key)
+    if task is not None:
+        _stats["joined"] += 1
+        return copy.deepcopy(await asyncio.shield(task)), True
+
+    _stats["leaders"] += 1
+    task = asyncio.ensure_future(compute())
+    _in_flight[key] = task
+
+    def done(task: asyncio.Task) -> None:
+        if _in_flight.get(key) is task:
+            del _in_flight[key]
+        if not task.cancelled():
+            # Retrieve the exception so an unawaited failure is not reported as never retrieved
+            task.exception()
+
+    task.add_done_callback(done)
+    return await asyncio.shield(task), False
+
+
+def single_flight_stats() -> Dict[str, Any]:
+    """How many calls started a computation and how many joined one"""
+    calls = _stats["leaders"] + _stats["joined"]
+    return {
+        **_stats,
+        "coalesced_rate": round(_stats["joined"] / calls, 4) if calls else None,
+        "in_flight": len(_in_flight),
+    }
+
+
+__all__ = [
+    "run",
+    "single_flight_stats",
+]
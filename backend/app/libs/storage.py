@@ -0,0 +1,119 @@
+"""Async facade over the configured storage backend.
+
+Storage clients are synchronous, so calling them from an async endpoint
+blocks the event loop for the whole round trip. These helpers run each call
+on a bounded thread pool instead, offer `*_get_many` variants that fetch many
+keys concurrently, and record per-operation latency metrics. The backend
+(Databutton or local SQLite) is selected in `app.libs.storage_backend`.
+
+Usage:
+
+    from app.libs import storage
+
+    content = await storage.binary_get(file_key)
+    chunk_sets = await storage.json_get_many(keys, default=None)
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from app.libs.metrics import LatencyMetrics
+from app.libs.storage_backend import StorageBackend, get_storage_backend
+
+# Upper bound on storage calls in flight at once per worker
+STORAGE_MAX_WORKERS = int(os.environ.get("STORAGE_MAX_WORKERS", "16"))
+
+_MISSING = object()
+
+_executor = ThreadPoolExecutor(max_workers=STORAGE_MAX_WORKERS, thread_name_prefix="storage")
+
+_metrics: Dict[str, LatencyMetrics] = {}
+
+
+def backend() -> StorageBackend:
+    """The storage backend in use"""
+    return get_storage_backend()
+
+
+async def run(operation: str, func: Callable, *args) -> Any:
+    """Run a blocking storage call on the storage thread pool, recording its latency"""
+    metrics = _metrics.setdefault(operation, LatencyMetrics())
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    failed = False
+    try:
+        return await loop.run_in_executor(_executor, func, *args)
+    except FileNotFoundError:
+        # A missing key is an expected outcome, not a storage failure
+        raise
+    except Exception:
+        failed = True
+        raise
+    finally:
+        metrics.record((time.perf_counter() - start) * 1000, failed)
+
+
+async def _get(operation: str, func: Callable, key: str, default: Any) -> Any:
+    try:
+        return await run(operation, func, key)
+    except FileNotFoundError:
+        if default is _MISSING:
+            raise
+        return default
+
+
+async def json_get(key: str, default: Any = _MISSING) -> Any:
+    """Read a JSON value, raising FileNotFoundError if missing and no default is given"""
+    return await _get("json.get", backend().json_get, key, default)
+
+
+async def json_put(key: str, value: Any) -> None:
+    """Write a JSON value"""
+    await run("json.put", backend().json_put, key, value)
+
+
+async def binary_get(key: str, default: Any = _MISSING) -> Any:
+    """Read a binary value, raising FileNotFoundError if missing and no default is given"""
+    return await _get("binary.get", backend().binary_get, key, default)
+
+
+async def binary_put(key: str, value: bytes) -> None:
+    """Write a binary value"""
+    await run("binary.put", backend().binary_put, key, value)
+
+
+async def json_compare_and_put(key: str, expected_version: Optional[int], value: Dict[str, Any]) -> bool:
+    """Atomic versioned write; only call when backend().supports_atomic_cas"""
+    return await run("json.cas", backend().json_compare_and_put, key, expected_version, value)
+
+
+async def json_get_many(keys: List[str], default: Any = None) -> List[Any]:
+    """Read many JSON values concurrently, in key order, with default for missing keys"""
+    return list(await asyncio.gather(*(json_get(key, default) for key in keys)))
+
+
+async def binary_get_many(keys: List[str], default: Any = None) -> List[Any]:
+    """Read many binary values concurrently, in key order, with default for missing keys"""
+    return list(await asyncio.gather(*(binary_get(key, default) for key in keys)))
+
+
+def storage_metrics() -> Dict[str, Dict[str, Any]]:
+    """Latency summary per storage operation since the worker started"""
+    return {operation: metrics.summary() for operation, metrics in sorted(_metrics.items())}
+
+
+__all__ = [
+    "backend",
+    "binary_get",
+    "binary_get_many",
+    "binary_put",
+    "json_compare_and_put",
+    "json_get",
+    "json_get_many",
+    "json_put",
+    "run",
+    "storage_metrics",
+]
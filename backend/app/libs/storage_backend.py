@@ -0,0 +1,353 @@
+"""Storage backends behind `app.libs.storage`.
+
+The backend is chosen with the STORAGE_BACKEND environment variable:
+
+- "databutton" (default): db.storage on the Databutton platform.
+- "sqlite": a local SQLite database in WAL mode at STORAGE_SQLITE_PATH, for
+  running the service outside Databutton and for benchmarks. Besides JSON and
+  binary values it keeps document/URL metadata in an indexed table, so list
+  and filter queries run as SQL instead of scanning index pages.
+
+Backends are synchronous; `app.libs.storage` runs them on its thread pool.
+
+Usage:
+
+    from app.libs.storage_backend import get_storage_backend
+
+    backend = get_storage_backend()
+    if backend.supports_metadata_queries:
+        records, total = backend.metadata_list("documents", user_id)
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class StorageBackend:
+    """Key-value storage for JSON and binary values"""
+
+    name = "base"
+
+    # Whether the backend implements the metadata_* query methods
+    supports_metadata_queries = False
+
+    # Whether json_compare_and_put is atomic across processes
+    supports_atomic_cas = False
+
+    def json_get(self, key: str) -> Any:
+        """Read a JSON value, raising FileNotFoundError if missing"""
+        raise NotImplementedError
+
+    def json_put(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def binary_get(self, key: str) -> bytes:
+        """Read a binary value, raising FileNotFoundError if missing"""
+        raise NotImplementedError
+
+    def binary_put(self, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    def json_compare_and_put(self, key: str, expected_version: Optional[int], value: Dict[str, Any]) -> bool:
+        """Atomically write value if the stored "version" equals expected_version"""
+        raise NotImplementedError
+
+
+class DatabuttonStorageBackend(StorageBackend):
+    """db.storage from the databutton SDK"""
+
+    name = "databutton"
+
+    def __init__(self):
+        import databutton as db
+
+        self._storage = db.storage
+
+    def json_get(self, key: str) -> Any:
+        return self._storage.json.get(key)
+
+    def json_put(self, key: str, value: Any) -> None:
+        self._storage.json.put(key, value)
+
+    def binary_get(self, key: str) -> bytes:
+        return self._storage.binary.get(key)
+
+    def binary_put(self, key: str, value: bytes) -> None:
+        self._storage.binary.put(key, value)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS json_store (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    version INTEGER
+);
+CREATE TABLE IF NOT EXISTS binary_store (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    category TEXT,
+    indexed INTEGER,
+    version INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, user_id, id)
+);
+CREATE INDEX IF NOT EXISTS metadata_by_user ON metadata (kind, user_id, seq);
+CREATE INDEX IF NOT EXISTS metadata_by_category ON metadata (kind, user_id, category, seq);
+CREATE INDEX IF NOT EXISTS metadata_by_indexed ON metadata (kind, user_id, indexed, seq);
+CREATE TABLE IF NOT EXISTS metadata_imports (
+    kind TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (kind, user_id)
+);
+"""
+
+
+def _indexed_value(value: Any) -> Optional[int]:
+    return None if value is None else int(bool(value))
+
+
+class SQLiteStorageBackend(StorageBackend):
+    """Local SQLite storage in WAL mode, one connection per thread"""
+
+    name = "sqlite"
+    supports_metadata_queries = True
+    supports_atomic_cas = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        conn = self._connect()
+        return _Transaction(conn)
+
+    # Key-value storage
+    def json_get(self, key: str) -> Any:
+        row = self._connect().execute("SELECT value FROM json_store WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(key)
+        return json.loads(row[0])
+
+    def json_put(self, key: str, value: Any) -> None:
+        version = value.get("version") if isinstance(value, dict) else None
+        self._connect().execute(
+            "INSERT INTO json_store (key, value, version) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, version = excluded.version",
+            (key, json.dumps(value), version if isinstance(version, int) else None),
+        )
+
+    def binary_get(self, key: str) -> bytes:
+        row = self._connect().execute("SELECT value FROM binary_store WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(key)
+        return bytes(row[0])
+
+    def binary_put(self, key: str, value: bytes) -> None:
+        self._connect().execute(
+            "INSERT INTO binary_store (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, sqlite3.Binary(value)),
+        )
+
+    def json_compare_and_put(self, key: str, expected_version: Optional[int], value: Dict[str, Any]) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT version FROM json_store WHERE key = ?", (key,)).fetchone()
+            current = None if row is None else (row[0] or 0)
+            if current != expected_version:
+                return False
+            self.json_put(key, value)
+            return True
+
+    # Metadata records
+    def metadata_get(self, kind: str, user_id: str, record_id: str) -> Optional[Dict[str, Any]]:
+        row = self._connect().execute(
+            "SELECT data FROM metadata WHERE kind = ? AND user_id = ? AND id = ?",
+            (kind, user_id, record_id),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _where(self, kind, user_id, ids, categories, indexed) -> Tuple[str, List[Any]]:
+        clauses = ["kind = ?", "user_id = ?"]
+        params: List[Any] = [kind, user_id]
+        if ids is not None:
+            clauses.append(f"id IN ({', '.join('?' * len(ids))})")
+            params.extend(ids)
+        if categories is not None:
+            clauses.append(f"category IN ({', '.join('?' * len(categories))})")
+            params.extend(categories)
+        if indexed is not None:
+            clauses.append("indexed = 1" if indexed else "(indexed IS NULL OR indexed = 0)")
+        return " AND ".join(clauses), params
+
+    def metadata_list(
+        self,
+        kind: str,
+        user_id: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        ids: Optional[List[str]] = None,
+        categories: Optional[List[str]] = None,
+        indexed: Optional[bool] = None,
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        where, params = self._where(kind, user_id, ids, categories, indexed)
+        conn = self._connect()
+        total = conn.execute(f"SELECT COUNT(*) FROM metadata WHERE {where}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT data FROM metadata WHERE {where} ORDER BY seq LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset],
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def metadata_entries(self, kind: str, user_id: str) -> List[Dict[str, Any]]:
+        rows = self._connect().execute(
+            "SELECT id, version, category, indexed FROM metadata "
+            "WHERE kind = ? AND user_id = ? ORDER BY seq",
+            (kind, user_id),
+        ).fetchall()
+        return [
+            {"id": row[0], "version": row[1], "category": row[2], "indexed": None if row[3] is None else bool(row[3])}
+            for row in rows
+        ]
+
+    def metadata_categories(self, kind: str, user_id: str) -> List[str]:
+        rows = self._connect().execute(
+            "SELECT DISTINCT category FROM metadata "
+            "WHERE kind = ? AND user_id = ? AND category IS NOT NULL AND category != ''",
+            (kind, user_id),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def metadata_insert(self, kind: str, user_id: str, record: Dict[str, Any]) -> None:
+        """Insert a record, or replace it in place if its id already exists"""
+        with self._transaction() as conn:
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM metadata WHERE kind = ? AND user_id = ?",
+                (kind, user_id),
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO metadata (kind, user_id, id, seq, category, indexed, version, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1, ?) "
+                "ON CONFLICT (kind, user_id, id) DO UPDATE SET category = excluded.category, "
+                "indexed = excluded.indexed, version = version + 1, data = excluded.data",
+                (kind, user_id, record["id"], seq, record.get("category"),
+                 _indexed_value(record.get("indexed")), json.dumps(record)),
+            )
+
+    def metadata_import(self, kind: str, user_id: str, records: List[Dict[str, Any]]) -> int:
+        """Insert a user's legacy records in order, at most once per user
+
+        Records whose id already exists are kept as they are. Returns the
+        number of records inserted, 0 if the user was imported before.
+        """
+        with self._transaction() as conn:
+            if conn.execute(
+                "SELECT 1 FROM metadata_imports WHERE kind = ? AND user_id = ?", (kind, user_id)
+            ).fetchone():
+                return 0
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM metadata WHERE kind = ? AND user_id = ?",
+                (kind, user_id),
+            ).fetchone()[0]
+            imported = 0
+            for record in records:
+                seq += 1
+                imported += conn.execute(
+                    "INSERT INTO metadata (kind, user_id, id, seq, category, indexed, version, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, 1, ?) ON CONFLICT (kind, user_id, id) DO NOTHING",
+                    (kind, user_id, record["id"], seq, record.get("category"),
+                     _indexed_value(record.get("indexed")), json.dumps(record)),
+                ).rowcount
+            conn.execute("INSERT INTO metadata_imports (kind, user_id) VALUES (?, ?)", (kind, user_id))
+            return imported
+
+    def metadata_update(self, kind: str, user_id: str, record_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Merge fields into a record in one transaction, returning the new record"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM metadata WHERE kind = ? AND user_id = ? AND id = ?",
+                (kind, user_id, record_id),
+            ).fetchone()
+            if row is None:
+                return None
+            record = {**json.loads(row[0]), **fields}
+            conn.execute(
+                "UPDATE metadata SET category = ?, indexed = ?, version = version + 1, data = ? "
+                "WHERE kind = ? AND user_id = ? AND id = ?",
+                (record.get("category"), _indexed_value(record.get("indexed")), json.dumps(record),
+                 kind, user_id, record_id),
+            )
+            return record
+
+    def metadata_delete(self, kind: str, user_id: str, record_id: str) -> Optional[Dict[str, Any]]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM metadata WHERE kind = ? AND user_id = ? AND id = ?",
+                (kind, user_id, record_id),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "DELETE FROM metadata WHERE kind = ? AND user_id = ? AND id = ?",
+                (kind, user_id, record_id),
+            )
+            return json.loads(row[0])
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolling back on error"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+@functools.cache
+def get_storage_backend() -> StorageBackend:
+    """The storage backend selected by STORAGE_BACKEND, created once per process"""
+    name = os.environ.get("STORAGE_BACKEND", "databutton").lower()
+    if name == "sqlite":
+        path = os.environ.get("STORAGE_SQLITE_PATH", "storage.sqlite3")
+        print(f"[STORAGE] Using SQLite storage backend at {path}")
+        return SQLiteStorageBackend(path)
+    if name == "databutton":
+        print(
+            "[STORAGE] Using databutton storage, which has no atomic compare-and-swap: "
+            "run ingestion on a single worker, or set STORAGE_BACKEND=sqlite"
+        )
+        return DatabuttonStorageBackend()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+
+
+__all__ = [
+    "DatabuttonStorageBackend",
+    "SQLiteStorageBackend",
+    "StorageBackend",
+    "get_storage_backend",
+]
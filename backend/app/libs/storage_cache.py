@@ -0,0 +1,247 @@
+"""Read cache in front of JSON storage.
+
+Two layers sit in front of storage reads:
+
+- A request-scoped memo, active inside a `request_scope()` block, so repeated
+  reads of the same key within one request or indexing run cost one round trip.
+- A process-level write-through cache shared by every request in the worker.
+  Entries are tagged with the payload's "version" field (when present), writes
+  never replace a cached value with an older version, and entries expire after
+  a short TTL so changes made by other workers become visible.
+
+Versioned payloads can also be written with `compare_and_put`, which only
+writes when the stored version still matches the one the caller read. On
+backends without atomic compare-and-swap (databutton.storage) it writes, waits
+CAS_SETTLE_MS and reads the key back, so of two workers racing from the same
+version only the one whose payload storage kept succeeds. That holds as long
+as a storage write lands within CAS_SETTLE_MS; run ingestion on one worker
+unless STORAGE_BACKEND=sqlite.
+
+Cache misses are served through the async facade in `app.libs.storage`.
+
+Usage:
+
+    from app.libs import storage_cache
+
+    with storage_cache.request_scope():
+        record = await storage_cache.json_get(key)
+        await storage_cache.json_put(key, record)
+"""
+
+import asyncio
+import contextvars
+import copy
+import json
+import os
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from app.libs import storage
+
+# Seconds a process-level entry is trusted before it is read from storage again
+CACHE_TTL_SECONDS = float(os.environ.get("STORAGE_CACHE_TTL_SECONDS", "5"))
+
+# Maximum number of keys held in the process-level cache
+CACHE_MAX_ENTRIES = int(os.environ.get("STORAGE_CACHE_MAX_ENTRIES", "10000"))
+
+# Milliseconds a non-atomic compare_and_put waits before reading its write back
+CAS_SETTLE_MS = float(os.environ.get("STORAGE_CAS_SETTLE_MS", "200"))
+
+_MISSING = object()
+_UNCACHED = object()
+
+_request_cache: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar(
+    "storage_request_cache", default=None
+)
+
+# key -> (version, expires_at, value)
+_process_cache: "OrderedDict[str, tuple]" = OrderedDict()
+
+# key -> lock serializing compare_and_put calls within this process
+_write_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+_stats = {"request_hits": 0, "process_hits": 0, "misses": 0, "writes": 0, "cas_conflicts": 0}
+
+
+def _version_of(value: Any) -> Optional[int]:
+    if isinstance(value, dict) and isinstance(value.get("version"), int):
+        return value["version"]
+    return None
+
+
+def _remember(key: str, value: Any) -> None:
+    version = _version_of(value)
+    cached = _process_cache.get(key)
+    if cached is not None and version is not None and cached[0] is not None and cached[0] > version:
+        # Never let an older payload replace a newer cached one
+        return
+
+    _process_cache[key] = (version, time.monotonic() + CACHE_TTL_SECONDS, value)
+    _process_cache.move_to_end(key)
+    while len(_process_cache) > CACHE_MAX_ENTRIES:
+        _process_cache.popitem(last=False)
+
+
+@contextmanager
+def request_scope():
+    """Memoize storage reads for the duration of the block
+
+    Nested scopes share the outermost memo.
+    """
+    if _request_cache.get() is not None:
+        yield
+        return
+
+    token = _request_cache.set({})
+    try:
+        yield
+    finally:
+        _request_cache.reset(token)
+
+
+def _lookup(key: str, fresh: bool) -> Any:
+    """Return the cached value for key, _MISSING for a memoized miss, or _UNCACHED"""
+    memo = _request_cache.get()
+    if not fresh and memo is not None and key in memo:
+        _stats["request_hits"] += 1
+        return memo[key]
+    cached = None if fresh else _process_cache.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        _stats["process_hits"] += 1
+        if memo is not None:
+            memo[key] = cached[2]
+        return cached[2]
+    return _UNCACHED
+
+
+def _store(key: str, value: Any) -> None:
+    """Record a value read from storage, or _MISSING if the key does not exist"""
+    if value is _MISSING:
+        # Missing keys are only memoized per request, since another
+        # worker may create them at any time
+        _process_cache.pop(key, None)
+    else:
+        _remember(key, value)
+    memo = _request_cache.get()
+    if memo is not None:
+        memo[key] = value
+
+
+def _result(key: str, value: Any, default: Any, shared: bool) -> Any:
+    if value is _MISSING:
+        if default is _MISSING:
+            raise FileNotFoundError(key)
+        return default
+    return value if shared else copy.deepcopy(value)
+
+
+async def json_get(key: str, default: Any = _MISSING, fresh: bool = False, shared: bool = False) -> Any:
+    """Read a JSON value, raising FileNotFoundError if missing and no default is given
+
+    With fresh=True both cache layers are bypassed and refreshed from storage.
+    Values are copies the caller may change; with shared=True the cached
+    object itself is returned, for read-only callers, and must not be modified.
+    """
+    value = _lookup(key, fresh)
+    if value is _UNCACHED:
+        _stats["misses"] += 1
+        value = await storage.json_get(key, default=_MISSING)
+        _store(key, value)
+    return _result(key, value, default, shared)
+
+
+async def json_get_many(keys: List[str], default: Any = None, shared: bool = False) -> List[Any]:
+    """Read many JSON values, fetching all cache misses concurrently; shared as for json_get"""
+    values = [_lookup(key, False) for key in keys]
+    missing = [i for i, value in enumerate(values) if value is _UNCACHED]
+    if missing:
+        _stats["misses"] += len(missing)
+        fetched = await storage.json_get_many([keys[i] for i in missing], default=_MISSING)
+        for i, value in zip(missing, fetched):
+            _store(keys[i], value)
+            values[i] = value
+    return [_result(key, value, default, shared) for key, value in zip(keys, values)]
+
+
+async def json_put(key: str, value: Any) -> None:
+    """Write a JSON value through to storage and both cache layers"""
+    await storage.json_put(key, value)
+    _stats["writes"] += 1
+
+    value = copy.deepcopy(value)
+    _remember(key, value)
+    memo = _request_cache.get()
+    if memo is not None:
+        memo[key] = value
+
+
+async def compare_and_put(key: str, expected_version: Optional[int], value: Dict[str, Any]) -> bool:
+    """Write a versioned value only if the stored version equals expected_version
+
+    Use expected_version=None for keys that must not exist yet. Returns False
+    when another writer got there first; the caller should re-read and retry.
+    Backends with atomic compare-and-swap (SQLite) do the check in storage.
+    Otherwise writers in this process are serialized per key, and a write is
+    only reported as done if storage still holds its payload CAS_SETTLE_MS
+    later: storage is last-writer-wins, so a worker that wrote from the same
+    version and was overwritten sees the other payload and retries.
+    """
+    if storage.backend().supports_atomic_cas:
+        written = await storage.json_compare_and_put(key, expected_version, value)
+        if written:
+            _stats["writes"] += 1
+            _store(key, copy.deepcopy(value))
+        else:
+            _stats["cas_conflicts"] += 1
+            invalidate(key)
+        return written
+
+    lock = _write_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _write_locks[key] = lock
+
+    async with lock:
+        current = await json_get(key, default=None, fresh=True)
+        current_version = _version_of(current) if current is not None else None
+        if current is not None and current_version is None:
+            current_version = 0
+        if current_version != expected_version:
+            _stats["cas_conflicts"] += 1
+            return False
+
+        # Compare against the payload as storage returns it
+        written = json.loads(json.dumps(value))
+        await json_put(key, value)
+        await asyncio.sleep(CAS_SETTLE_MS / 1000)
+        if await json_get(key, default=None, fresh=True) != written:
+            _stats["cas_conflicts"] += 1
+            return False
+        return True
+
+
+def invalidate(key: str) -> None:
+    """Drop a key from both cache layers"""
+    _process_cache.pop(key, None)
+    memo = _request_cache.get()
+    if memo is not None:
+        memo.pop(key, None)
+
+
+def cache_stats() -> Dict[str, int]:
+    """Hit/miss counters and current size of the process-level cache"""
+    return {**_stats, "entries": len(_process_cache)}
+
+
+__all__ = [
+    "cache_stats",
+    "compare_and_put",
+    "invalidate",
+    "json_get",
+    "json_get_many",
+    "json_put",
+    "request_scope",
+]
@@ -0,0 +1,673 @@
+"""Packed per-user vector index.
+
+Indexed chunks are stored in a few append-only segments per user instead of
+one JSON blob per document or URL, so a search reads a handful of keys no
+matter how many sources the user has.
+
+The index is columnar: vectors, chunk text and source metadata are stored
+separately, so scoring a query never deserializes text.
+
+Storage layout per user:
+
+    vector_manifest/{user}                  versioned manifest (see below)
+    vector_segment/{user}/{segment}         .npy float32 matrix, L2-normalized
+    vector_text/{user}/{segment}/{block}    chunk ids and texts of TEXT_BLOCK_ROWS rows
+
+The manifest lists the segments and, once per live source, its metadata and
+where its rows are (segment, offset, row count). A search loads the vector
+column only and then fetches the text blocks holding its top-k rows.
+
+Segments never change once written, so their vector matrices are also kept in
+a local disk cache (VECTOR_INDEX_CACHE_DIR, empty to disable) and opened with
+numpy.memmap. Worker processes on one host share a single page-cache copy, and
+a restarted worker reads only the manifest from storage. Only files of
+retired segments past their grace period are removed: by the worker that
+deletes their data, and by a load of the index on any other worker of the
+host. Files the manifest does not list are left alone, since they may belong
+to a newer generation than the manifest this worker has seen.
+
+The manifest version is the index generation: it increases by one with every
+change, so a search or cache that records it knows exactly which state of the
+index it saw. Each source entry also records the generation at which that
+source was last indexed or updated.
+
+Indexing a source writes a new segment and then points the manifest entry for
+that source at it; rows of older copies of the source become dead. Removing a
+source only drops its manifest entry. When a user accumulates more than
+VECTOR_INDEX_MAX_SEGMENTS segments, the smallest ones are merged (LSM style)
+into one segment holding only their live rows.
+
+Snapshots loaded before a merge keep reading the merged-away segments, on
+this worker while the next snapshot loads and on other workers until they
+refresh. Segments that drop out of the manifest are therefore only retired:
+the manifest lists them with the time they were dropped, and their data is
+deleted by the first manifest write after VECTOR_INDEX_RETIRED_GRACE_SECONDS.
+A snapshot that still finds a chunk gone raises StaleIndexError, so the
+caller can reload instead of ranking empty text.
+
+With VECTOR_INDEX_QUANTIZATION set to "int8" or "float16", a loaded index
+also keeps a quantized copy of each segment (see `vector_quantization`).
+Searches scan the quantized copy, so its scores are approximate. Rankers
+rescore their best candidates with `rescore`, which reads the
+full-precision vectors of those rows only; with the disk cache they stay
+memory-mapped rather than resident. VECTOR_INDEX_RESCORE_ROWS is how many
+candidates per query a ranker should rescore.
+
+Usage:
+
+    from app.libs import vector_index
+
+    await vector_index.add_source(user_id, "document", doc_id, chunk_ids, texts, embeddings, metadata)
+    index = await vector_index.load_index(user_id)
+    scores = index.similarities(query_embedding)
+    chunks = await index.fetch_chunks(top_rows)
+"""
+
+import asyncio
+import io
+import os
+import random
+import re
+import tempfile
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.libs import storage, storage_cache, vector_quantization
+
+# Segment count above which the smallest segments are merged
+MAX_SEGMENTS = int(os.environ.get("VECTOR_INDEX_MAX_SEGMENTS", "8"))
+
+# Rows per text block; a top-k search reads at most k blocks
+TEXT_BLOCK_ROWS = int(os.environ.get("VECTOR_INDEX_TEXT_BLOCK_ROWS", "64"))
+
+# Local directory holding memory-mapped copies of segment vectors
+CACHE_DIR = os.environ.get("VECTOR_INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vector_index"))
+
+# Quantized copy of the vectors scanned by searches: "int8", "float16" or empty for none
+QUANTIZATION = os.environ.get("VECTOR_INDEX_QUANTIZATION", "")
+
+# Rows per query rescored with full-precision vectors after a quantized scan
+RESCORE_ROWS = int(os.environ.get("VECTOR_INDEX_RESCORE_ROWS", "200"))
+
+# Seconds a segment dropped from the manifest keeps its data for older snapshots
+RETIRED_GRACE_SECONDS = float(os.environ.get("VECTOR_INDEX_RETIRED_GRACE_SECONDS", "3600"))
+
+# Attempts made by a manifest compare-and-swap before giving up
+MAX_MANIFEST_RETRIES = 8
+
+_compactions: Dict[str, asyncio.Task] = {}
+
+
+class StaleIndexError(Exception):
+    """Raised when a snapshot reads rows whose segment has since been deleted"""
+
+
+def sanitize_storage_key(key: str) -> str:
+    """Sanitize storage key to only allow alphanumeric and ._- symbols"""
+    # Remove slashes first
+    key = key.replace("/", "")
+    # Then filter other characters
+    return re.sub(r'[^a-zA-Z0-9._-]', '', key)
+
+
+def manifest_key(user_id: str) -> str:
+    return sanitize_storage_key(f"vector_manifest/{user_id}")
+
+
+def segment_key(user_id: str, segment_id: str) -> str:
+    return sanitize_storage_key(f"vector_segment/{user_id}/{segment_id}")
+
+
+def text_key(user_id: str, segment_id: str, block: int) -> str:
+    return sanitize_storage_key(f"vector_text/{user_id}/{segment_id}/{block}")
+
+
+def source_key(source_type: str, source_id: str) -> str:
+    return f"{source_type}:{source_id}"
+
+
+def _empty_manifest() -> Dict[str, Any]:
+    return {"version": 0, "segments": [], "sources": {}, "retired": []}
+
+
+# Segments
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _vectors_to_bytes(vectors: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, vectors, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _vectors_from_bytes(data: bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+# Local disk cache
+def _cache_path(user_id: str, segment_id: str) -> str:
+    return os.path.join(CACHE_DIR, sanitize_storage_key(user_id), f"{segment_id}.npy")
+
+
+def _cache_read(path: str) -> Optional[np.ndarray]:
+    try:
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+
+
+def _cache_write(path: str, data: bytes) -> Optional[np.ndarray]:
+    """Write a segment file atomically and map it, or None if the disk is unusable"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[VECTOR INDEX] Could not cache segment at {path}: {str(e)}")
+        return None
+    return _cache_read(path)
+
+
+def _cache_prune(user_id: str, segment_ids: List[str]) -> None:
+    """Remove the cached files of segments whose data is deleted"""
+    for segment_id in segment_ids:
+        try:
+            # Workers still mapping the file keep their view until they reload
+            os.remove(_cache_path(user_id, segment_id))
+        except OSError:
+            pass
+
+
+async def _write_segment(user_id: str, vectors: np.ndarray, chunk_ids: List[str], texts: List[str]) -> Dict[str, Any]:
+    """Write the vector and text columns of a new segment, returning its manifest entry"""
+    segment_id = uuid.uuid4().hex
+    await asyncio.gather(*(
+        storage.json_put(text_key(user_id, segment_id, block), {
+            "chunk_ids": chunk_ids[start:start + TEXT_BLOCK_ROWS],
+            "texts": texts[start:start + TEXT_BLOCK_ROWS],
+        })
+        for block, start in enumerate(range(0, len(chunk_ids), TEXT_BLOCK_ROWS))
+    ))
+    # The segment must be in storage before the manifest points at it
+    data = _vectors_to_bytes(vectors)
+    await storage.binary_put(segment_key(user_id, segment_id), data)
+    if CACHE_DIR:
+        await storage.run("vector_cache.write", _cache_write, _cache_path(user_id, segment_id), data)
+    return {"id": segment_id, "rows": int(vectors.shape[0])}
+
+
+async def _load_vectors(user_id: str, segment_ids: List[str]) -> List[Optional[np.ndarray]]:
+    """Vector matrices of the given segments, memory-mapped from the local cache when possible"""
+    if not CACHE_DIR:
+        blobs = await storage.binary_get_many([segment_key(user_id, s) for s in segment_ids])
+        return [_vectors_from_bytes(blob) if blob else None for blob in blobs]
+
+    paths = [_cache_path(user_id, segment_id) for segment_id in segment_ids]
+    vectors = list(await asyncio.gather(*(storage.run("vector_cache.read", _cache_read, path) for path in paths)))
+    missing = [i for i, array in enumerate(vectors) if array is None]
+    if missing:
+        blobs = await storage.binary_get_many([segment_key(user_id, segment_ids[i]) for i in missing])
+        for i, blob in zip(missing, blobs):
+            if not blob:
+                continue
+            mapped = await storage.run("vector_cache.write", _cache_write, paths[i], blob)
+            vectors[i] = mapped if mapped is not None else _vectors_from_bytes(blob)
+    return vectors
+
+
+async def _load_texts(user_id: str, segment_id: str, rows: int) -> Tuple[List[str], List[str]]:
+    """All chunk ids and texts of a segment"""
+    blocks = await storage.json_get_many([
+        text_key(user_id, segment_id, block) for block in range((rows + TEXT_BLOCK_ROWS - 1) // TEXT_BLOCK_ROWS)
+    ], default={})
+    chunk_ids = [chunk_id for block in blocks for chunk_id in block.get("chunk_ids", [])]
+    texts = [text for block in blocks for text in block.get("texts", [])]
+    return chunk_ids, texts
+
+
+async def _discard_segments(user_id: str, segments: List[Dict[str, Any]]) -> None:
+    """Storage has no delete, so blank out segments no longer referenced by any snapshot"""
+    for segment in segments:
+        await storage.binary_put(segment_key(user_id, segment["id"]), b"")
+        for block in range((segment["rows"] + TEXT_BLOCK_ROWS - 1) // TEXT_BLOCK_ROWS):
+            await storage_cache.json_put(text_key(user_id, segment["id"], block), {})
+    if CACHE_DIR:
+        await storage.run("vector_cache.prune", _cache_prune, user_id, [segment["id"] for segment in segments])
+
+
+# Manifest
+async def load_manifest(user_id: str, fresh: bool = False) -> Optional[Dict[str, Any]]:
+    """The user's manifest, or None if the user has no vector index yet
+
+    The manifest is the cached object itself and must not be modified;
+    changes go through `_update_manifest`, which reads its own copy.
+    """
+    return await storage_cache.json_get(manifest_key(user_id), default=None, fresh=fresh, shared=True)
+
+
+async def _update_manifest(user_id: str, change) -> Dict[str, Any]:
+    """Apply change(manifest) with compare-and-swap, retrying on conflicts"""
+    key = manifest_key(user_id)
+    for attempt in range(MAX_MANIFEST_RETRIES):
+        manifest = await storage_cache.json_get(key, default=None, fresh=attempt > 0)
+        expected = manifest["version"] if manifest else None
+        manifest = manifest or _empty_manifest()
+        change(manifest)
+        expired = _expire_retired(manifest)
+        manifest["version"] = (expected or 0) + 1
+        if await storage_cache.compare_and_put(key, expected, manifest):
+            if expired:
+                try:
+                    await _discard_segments(user_id, expired)
+                except Exception as e:
+                    print(f"[VECTOR INDEX] Discarding retired segments failed for user {user_id}: {str(e)}")
+            return manifest
+        await asyncio.sleep(random.uniform(0, 0.005 * (2 ** attempt)))
+    raise RuntimeError(f"Vector manifest for user {user_id} kept changing during update")
+
+
+def generation_of(manifest: Optional[Dict[str, Any]]) -> int:
+    """The index generation a manifest represents (0 before the first write)"""
+    return manifest["version"] if manifest else 0
+
+
+async def generation(user_id: str) -> int:
+    """The user's current index generation
+
+    Every index, delete, metadata update or merge bumps it atomically with
+    the manifest write, so it identifies one consistent state of the index.
+    Caches of anything derived from the index can use it as their key.
+    """
+    return generation_of(await load_manifest(user_id))
+
+
+def source_generations(manifest: Optional[Dict[str, Any]], keys: List[str]) -> Dict[str, Optional[int]]:
+    """Generation at which each source was last indexed or updated (None if not indexed)
+
+    Unlike the index generation this does not move when other sources
+    change or segments are merged.
+    """
+    sources = manifest["sources"] if manifest else {}
+    return {key: sources[key].get("generation", 0) if key in sources else None for key in keys}
+
+
+async def create_manifest(user_id: str) -> Dict[str, Any]:
+    """Create an empty manifest for the user if none exists yet"""
+    return await _update_manifest(user_id, lambda manifest: None)
+
+
+# Writes
+async def add_sources(user_id: str, sources: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Index (or re-index) several sources together as one new segment
+
+    Each source is a dict with source_type, source_id, chunk_ids, texts,
+    embeddings and metadata. Returns the new manifest, or None if there was
+    nothing to index.
+    """
+    sources = [s for s in sources if s["chunk_ids"]]
+    if not sources:
+        return None
+
+    vectors, offsets, chunk_ids, texts = [], [], [], []
+    for source in sources:
+        offsets.append(len(chunk_ids))
+        vectors.append(np.asarray(source["embeddings"], dtype=np.float32))
+        chunk_ids.extend(source["chunk_ids"])
+        texts.extend(source["texts"])
+
+    segment = await _write_segment(user_id, _normalize(np.concatenate(vectors)), chunk_ids, texts)
+
+    def change(manifest: Dict[str, Any]) -> None:
+        manifest["segments"].append(segment)
+        generation = manifest["version"] + 1
+        for source, offset in zip(sources, offsets):
+            manifest["sources"][source_key(source["source_type"], source["source_id"])] = {
+                "source_type": source["source_type"],
+                "source_id": source["source_id"],
+                "segment": segment["id"],
+                "offset": offset,
+                "rows": len(source["chunk_ids"]),
+                "metadata": source["metadata"],
+                "generation": generation,
+            }
+        _drop_dead_segments(manifest)
+
+    manifest = await _update_manifest(user_id, change)
+    if len(manifest["segments"]) > MAX_SEGMENTS:
+        schedule_compaction(user_id)
+    return manifest
+
+
+async def add_source(
+    user_id: str,
+    source_type: str,
+    source_id: str,
+    chunk_ids: List[str],
+    texts: List[str],
+    embeddings: List[List[float]],
+    metadata: Dict[str, Any],
+) -> Optional[Dict[str, Any]]:
+    """Index (or re-index) a single source as a new segment"""
+    return await add_sources(user_id, [{
+        "source_type": source_type,
+        "source_id": source_id,
+        "chunk_ids": chunk_ids,
+        "texts": texts,
+        "embeddings": embeddings,
+        "metadata": metadata,
+    }])
+
+
+async def remove_source(user_id: str, source_type: str, source_id: str) -> Optional[Dict[str, Any]]:
+    """Drop a source from the index; its rows are discarded at the next merge
+
+    Returns the new manifest, or None if the user has no index.
+    """
+    key = source_key(source_type, source_id)
+
+    def change(manifest: Dict[str, Any]) -> None:
+        manifest["sources"].pop(key, None)
+        _drop_dead_segments(manifest)
+
+    if await load_manifest(user_id) is None:
+        return None
+    return await _update_manifest(user_id, change)
+
+
+async def update_source_metadata(user_id: str, source_type: str, source_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Update the stored metadata of an indexed source (e.g. a new category)
+
+    Returns the new manifest, or None if the source is not indexed.
+    """
+    key = source_key(source_type, source_id)
+    manifest = await load_manifest(user_id)
+    if manifest is None or key not in manifest["sources"]:
+        return None
+
+    def change(manifest: Dict[str, Any]) -> None:
+        if key in manifest["sources"]:
+            manifest["sources"][key]["metadata"].update(fields)
+            manifest["sources"][key]["generation"] = manifest["version"] + 1
+
+    return await _update_manifest(user_id, change)
+
+
+def _live_rows(manifest: Dict[str, Any]) -> Dict[str, int]:
+    live: Dict[str, int] = {}
+    for source in manifest["sources"].values():
+        live[source["segment"]] = live.get(source["segment"], 0) + source["rows"]
+    return live
+
+
+def _retire_segments(manifest: Dict[str, Any], segments: List[Dict[str, Any]]) -> None:
+    """Keep the data of segments dropped from the manifest for RETIRED_GRACE_SECONDS"""
+    now = time.time()
+    manifest.setdefault("retired", []).extend(
+        {"id": segment["id"], "rows": segment["rows"], "retired_at": now} for segment in segments
+    )
+
+
+def _expired(manifest: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """The retired segments past their grace period"""
+    cutoff = time.time() - RETIRED_GRACE_SECONDS
+    return [segment for segment in manifest.get("retired", []) if segment["retired_at"] <= cutoff]
+
+
+def _expire_retired(manifest: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Take the retired segments past their grace period out of the manifest"""
+    expired = _expired(manifest)
+    manifest["retired"] = [segment for segment in manifest.get("retired", []) if segment not in expired]
+    return expired
+
+
+def _drop_dead_segments(manifest: Dict[str, Any]) -> None:
+    """Retire segments no live source points at any more"""
+    live = _live_rows(manifest)
+    _retire_segments(manifest, [s for s in manifest["segments"] if not live.get(s["id"])])
+    manifest["segments"] = [s for s in manifest["segments"] if live.get(s["id"])]
+
+
+# Compaction
+def schedule_compaction(user_id: str) -> None:
+    """Merge small segments in the background, at most once at a time per user"""
+    task = _compactions.get(user_id)
+    if task is None or task.done():
+        _compactions[user_id] = asyncio.create_task(compact(user_id))
+
+
+async def compact(user_id: str) -> None:
+    """Merge the smallest segments into one containing only their live rows"""
+    try:
+        manifest = await load_manifest(user_id)
+        if manifest is None or len(manifest["segments"]) <= MAX_SEGMENTS:
+            return
+
+        live = _live_rows(manifest)
+        by_size = sorted(manifest["segments"], key=lambda s: live.get(s["id"], 0))
+        to_merge = by_size[:len(by_size) - MAX_SEGMENTS // 2 + 1]
+        merge_vectors = await _load_vectors(user_id, [s["id"] for s in to_merge])
+        merge_texts = await asyncio.gather(*(_load_texts(user_id, s["id"], s["rows"]) for s in to_merge))
+
+        # Keep each source's rows only from the segment the manifest points at
+        vectors, moved, chunk_ids, texts = [], [], [], []
+        for segment, segment_vectors, (segment_chunk_ids, segment_texts) in zip(to_merge, merge_vectors, merge_texts):
+            if segment_vectors is None:
+                continue
+            for key, source in manifest["sources"].items():
+                if source["segment"] != segment["id"]:
+                    continue
+                rows = slice(source["offset"], source["offset"] + source["rows"])
+                moved.append({"key": key, "from": segment["id"], "offset": len(chunk_ids)})
+                vectors.append(segment_vectors[rows])
+                chunk_ids.extend(segment_chunk_ids[rows])
+                texts.extend(segment_texts[rows])
+
+        merged = await _write_segment(user_id, np.concatenate(vectors), chunk_ids, texts) if vectors else None
+
+        def change(manifest: Dict[str, Any]) -> None:
+            if merged is not None:
+                manifest["segments"].append(merged)
+                for entry in moved:
+                    current = manifest["sources"].get(entry["key"])
+                    # Sources re-indexed or removed during the merge keep their newer state
+                    if current is not None and current["segment"] == entry["from"]:
+                        current["segment"] = merged["id"]
+                        current["offset"] = entry["offset"]
+            _drop_dead_segments(manifest)
+
+        manifest = await _update_manifest(user_id, change)
+        print(f"[VECTOR INDEX] Merged {len(to_merge)} segments for user {user_id}, "
+              f"{len(manifest['segments'])} segments remain")
+    except Exception as e:
+        print(f"[VECTOR INDEX] Compaction failed for user {user_id}: {str(e)}")
+
+
+# Reads
+class TenantIndex:
+    """The vector column of one user's index, ready for scoring
+
+    Rows are numbered across all live rows of the user's segments; text is
+    fetched per row with fetch_chunks.
+    """
+
+    def __init__(self, user_id: str, generation: int, sources: List[Dict[str, Any]],
+                 segments: List[Tuple[str, np.ndarray, np.ndarray]],
+                 quantized: Optional[Dict[str, vector_quantization.QuantizedVectors]] = None):
+        self.user_id = user_id
+        self.generation = generation  # manifest version the index was built from
+        self.sources = sources  # manifest source entries
+        # (segment id, segment vectors, live row offsets within the segment)
+        self.segments = segments
+        # segment id -> quantized copy of its vectors, scanned instead when present
+        self.quantized = quantized or {}
+
+        row_source, row_segment = [], []
+        source_index = {source["segment"]: [] for source in sources}
+        for position, source in enumerate(sources):
+            source_index[source["segment"]].append((source["offset"], source["rows"], position))
+        for segment_position, (segment_id, _, live) in enumerate(segments):
+            for offset, rows, position in sorted(source_index.get(segment_id, [])):
+                row_source.append(np.full(rows, position, dtype=np.int32))
+            row_segment.append(np.full(len(live), segment_position, dtype=np.int32))
+
+        self.row_source = np.concatenate(row_source) if row_source else np.zeros(0, dtype=np.int32)
+        self.row_segment = np.concatenate(row_segment) if row_segment else np.zeros(0, dtype=np.int32)
+        self.row_offset = np.concatenate([live for _, _, live in segments]) if segments else np.zeros(0, dtype=np.int64)
+
+    @property
+    def size(self) -> int:
+        return int(self.row_source.shape[0])
+
+    def similarities(self, query_embedding: List[float]) -> np.ndarray:
+        """Cosine similarity of one query against every row (approximate if quantized)"""
+        if self.quantized:
+            return self.similarities_many([query_embedding])[0]
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        if not self.segments:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate([(vectors @ query)[live] for _, vectors, live in self.segments])
+
+    def similarities_many(self, query_embeddings: List[List[float]]) -> np.ndarray:
+        """Cosine similarity of several queries against every row, one row per query
+
+        All queries are scored in one matrix-matrix product per segment. With
+        a quantized index the scores are approximate; see `rescore`.
+        """
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        if not self.segments:
+            return np.zeros((len(queries), 0), dtype=np.float32)
+        if self.quantized:
+            return np.concatenate([
+                self.quantized[segment_id].dot(queries)[live] for segment_id, _, live in self.segments
+            ]).T
+        return np.concatenate([(vectors @ queries.T)[live] for _, vectors, live in self.segments]).T
+
+    def rescore(self, query_embeddings: List[List[float]], rows: np.ndarray) -> np.ndarray:
+        """Exact cosine similarity of several queries against the given rows, one row per query"""
+        queries = _normalize(np.asarray(query_embeddings, dtype=np.float32))
+        if len(rows) == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32)
+        return (self._row_vectors(rows) @ queries.T).T
+
+    def _row_vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Full-precision vectors of the given rows, reading only those rows"""
+        dimensions = self.segments[0][1].shape[1]
+        vectors = np.empty((len(rows), dimensions), dtype=np.float32)
+        row_segments = self.row_segment[rows]
+        for segment_position in np.unique(row_segments):
+            selected = row_segments == segment_position
+            vectors[selected] = self.segments[segment_position][1][self.row_offset[rows[selected]]]
+        return vectors
+
+    async def fetch_chunks(self, rows: List[int]) -> List[Tuple[str, str]]:
+        """(chunk id, text) of the given rows, reading only the text blocks they fall in"""
+        locations = [
+            (self.segments[self.row_segment[row]][0], int(self.row_offset[row]))
+            for row in rows
+        ]
+        keys = sorted({text_key(self.user_id, segment_id, offset // TEXT_BLOCK_ROWS) for segment_id, offset in locations})
+        blocks = dict(zip(keys, await storage_cache.json_get_many(keys, default={}, shared=True)))
+
+        chunks = []
+        for segment_id, offset in locations:
+            block = blocks[text_key(self.user_id, segment_id, offset // TEXT_BLOCK_ROWS)] or {}
+            index = offset % TEXT_BLOCK_ROWS
+            chunk_ids, texts = block.get("chunk_ids", []), block.get("texts", [])
+            if index >= len(chunk_ids) or index >= len(texts):
+                raise StaleIndexError(f"Segment {segment_id} of user {self.user_id} is no longer stored")
+            chunks.append((chunk_ids[index], texts[index]))
+        return chunks
+
+    def source_generations(self, keys: List[str]) -> Dict[str, Optional[int]]:
+        """Like `source_generations`, as of this snapshot"""
+        generations = {source_key(s["source_type"], s["source_id"]): s.get("generation", 0) for s in self.sources}
+        return {key: generations.get(key) for key in keys}
+
+    @classmethod
+    def empty(cls, user_id: str, generation: int = 0) -> "TenantIndex":
+        return cls(user_id, generation, [], [])
+
+
+def _quantize_segments(segments: List[Tuple[str, np.ndarray, np.ndarray]],
+                       reuse: Dict[str, vector_quantization.QuantizedVectors]) -> Dict[str, vector_quantization.QuantizedVectors]:
+    return {
+        segment_id: reuse.get(segment_id) or vector_quantization.quantize(vectors, QUANTIZATION)
+        for segment_id, vectors, _ in segments
+    }
+
+
+async def load_index(user_id: str, manifest: Optional[Dict[str, Any]] = None, previous: Optional[TenantIndex] = None) -> TenantIndex:
+    """Load the vector column of all of the user's live rows
+
+    With QUANTIZATION set, segments are also quantized; those already
+    quantized in previous, an older snapshot of the same index, are reused.
+    """
+    if manifest is None:
+        manifest = await load_manifest(user_id)
+    if not manifest or not manifest["segments"]:
+        return TenantIndex.empty(user_id, generation_of(manifest))
+
+    segment_ids = [s["id"] for s in manifest["segments"]]
+    loaded = dict(zip(segment_ids, await _load_vectors(user_id, segment_ids)))
+
+    # Sources whose segment could not be read are left out of the index
+    sources = [s for s in manifest["sources"].values() if loaded.get(s["segment"]) is not None]
+    segments = []
+    for segment_id in segment_ids:
+        vectors = loaded[segment_id]
+        if vectors is None:
+            continue
+        live = [
+            np.arange(s["offset"], s["offset"] + s["rows"])
+            for s in sorted(sources, key=lambda s: s["offset"]) if s["segment"] == segment_id
+        ]
+        if live:
+            segments.append((segment_id, vectors, np.concatenate(live)))
+
+    quantized = None
+    if QUANTIZATION:
+        # Segments never change, so their quantized copies carry over between generations
+        reuse = previous.quantized if previous is not None and previous.user_id == user_id else {}
+        loop = asyncio.get_running_loop()
+        quantized = await loop.run_in_executor(None, _quantize_segments, segments, reuse)
+
+    expired = _expired(manifest)
+    if CACHE_DIR and expired:
+        # Their data is deleted at the next manifest write on some worker, maybe on another host
+        await storage.run("vector_cache.prune", _cache_prune, user_id, [s["id"] for s in expired])
+    return TenantIndex(user_id, generation_of(manifest), sources, segments, quantized)
+
+
+__all__ = [
+    "CACHE_DIR",
+    "MAX_SEGMENTS",
+    "QUANTIZATION",
+    "RESCORE_ROWS",
+    "RETIRED_GRACE_SECONDS",
+    "StaleIndexError",
+    "TEXT_BLOCK_ROWS",
+    "TenantIndex",
+    "add_source",
+    "add_sources",
+    "compact",
+    "create_manifest",
+    "generation",
+    "generation_of",
+    "load_index",
+    "load_manifest",
+    "remove_source",
+    "schedule_compaction",
+    "source_generations",
+    "source_key",
+    "update_source_metadata",
+]
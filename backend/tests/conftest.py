@@ -0,0 +1,13 @@
+"""Test setup: the libraries run against a throwaway SQLite store and disk cache."""
+
+import os
+import sys
+import tempfile
+
+_TEMP_DIR = tempfile.mkdtemp(prefix="rag-tests-")
+
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["STORAGE_SQLITE_PATH"] = os.path.join(_TEMP_DIR, "storage.sqlite3")
+os.environ["VECTOR_INDEX_CACHE_DIR"] = os.path.join(_TEMP_DIR, "vector_index")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
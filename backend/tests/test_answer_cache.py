@@ -0,0 +1,55 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+from app.libs import answer_cache, vector_index
+
+
+@pytest.fixture
+def user_id(monkeypatch):
+    monkeypatch.setattr(answer_cache, "_entries", OrderedDict())
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    user_id = uuid.uuid4().hex
+    for source_id in ("a", "b"):
+        asyncio.run(vector_index.add_source(
+            user_id, "document", source_id, [f"{source_id}-0"], [f"text of {source_id}"], [[1.0, 0.0]], {"title": source_id}
+        ))
+    return user_id
+
+
+def snapshot_generations(user_id, keys):
+    return asyncio.run(vector_index.load_index(user_id)).source_generations(keys)
+
+
+def test_answer_is_reused_until_one_of_its_sources_changes(user_id):
+    key = vector_index.source_key("document", "a")
+    asyncio.run(answer_cache.store(user_id, "question", [1.0, 0.0], {"message": "### Answer"}, "raw answer", snapshot_generations(user_id, [key])))
+
+    # Changes to other sources do not invalidate the answer
+    asyncio.run(vector_index.update_source_metadata(user_id, "document", "b", {"category": "x"}))
+    hit = asyncio.run(answer_cache.lookup(user_id, [0.99, 0.01]))
+    assert hit["response"] == {"message": "### Answer"}
+    assert hit["answer"] == "raw answer"
+
+    asyncio.run(vector_index.update_source_metadata(user_id, "document", "a", {"category": "x"}))
+    assert asyncio.run(answer_cache.lookup(user_id, [1.0, 0.0])) is None
+
+
+def test_answer_retrieved_from_an_older_snapshot_is_stale_when_stored(user_id):
+    key = vector_index.source_key("document", "a")
+    generations = snapshot_generations(user_id, [key])
+    # The source changes between retrieval and the end of the completion
+    asyncio.run(vector_index.update_source_metadata(user_id, "document", "a", {"category": "x"}))
+
+    asyncio.run(answer_cache.store(user_id, "question", [1.0, 0.0], {"message": "answer"}, "answer", generations))
+
+    assert asyncio.run(answer_cache.lookup(user_id, [1.0, 0.0])) is None
+
+
+def test_dissimilar_questions_miss(user_id):
+    key = vector_index.source_key("document", "a")
+    asyncio.run(answer_cache.store(user_id, "question", [1.0, 0.0], {"message": "answer"}, "answer", snapshot_generations(user_id, [key])))
+
+    assert asyncio.run(answer_cache.lookup(user_id, [0.0, 1.0])) is None
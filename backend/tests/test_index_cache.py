@@ -0,0 +1,68 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+from app.libs import index_cache, vector_index
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """Three indexed users and an empty cache"""
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    monkeypatch.setattr(index_cache, "_resident", OrderedDict())
+    monkeypatch.setattr(index_cache, "_resident_bytes", 0)
+    user_ids = [uuid.uuid4().hex for _ in range(3)]
+
+    async def index():
+        for user_id in user_ids:
+            await vector_index.add_source(
+                user_id, "document", "a", ["a-0", "a-1"], ["one", "two"], [[1.0, 0.0], [0.0, 1.0]], {"title": "a"}
+            )
+
+    asyncio.run(index())
+    return user_ids
+
+
+def test_least_recently_used_indexes_are_evicted_to_stay_in_budget(users, monkeypatch):
+    first, second, third = users
+
+    async def scenario():
+        size = index_cache.index_bytes(await index_cache.get_index(first))
+        monkeypatch.setattr(index_cache, "MEMORY_BUDGET_BYTES", 2 * size)
+        await index_cache.get_index(second)
+        await index_cache.get_index(first)
+        await index_cache.get_index(third)
+
+    asyncio.run(scenario())
+
+    assert list(index_cache._resident) == [first, third]
+    assert index_cache._resident_bytes <= index_cache.MEMORY_BUDGET_BYTES
+
+
+def test_indexes_larger_than_the_budget_are_served_but_not_kept(users, monkeypatch):
+    monkeypatch.setattr(index_cache, "MEMORY_BUDGET_BYTES", 1)
+
+    index = asyncio.run(index_cache.get_index(users[0]))
+
+    assert len(index.row_source) == 2
+    assert users[0] not in index_cache._resident
+
+
+def test_schedule_refresh_swaps_in_the_next_generation(users):
+    user_id = users[0]
+
+    async def scenario():
+        first = await index_cache.get_index(user_id)
+        manifest = await vector_index.update_source_metadata(user_id, "document", "a", {"category": "x"})
+        index_cache.schedule_refresh(user_id, manifest)
+        while index_cache._loading:
+            await asyncio.sleep(0.01)
+        return first, await index_cache.get_index(user_id, manifest), manifest
+
+    first, refreshed, manifest = asyncio.run(scenario())
+
+    assert refreshed is not first
+    assert refreshed.generation == manifest["version"]
+    assert refreshed.sources[0]["metadata"]["category"] == "x"
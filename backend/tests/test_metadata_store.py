@@ -0,0 +1,145 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.libs import metadata_store, storage_cache
+from app.libs.metadata_store import MetadataStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """A store on the key-value layout, whatever the configured backend"""
+    monkeypatch.setattr(MetadataStore, "_use_sql", False)
+    monkeypatch.setattr(metadata_store, "INDEX_PAGE_SIZE", 4)
+    return MetadataStore("documents")
+
+
+def record(record_id, **fields):
+    return {"id": record_id, "category": None, "indexed": False, **fields}
+
+
+def test_create_writes_the_record_before_its_index_entry(store, monkeypatch):
+    user_id = uuid.uuid4().hex
+    seen = []
+    mutate_index = store._mutate_index
+
+    async def observe(user_id, mutation):
+        seen.append(await store._load_envelope(user_id, "a"))
+        return await mutate_index(user_id, mutation)
+
+    monkeypatch.setattr(store, "_mutate_index", observe)
+    asyncio.run(store.create(user_id, record("a")))
+
+    assert seen[0]["record"]["id"] == "a"
+    assert asyncio.run(store._load_envelope(user_id, "a"))["page"] == 0
+
+
+def test_concurrent_creates_all_reach_the_index(store):
+    user_id = uuid.uuid4().hex
+
+    async def scenario():
+        await asyncio.gather(*(store.create(user_id, record(f"r{n}")) for n in range(10)))
+        return await store.list(user_id), await store.list(user_id, offset=3, limit=4)
+
+    (records, total), (window, window_total) = asyncio.run(scenario())
+
+    assert total == window_total == 10
+    assert sorted(r["id"] for r in records) == sorted(f"r{n}" for n in range(10))
+    assert [r["id"] for r in window] == [r["id"] for r in records[3:7]]
+
+
+def test_index_writer_holds_its_flush_task_until_done(store):
+    user_id = uuid.uuid4().hex
+
+    async def mutation(state):
+        return "applied"
+
+    async def scenario():
+        mutate = asyncio.ensure_future(store._mutate_index(user_id, mutation))
+        await asyncio.sleep(0)
+        writer = store._writers[user_id]
+        running = writer.task
+        assert await mutate == "applied"
+        await asyncio.sleep(0)
+        return running, writer.task
+
+    running, finished = asyncio.run(scenario())
+
+    assert running is not None and running.done()
+    assert finished is None
+
+
+def test_concurrent_updates_of_one_record_are_all_applied(store):
+    user_id = uuid.uuid4().hex
+
+    async def scenario():
+        await store.create(user_id, record("a"))
+        await asyncio.gather(
+            store.update(user_id, "a", {"category": "guidelines"}),
+            store.update(user_id, "a", {"indexed": True}),
+            store.update(user_id, "a", {"title": "Sepsis"}),
+        )
+        return await store.get(user_id, "a"), await store.entries(user_id)
+
+    updated, entries = asyncio.run(scenario())
+
+    assert updated["category"] == "guidelines" and updated["indexed"] is True and updated["title"] == "Sepsis"
+    assert [(e["category"], e["indexed"]) for e in entries] == [("guidelines", True)]
+
+
+def test_deleted_records_leave_the_listing(store):
+    user_id = uuid.uuid4().hex
+
+    async def scenario():
+        for n in range(3):
+            await store.create(user_id, record(f"r{n}"))
+        await store.delete(user_id, "r1")
+        return await store.list(user_id), await store.get(user_id, "r1")
+
+    (records, total), deleted = asyncio.run(scenario())
+
+    assert [r["id"] for r in records] == ["r0", "r2"] and total == 2
+    assert deleted is None
+
+
+@pytest.fixture
+def sql_store():
+    """A store on the SQLite metadata table configured for the tests"""
+    store = MetadataStore("documents")
+    if not store._use_sql:
+        pytest.skip("needs the SQLite storage backend")
+    return store
+
+
+def test_sql_store_imports_the_legacy_blob_once(sql_store):
+    user_id = uuid.uuid4().hex
+    legacy = {"documents": [record("old1", category="guidelines"), record("old2")]}
+
+    async def scenario():
+        await storage_cache.json_put(sql_store._legacy_key(user_id), legacy)
+        first, _ = await sql_store.list(user_id)
+        await sql_store.delete(user_id, "old1")
+        # A new process reads the blob again but does not bring the deleted record back
+        return first, await MetadataStore("documents").list(user_id), await sql_store.categories(user_id)
+
+    first, (after_delete, total), categories = asyncio.run(scenario())
+
+    assert [r["id"] for r in first] == ["old1", "old2"]
+    assert [r["id"] for r in after_delete] == ["old2"] and total == 1
+    assert categories == []
+
+
+def test_sql_store_create_is_idempotent(sql_store):
+    user_id = uuid.uuid4().hex
+
+    async def scenario():
+        await sql_store.create(user_id, record("a"))
+        await sql_store.create(user_id, record("b"))
+        await sql_store.create(user_id, record("a", category="guidelines"))
+        return await sql_store.list(user_id)
+
+    records, total = asyncio.run(scenario())
+
+    assert [(r["id"], r["category"]) for r in records] == [("a", "guidelines"), ("b", None)]
+    assert total == 2
@@ -0,0 +1,64 @@
+import asyncio
+import uuid
+
+import numpy as np
+import pytest
+
+embeddings = pytest.importorskip("app.apis.embeddings")
+
+from app.libs import vector_index  # noqa: E402
+
+
+@pytest.fixture
+def quantized(monkeypatch):
+    """An int8 index of two documents, with their full-precision vectors by chunk id"""
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    monkeypatch.setattr(vector_index, "QUANTIZATION", "int8")
+    # Far fewer rows rescored than indexed, so filtered rows are outside any global shortlist
+    monkeypatch.setattr(vector_index, "RESCORE_ROWS", 2)
+    rng = np.random.default_rng(7)
+    user_id = uuid.uuid4().hex
+    vectors = {}
+
+    async def load():
+        for source_id, rows in (("big", 60), ("small", 6)):
+            chunk_ids = [f"{source_id}-{row}" for row in range(rows)]
+            source_vectors = rng.standard_normal((rows, 16)).astype(np.float32)
+            vectors.update(zip(chunk_ids, source_vectors / np.linalg.norm(source_vectors, axis=1, keepdims=True)))
+            await vector_index.add_source(
+                user_id, "document", source_id, chunk_ids, chunk_ids, source_vectors.tolist(), {"title": source_id}
+            )
+        return await vector_index.load_index(user_id)
+
+    index = asyncio.run(load())
+    assert index.quantized
+    return index, vectors, rng
+
+
+def exact_scores(vectors, query, results):
+    query = np.asarray(query, dtype=np.float32)
+    return [float(vectors[result.id] @ (query / np.linalg.norm(query))) for result in results]
+
+
+def test_filtered_search_returns_exact_scores(quantized):
+    index, vectors, rng = quantized
+    query = rng.standard_normal(16).tolist()
+
+    results = asyncio.run(embeddings.rank_index(index, query, top_k=3, document_ids=["small"]))
+
+    assert len(results) == 3 and all(result.id.startswith("small-") for result in results)
+    np.testing.assert_allclose([result.semantic_score for result in results], exact_scores(vectors, query, results), atol=1e-6)
+    # Within one source the ranking follows the exact similarity
+    small = sorted((chunk_id for chunk_id in vectors if chunk_id.startswith("small-")),
+                   key=lambda chunk_id: -float(vectors[chunk_id] @ np.asarray(query, dtype=np.float32)))
+    assert [result.id for result in results] == small[:3]
+
+
+def test_fused_search_returns_exact_scores(quantized):
+    index, vectors, rng = quantized
+    queries = rng.standard_normal((2, 16)).tolist()
+
+    results = asyncio.run(embeddings.rank_index_fused(index, queries, top_k=5))
+
+    best = [max(exact_scores(vectors, query, [result])[0] for query in queries) for result in results]
+    np.testing.assert_allclose([result.semantic_score for result in results], best, atol=1e-6)
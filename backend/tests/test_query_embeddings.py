@@ -0,0 +1,42 @@
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+embeddings = pytest.importorskip("app.apis.embeddings")
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    """Fake embedding provider recording the texts of every call"""
+    calls = []
+
+    async def generate_embeddings(texts):
+        calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    monkeypatch.setattr(embeddings, "generate_embeddings", generate_embeddings)
+    monkeypatch.setattr(embeddings, "_query_embeddings", OrderedDict())
+    monkeypatch.setattr(embeddings, "QUERY_EMBEDDING_CACHE_SIZE", 3)
+    return calls
+
+
+def test_embed_queries_keeps_cached_queries_of_a_call_that_overflows_the_cache(provider):
+    asyncio.run(embeddings.embed_queries(["a", "bb", "ccc"]))
+
+    result = asyncio.run(embeddings.embed_queries(["a", "dddd"]))
+
+    assert result == [[1.0], [4.0]]
+    assert provider == [["a", "bb", "ccc"], ["dddd"]]
+    # The least recently used query not in the call is evicted
+    assert list(embeddings._query_embeddings) == ["ccc", "a", "dddd"]
+
+
+def test_embed_queries_with_more_queries_than_the_cache_holds(provider):
+    asyncio.run(embeddings.embed_queries(["a", "bb"]))
+
+    result = asyncio.run(embeddings.embed_queries(["a", "bb", "ccc", "dddd", "a"]))
+
+    assert result == [[1.0], [2.0], [3.0], [4.0], [1.0]]
+    assert provider == [["a", "bb"], ["ccc", "dddd"]]
+    assert len(embeddings._query_embeddings) == 3
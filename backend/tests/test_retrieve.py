@@ -0,0 +1,53 @@
+import asyncio
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+embeddings = pytest.importorskip("app.apis.embeddings")
+
+from app.libs import index_cache, vector_index  # noqa: E402
+
+
+@pytest.fixture
+def stale_user_id(monkeypatch):
+    """A user whose resident index snapshot reads segments deleted by a compaction"""
+    async def generate_embeddings(texts):
+        return [[1.0, 0.0, 0.5] for _ in texts]
+
+    monkeypatch.setattr(embeddings, "generate_embeddings", generate_embeddings)
+    monkeypatch.setattr(embeddings, "_query_embeddings", OrderedDict())
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    user_id = uuid.uuid4().hex
+
+    async def setup():
+        for source_id in ("a", "b", "c"):
+            await vector_index.add_source(
+                user_id, "document", source_id, [f"{source_id}-0"], [f"text of {source_id}"],
+                [[1.0, 0.0, 0.5]], {"title": source_id},
+            )
+        await index_cache.get_index(user_id)
+
+        monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 2)
+        monkeypatch.setattr(vector_index, "RETIRED_GRACE_SECONDS", 0)
+        await vector_index.compact(user_id)
+        await vector_index.update_source_metadata(user_id, "document", "a", {"category": "x"})
+
+    asyncio.run(setup())
+    return user_id
+
+
+def test_retrieve_reloads_an_index_snapshot_whose_segments_were_deleted(stale_user_id):
+    context = asyncio.run(embeddings.retrieve(embeddings.SearchRequest(query="question", top_k=3), stale_user_id))
+
+    assert sorted(result.text for result in context.results) == ["text of a", "text of b", "text of c"]
+    assert context.generation == asyncio.run(vector_index.generation(stale_user_id))
+
+
+def test_retrieve_batch_reloads_an_index_snapshot_whose_segments_were_deleted(stale_user_id):
+    requests = [embeddings.SearchRequest(query="question", top_k=3), embeddings.SearchRequest(query="other", top_k=1)]
+
+    results = asyncio.run(embeddings.retrieve_batch(requests, stale_user_id))
+
+    assert sorted(result.text for result in results[0]) == ["text of a", "text of b", "text of c"]
+    assert len(results[1]) == 1 and results[1][0].text
@@ -0,0 +1,81 @@
+import asyncio
+import uuid
+
+import numpy as np
+import pytest
+
+from app.libs import search_batcher, vector_index
+
+
+@pytest.fixture
+def index(monkeypatch):
+    """A small index whose matrix products are counted"""
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    monkeypatch.setattr(search_batcher, "WINDOW_MS", 20)
+    user_id = uuid.uuid4().hex
+
+    async def load():
+        await vector_index.add_source(
+            user_id, "document", "a", ["a-0", "a-1", "a-2"], ["one", "two", "three"],
+            [[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]], {"title": "a"},
+        )
+        return await vector_index.load_index(user_id)
+
+    index = asyncio.run(load())
+    index.products = []
+    similarities_many = index.similarities_many
+
+    def counted(queries):
+        index.products.append(len(queries))
+        return similarities_many(queries)
+
+    index.similarities_many = counted
+    return index
+
+
+def test_concurrent_searches_share_one_matrix_product(index):
+    queries = [[[1.0, 0.0]], [[0.0, 1.0], [1.0, 1.0]], [[0.5, 0.5]]]
+
+    async def search():
+        return await asyncio.gather(*(search_batcher.similarities(index, q) for q in queries))
+
+    results = asyncio.run(search())
+
+    assert index.products == [4]
+    for query, scores in zip(queries, results):
+        assert scores.shape == (len(query), 3)
+        np.testing.assert_allclose(scores, index.similarities_many(query))
+
+
+def test_full_batches_are_scored_without_waiting(index, monkeypatch):
+    monkeypatch.setattr(search_batcher, "MAX_QUERIES", 2)
+    monkeypatch.setattr(search_batcher, "WINDOW_MS", 60_000)
+
+    async def search():
+        return await asyncio.wait_for(asyncio.gather(
+            search_batcher.similarities(index, [[1.0, 0.0]]),
+            search_batcher.similarities(index, [[0.0, 1.0]]),
+            search_batcher.similarities(index, [[1.0, 1.0], [0.0, 1.0]]),
+        ), timeout=5)
+
+    results = asyncio.run(search())
+
+    # The third search already fills a batch on its own
+    assert sorted(index.products) == [2, 2]
+    assert [len(scores) for scores in results] == [1, 1, 2]
+
+
+def test_a_failed_product_fails_every_search_of_the_batch(index):
+    def fail(queries):
+        raise ValueError("dimension mismatch")
+
+    index.similarities_many = fail
+
+    async def search():
+        return await asyncio.gather(
+            search_batcher.similarities(index, [[1.0, 0.0]]),
+            search_batcher.similarities(index, [[0.0, 1.0]]),
+            return_exceptions=True,
+        )
+
+    assert [type(result) for result in asyncio.run(search())] == [ValueError, ValueError]
@@ -0,0 +1,61 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.libs import storage, storage_cache
+
+
+@pytest.fixture
+def non_atomic(monkeypatch):
+    """The configured backend, treated as one without compare-and-swap"""
+    monkeypatch.setattr(storage.backend(), "supports_atomic_cas", False)
+    monkeypatch.setattr(storage_cache, "CAS_SETTLE_MS", 10)
+
+
+def test_compare_and_put_checks_the_version_without_atomic_storage(non_atomic):
+    key = f"cas-{uuid.uuid4().hex}"
+
+    async def scenario():
+        created = await storage_cache.compare_and_put(key, None, {"version": 1, "n": 1})
+        stale = await storage_cache.compare_and_put(key, None, {"version": 1, "n": 2})
+        updated = await storage_cache.compare_and_put(key, 1, {"version": 2, "n": 3})
+        return created, stale, updated, await storage_cache.json_get(key, fresh=True)
+
+    assert asyncio.run(scenario()) == (True, False, True, {"version": 2, "n": 3})
+
+
+def test_compare_and_put_fails_when_another_worker_overwrites_it(non_atomic, monkeypatch):
+    key = f"cas-{uuid.uuid4().hex}"
+    rival = {"version": 1, "writer": "other worker"}
+    json_put = storage.json_put
+
+    async def raced(key, value):
+        # Another worker read the same version and writes right after us
+        await json_put(key, value)
+        await json_put(key, rival)
+
+    async def scenario():
+        monkeypatch.setattr(storage, "json_put", raced)
+        written = await storage_cache.compare_and_put(key, None, {"version": 1, "writer": "this worker"})
+        monkeypatch.setattr(storage, "json_put", json_put)
+        return written, await storage_cache.json_get(key)
+
+    assert asyncio.run(scenario()) == (False, rival)
+
+
+def test_shared_reads_skip_the_copy_but_default_reads_do_not():
+    key = f"cache-{uuid.uuid4().hex}"
+
+    async def scenario():
+        await storage_cache.json_put(key, {"version": 1, "rows": [1, 2]})
+        first, second = await storage_cache.json_get(key, shared=True), await storage_cache.json_get(key, shared=True)
+        [listed] = await storage_cache.json_get_many([key], shared=True)
+        private = await storage_cache.json_get(key)
+        private["rows"].append(3)
+        return first, second, listed, await storage_cache.json_get(key)
+
+    first, second, listed, after = asyncio.run(scenario())
+
+    assert first is second is listed
+    assert after == {"version": 1, "rows": [1, 2]}
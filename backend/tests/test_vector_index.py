@@ -0,0 +1,125 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from app.libs import index_cache, storage_cache, vector_index
+
+
+def source(source_id, texts):
+    return {
+        "source_type": "document",
+        "source_id": source_id,
+        "chunk_ids": [f"{source_id}-{position}" for position in range(len(texts))],
+        "texts": texts,
+        "embeddings": [[1.0, float(position), 0.5] for position in range(len(texts))],
+        "metadata": {"title": source_id},
+    }
+
+
+@pytest.fixture
+def user_id(monkeypatch):
+    # Compaction is run explicitly by the tests, never scheduled by a write
+    monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 100)
+    return uuid.uuid4().hex
+
+
+async def index_three_sources(user_id):
+    for source_id in ("a", "b", "c"):
+        await vector_index.add_sources(user_id, [source(source_id, [f"{source_id} one", f"{source_id} two"])])
+
+
+async def texts_of(index):
+    return [text for _, text in await index.fetch_chunks(list(range(len(index.row_source))))]
+
+
+def test_compaction_keeps_merged_segments_readable_by_older_snapshots(user_id, monkeypatch):
+    async def scenario():
+        await index_three_sources(user_id)
+        stale = await vector_index.load_index(user_id)
+
+        monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 2)
+        await vector_index.compact(user_id)
+
+        manifest = await vector_index.load_manifest(user_id)
+        assert len(manifest["segments"]) == 1
+        assert len(manifest["retired"]) == 3
+        assert sorted(await texts_of(stale)) == ["a one", "a two", "b one", "b two", "c one", "c two"]
+
+    asyncio.run(scenario())
+
+
+def test_retired_segments_are_discarded_after_the_grace_period(user_id, monkeypatch):
+    async def scenario():
+        await index_three_sources(user_id)
+        stale = await vector_index.load_index(user_id)
+        monkeypatch.setattr(vector_index, "MAX_SEGMENTS", 2)
+        await vector_index.compact(user_id)
+
+        monkeypatch.setattr(vector_index, "RETIRED_GRACE_SECONDS", 0)
+        manifest = await vector_index.update_source_metadata(user_id, "document", "a", {"category": "x"})
+        assert manifest["retired"] == []
+
+        # A snapshot reading deleted segments fails instead of returning empty text
+        with pytest.raises(vector_index.StaleIndexError):
+            await stale.fetch_chunks([0])
+        current = await vector_index.load_index(user_id, manifest)
+        assert sorted(await texts_of(current)) == ["a one", "a two", "b one", "b two", "c one", "c two"]
+
+    asyncio.run(scenario())
+
+
+def test_get_index_serves_the_resident_snapshot_unless_asked_to_wait(user_id):
+    async def scenario():
+        await vector_index.add_sources(user_id, [source("a", ["a one"])])
+        first = await index_cache.get_index(user_id)
+
+        manifest = await vector_index.add_sources(user_id, [source("b", ["b one"])])
+        assert await index_cache.get_index(user_id, manifest) is first
+
+        current = await index_cache.get_index(user_id, manifest, wait=True)
+        assert current.generation == manifest["version"] > first.generation
+        assert sorted(await texts_of(current)) == ["a one", "b one"]
+
+    asyncio.run(scenario())
+
+
+def test_segments_left_without_live_sources_are_retired_then_discarded(user_id, monkeypatch):
+    async def scenario():
+        first = await vector_index.add_sources(user_id, [source("a", ["a one"]), source("b", ["b one"])])
+        replaced = first["segments"][0]
+        await vector_index.add_sources(user_id, [source("a", ["a new"])])
+        manifest = await vector_index.remove_source(user_id, "document", "b")
+        assert [segment["id"] for segment in manifest["retired"]] == [replaced["id"]]
+        stale = await vector_index.load_index(user_id, first)
+        assert await texts_of(stale) == ["a one", "b one"]
+
+        monkeypatch.setattr(vector_index, "RETIRED_GRACE_SECONDS", 0)
+        manifest = await vector_index.create_manifest(user_id)
+        assert manifest["retired"] == []
+        assert await storage_cache.json_get(vector_index.text_key(user_id, replaced["id"], 0)) == {}
+
+    asyncio.run(scenario())
+
+
+def test_disk_cache_keeps_files_of_newer_and_retired_segments(user_id, monkeypatch):
+    async def scenario():
+        old = await vector_index.add_sources(user_id, [source("a", ["a one"])])
+        replaced = old["segments"][0]["id"]
+        newer = await vector_index.add_sources(user_id, [source("a", ["a new"])])
+        current = newer["segments"][0]["id"]
+
+        # A worker still on the older manifest loads it; the newer segment was written by another worker
+        await vector_index.load_index(user_id, old)
+        await vector_index.load_index(user_id, newer)
+        assert os.path.exists(vector_index._cache_path(user_id, current))
+        # The replaced segment is retired but still readable by older snapshots
+        assert os.path.exists(vector_index._cache_path(user_id, replaced))
+
+        monkeypatch.setattr(vector_index, "RETIRED_GRACE_SECONDS", 0)
+        await vector_index.load_index(user_id, newer)
+        assert not os.path.exists(vector_index._cache_path(user_id, replaced))
+        assert os.path.exists(vector_index._cache_path(user_id, current))
+
+    asyncio.run(scenario())
@@ -10,11 +10,16 @@ import {
   BatchIndexUrlsData,
   BatchIndexUrlsError,
   BatchIndexUrlsParams,
+  BatchSearchRequest,
   BodyUploadDocument,
   ChatData,
   ChatError,
   ChatRequest,
   CheckHealthData,
+  CreateChatSessionData,
+  DeleteChatSessionData,
+  DeleteChatSessionError,
+  DeleteChatSessionParams,
   DeleteDocumentData,
   DeleteDocumentError,
   DeleteDocumentParams,
@@ -58,6 +63,8 @@ import {
   LogQueryError,
   PDFExportRequest,
   QueryMetrics,
+  SearchBatchData,
+  SearchBatchError,
   SearchData,
   SearchError,
   SearchRequest,
@@ -126,6 +133,36 @@ export class Brain<SecurityDataType = unknown> extends HttpClient<SecurityDataTy
       ...params,
     });
 
+  /**
+   * @description Start a server-side conversation Send the returned session_id with each /chat message instead of conversation_history; the server keeps the history and summarizes older turns.
+   *
+   * @tags dbtn/module:chat, dbtn/hasAuth
+   * @name create_chat_session
+   * @summary Create Chat Session
+   * @request POST:/routes/chat/sessions
+   */
+  create_chat_session = (params: RequestParams = {}) =>
+    this.request<CreateChatSessionData, any>({
+      path: `/routes/chat/sessions`,
+      method: "POST",
+      ...params,
+    });
+
+  /**
+   * @description Delete a server-side conversation
+   *
+   * @tags dbtn/module:chat, dbtn/hasAuth
+   * @name delete_chat_session
+   * @summary Delete Chat Session
+   * @request DELETE:/routes/chat/sessions/{session_id}
+   */
+  delete_chat_session = ({ sessionId, ...query }: DeleteChatSessionParams, params: RequestParams = {}) =>
+    this.request<DeleteChatSessionData, DeleteChatSessionError>({
+      path: `/routes/chat/sessions/${sessionId}`,
+      method: "DELETE",
+      ...params,
+    });
+
   /**
    * @description Get detailed metrics for all documents and URLs in the knowledge base
    *
@@ -253,6 +290,23 @@ export class Brain<SecurityDataType = unknown> extends HttpClient<SecurityDataTy
       ...params,
     });
 
+  /**
+   * @description Run many searches in one request, embedding and scoring all queries together
+   *
+   * @tags dbtn/module:embeddings, dbtn/hasAuth
+   * @name search_batch
+   * @summary Search Batch
+   * @request POST:/routes/embeddings/search/batch
+   */
+  search_batch = (data: BatchSearchRequest, params: RequestParams = {}) =>
+    this.request<SearchBatchData, SearchBatchError>({
+      path: `/routes/embeddings/search/batch`,
+      method: "POST",
+      body: data,
+      type: ContentType.Json,
+      ...params,
+    });
+
   /**
    * @description Log query metrics for analytics
    *
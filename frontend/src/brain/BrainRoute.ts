@@ -3,10 +3,13 @@ import {
   BatchIndexAllData,
   BatchIndexDocumentsData,
   BatchIndexUrlsData,
+  BatchSearchRequest,
   BodyUploadDocument,
   ChatData,
   ChatRequest,
   CheckHealthData,
+  CreateChatSessionData,
+  DeleteChatSessionData,
   DeleteDocumentData,
   DeleteUrlData,
   EmailRequest,
@@ -26,6 +29,7 @@ import {
   LogQueryData,
   PDFExportRequest,
   QueryMetrics,
+  SearchBatchData,
   SearchData,
   SearchRequest,
   SendChatSummaryData,
@@ -82,6 +86,39 @@ export namespace Brain {
     export type ResponseBody = ChatData;
   }
 
+  /**
+   * @description Start a server-side conversation Send the returned session_id with each /chat message instead of conversation_history; the server keeps the history and summarizes older turns.
+   * @tags dbtn/module:chat, dbtn/hasAuth
+   * @name create_chat_session
+   * @summary Create Chat Session
+   * @request POST:/routes/chat/sessions
+   */
+  export namespace create_chat_session {
+    export type RequestParams = {};
+    export type RequestQuery = {};
+    export type RequestBody = never;
+    export type RequestHeaders = {};
+    export type ResponseBody = CreateChatSessionData;
+  }
+
+  /**
+   * @description Delete a server-side conversation
+   * @tags dbtn/module:chat, dbtn/hasAuth
+   * @name delete_chat_session
+   * @summary Delete Chat Session
+   * @request DELETE:/routes/chat/sessions/{session_id}
+   */
+  export namespace delete_chat_session {
+    export type RequestParams = {
+      /** Session Id */
+      sessionId: string;
+    };
+    export type RequestQuery = {};
+    export type RequestBody = never;
+    export type RequestHeaders = {};
+    export type ResponseBody = DeleteChatSessionData;
+  }
+
   /**
    * @description Get detailed metrics for all documents and URLs in the knowledge base
    * @tags dbtn/module:content_analysis, dbtn/hasAuth
@@ -226,6 +263,21 @@ export namespace Brain {
     export type ResponseBody = SearchData;
   }
 
+  /**
+   * @description Run many searches in one request, embedding and scoring all queries together
+   * @tags dbtn/module:embeddings, dbtn/hasAuth
+   * @name search_batch
+   * @summary Search Batch
+   * @request POST:/routes/embeddings/search/batch
+   */
+  export namespace search_batch {
+    export type RequestParams = {};
+    export type RequestQuery = {};
+    export type RequestBody = BatchSearchRequest;
+    export type RequestHeaders = {};
+    export type ResponseBody = SearchBatchData;
+  }
+
   /**
    * @description Log query metrics for analytics
    * @tags dbtn/module:analytics, dbtn/hasAuth
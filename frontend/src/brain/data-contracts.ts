@@ -10,6 +10,18 @@ export interface AnalyticsResponse {
   page_size: number;
 }
 
+/** BatchSearchRequest */
+export interface BatchSearchRequest {
+  /** Requests */
+  requests: SearchRequest[];
+}
+
+/** BatchSearchResponse */
+export interface BatchSearchResponse {
+  /** Responses */
+  responses: SearchResponse[];
+}
+
 /** Body_upload_document */
 export interface BodyUploadDocument {
   /**
@@ -30,6 +42,19 @@ export interface ChatRequest {
    * @default []
    */
   conversation_history?: AppApisChatChatMessage[] | null;
+  /** Session Id */
+  session_id?: string | null;
+  /**
+   * Multi Query
+   * @default false
+   */
+  multi_query?: boolean;
+}
+
+/** ChatSessionResponse */
+export interface ChatSessionResponse {
+  /** Session Id */
+  session_id: string;
 }
 
 /** DocumentResponse */
@@ -128,6 +153,18 @@ export interface QueryMetrics {
   response_length: number;
   /** Processing Time Ms */
   processing_time_ms?: number | null;
+  /** Retrieval Time Ms */
+  retrieval_time_ms?: number | null;
+  /** Prompt Tokens */
+  prompt_tokens?: number | null;
+  /** History Tokens */
+  history_tokens?: number | null;
+  /** Context Tokens */
+  context_tokens?: number | null;
+  /** Relevance Gate */
+  relevance_gate?: string | null;
+  /** Top Semantic Score */
+  top_semantic_score?: number | null;
   /** Num Sources */
   num_sources: number;
   /** Avg Semantic Score */
@@ -163,6 +200,11 @@ export interface QueryStatsResponse {
    * @default {}
    */
   source_type_distribution?: Record<string, number>;
+  /**
+   * Relevance Gate Distribution
+   * @default {}
+   */
+  relevance_gate_distribution?: Record<string, number>;
   /**
    * Top Queries
    * @default []
@@ -190,6 +232,13 @@ export interface SearchRequest {
   url_ids?: string[] | null;
   /** Categories */
   categories?: string[] | null;
+  /**
+   * Multi Query
+   * @default false
+   */
+  multi_query?: boolean;
+  /** Earlier Questions */
+  earlier_questions?: string[] | null;
 }
 
 /** SearchResponse */
@@ -325,6 +374,17 @@ export type ChatData = any;
 
 export type ChatError = HTTPValidationError;
 
+export type CreateChatSessionData = ChatSessionResponse;
+
+export interface DeleteChatSessionParams {
+  /** Session Id */
+  sessionId: string;
+}
+
+export type DeleteChatSessionData = any;
+
+export type DeleteChatSessionError = HTTPValidationError;
+
 export type GetContentMetricsData = any;
 
 export type SendChatSummaryData = EmailResponse;
@@ -389,6 +449,10 @@ export type SearchData = SearchResponse;
 
 export type SearchError = HTTPValidationError;
 
+export type SearchBatchData = BatchSearchResponse;
+
+export type SearchBatchError = HTTPValidationError;
+
 export type LogQueryData = any;
 
 export type LogQueryError = HTTPValidationError;
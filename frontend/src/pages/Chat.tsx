@@ -3,7 +3,7 @@ import { useUserGuardContext } from "app";
 import { Header } from "components/Header";
 // Footer removed per user request
 import brain from "brain";
-import { ChatMessage, ChatRequest } from "types";
+import { ChatRequest } from "types";
 import { ChatResponse, Source, EmailDialogState } from "utils/chat-types";
 import { toast } from "sonner";
 import RAGResponseCard from "components/RAGResponseCard";
@@ -154,6 +154,8 @@ const Chat = () => {
   };
   const [message, setMessage] = useState<string>("");
   const [loading, setLoading] = useState<boolean>(false);
+  // Server-side conversation, started with the first message
+  const [sessionId, setSessionId] = useState<string | null>(null);
   // State for expanded sources removed since details feature was removed
   const [emailDialog, setEmailDialog] = useState<EmailDialogState>({
     isOpen: false,
@@ -216,16 +218,19 @@ const Chat = () => {
     try {
       setLoading(true);
       
-      // Format conversation history for API
-      const historyForApi = conversation.map(msg => ({
-        role: msg.role,
-        content: msg.content
-      }));
+      // The server keeps the conversation history for the session
+      let currentSessionId = sessionId;
+      if (!currentSessionId) {
+        const sessionResponse = await brain.create_chat_session();
+        const session = await sessionResponse.json();
+        currentSessionId = session.session_id as string;
+        setSessionId(currentSessionId);
+      }
       
       // Prepare request
       const request: ChatRequest = {
         message: message,
-        conversation_history: historyForApi as ChatMessage[]
+        session_id: currentSessionId
       };
       
       // Call API
@@ -352,6 +357,13 @@ const Chat = () => {
                   onClick={() => {
                     // Keep only the welcome message
                     setConversation([conversation[0]]);
+                    // Start a new server-side history with the next message
+                    if (sessionId) {
+                      brain.delete_chat_session({ sessionId }).catch((error) => {
+                        console.error("Error deleting chat session:", error);
+                      });
+                      setSessionId(null);
+                    }
                     scrollToTop();
                   }}
                   className="text-xs text-gray-500 hover:text-gray-700 flex items-center"
@@ -5,7 +5,9 @@ export interface ChatMessage {
 
 export interface ChatRequest {
   message: string;
-  conversation_history: ChatMessage[];
+  conversation_history?: ChatMessage[];
+  session_id?: string;  // Server-side conversation; replaces conversation_history
+  multi_query?: boolean;  // Retrieve with several query variants fused by rank
 }
 
 export interface RankingInfo {
@@ -49,6 +51,8 @@ export interface ChatResponse {
   message: string;
   confidence_level?: string;
   sources: Source[];
+  cache_hit?: boolean;
+  session_id?: string;
 }
 
 export interface EmailDialogState {